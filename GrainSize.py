@@ -10,9 +10,26 @@
 
 import arcpy
 import os
-from GrainSizeReach import Reach
+import numpy as np
+import GrainSizeCalibration
+from GrainSizeCache import DEFAULT_MAX_BYTES
+from GrainSizeCheckpoint import DEFAULT_CHECKPOINT_INTERVAL
+# The pipeline itself lives in GrainSizeCore, which doesn't need arcpy. Its names are kept here for existing scripts
+from GrainSizeCore import HYDROLOGY_RASTERS, DEFAULT_BATCH_SIZE, TEST_REACHES, DEFAULT_MIN_JAN_TEMP_MAP, \
+    ReachFileWriter, ReachNetwork, prepareFolders, makeInstrumentation, makeReaches, streamReaches, \
+    findFlowAccumulationRaster, openCheckpoint, findReachNetwork, openReachInputs, findDrainageRasters, \
+    findMinJanTemps, findQ_2s, findFlowAccumulations, openFlowAccumulation, findPrecipitations, findEndPoints, \
+    findElevations
+from GrainSizeHydrology import ARCGIS_ENGINE, NATIVE_ENGINE
+from GrainSizeNetwork import SAMPLED_DRAINAGE, NETWORK_DRAINAGE, DEFAULT_SNAP_TOLERANCE
+from GrainSizePipeline import findWidth, findSlopes
+from GrainSizeQ2 import getDefaultRegistry
+from GrainSizeReach import ReachTable
+from GrainSizeRegions import RegionIndex, writeRegionOutputs, writeRegionSummary
 from math import sqrt
-from timeit import default_timer as timer
+
+SHAPEFILE_FIELDS = [("GrainSize", "DOUBLE"), ("Width", "DOUBLE"), ("Q_2", "DOUBLE"), ("Slope", "DOUBLE"),
+                    ("DrainArea", "DOUBLE"), ("ReachFID", "LONG")]
 
 
 def main(dem,
@@ -24,7 +41,16 @@ def main(dem,
          nValue,
          t_cValue,
          regionNumber,
-         testing):
+         testing,
+         cacheFolder=None,
+         cacheSizeLimit=DEFAULT_MAX_BYTES,
+         hydrologyEngine=ARCGIS_ENGINE,
+         maxRasterMemory=None,
+         numWorkers=1,
+         checkpointFolder=None,
+         profile=False,
+         batchSize=DEFAULT_BATCH_SIZE,
+         drainageMethod=SAMPLED_DRAINAGE):
     """
     Our main function
     :param dem: The path to a DEM file
@@ -35,19 +61,234 @@ def main(dem,
     :param nValue: What value we use for our Manning coefficient. Important for our equation
     :param t_cValue: What value we use for our Shields stress coefficient. Important for our equation
     :param regionNumber: What region we use to calculate our Q_2 value
+    :param cacheFolder: Where we keep rasters derived from the DEM between runs. Defaults to a folder in outputFolder
+    :param cacheSizeLimit: How many bytes the cache may use before old entries are thrown out
+    :param hydrologyEngine: "ArcGIS" to find drainage area with Spatial Analyst, or "Native" to use our own engine
+    :param maxRasterMemory: The most memory, in bytes, any one raster may take up before we read it a tile at a time
+    :param numWorkers: How many processes to spread the reaches across. Less than 1 means one per core
+    :param checkpointFolder: Where we save each reach's variables as we go, so a rerun can skip the reaches that are
+    already done. Defaults to a folder in outputFolder
+    :param profile: If True, the run is profiled with cProfile, and the profile and a trace of every stage are written
+    to the output folder
+    :param batchSize: How many reaches are read, found and written at a time. Memory use grows with this, not with the
+    size of the stream network
+    :param drainageMethod: "Sampled" samples drainage area and precipitation at the first point of each reach. "Network"
+    passes them down the stream network, so drainage area never shrinks downstream
     :return: None
     """
+    tempData, outputDataPath, clippedStreamNetwork, hydrologyCache, checkpointFolder = \
+        prepareRun(dem, flowAccumulation, streamNetwork, precipMap, clippingRegion, outputFolder, testing, cacheFolder,
+                   cacheSizeLimit, hydrologyEngine, checkpointFolder)
+    instrumentation = makeInstrumentation(outputDataPath, profile)
+
+    try:
+        """Makes the reaches a batch at a time, and writes each batch to our output folder as soon as it's done"""
+        writer = ReachOutputWriter(outputDataPath, arcpy.Describe(streamNetwork).spatialReference, testing,
+                                   {"n": nValue, "t_c": t_cValue, "regionNumber": regionNumber})
+        try:
+            for reaches in streamReaches(testing, dem, flowAccumulation, clippedStreamNetwork, precipMap, regionNumber,
+                                         tempData, nValue, t_cValue, hydrologyCache=hydrologyCache,
+                                         hydrologyEngine=hydrologyEngine, maxRasterMemory=maxRasterMemory,
+                                         numWorkers=numWorkers, checkpointFolder=checkpointFolder,
+                                         instrumentation=instrumentation, batchSize=batchSize,
+                                         drainageMethod=drainageMethod):
+                with instrumentation.stage("output", len(reaches)):
+                    writer.write(reaches)
+        except:
+            writer.abort()
+            raise
+        with instrumentation.stage("output"):
+            writer.close()
+    finally:
+        instrumentation.finish(outputDataPath + "\\timings.json")
+
+
+def sweep(dem,
+          flowAccumulation,
+          streamNetwork,
+          precipMap,
+          clippingRegion,
+          outputFolder,
+          nValues,
+          t_cValues,
+          regionNumber,
+          testing,
+          observedField=None,
+          cacheFolder=None,
+          cacheSizeLimit=DEFAULT_MAX_BYTES,
+          hydrologyEngine=ARCGIS_ENGINE,
+          maxRasterMemory=None,
+          numWorkers=1,
+          checkpointFolder=None,
+          profile=False,
+          drainageMethod=SAMPLED_DRAINAGE):
+    """
+    Finds the grain size of every reach for every pair of n and t_c values, sampling the rasters only once. If the
+    stream network has measured grain sizes, also finds the t_c that fits them best for each n
+    :param nValues: A list of Manning coefficients to try
+    :param t_cValues: A list of Shields stress coefficients to try
+    :param observedField: A field in the stream network with grain sizes measured in the field, in millimeters. Reaches
+    that weren't measured should be empty or 0
+    :return: A ReachTable of every reach. The other parameters are the same as main()
+    """
+    tempData, outputDataPath, clippedStreamNetwork, hydrologyCache, checkpointFolder = \
+        prepareRun(dem, flowAccumulation, streamNetwork, precipMap, clippingRegion, outputFolder, testing, cacheFolder,
+                   cacheSizeLimit, hydrologyEngine, checkpointFolder)
+    instrumentation = makeInstrumentation(outputDataPath, profile)
+    try:
+        nValues = np.asarray(nValues, dtype=np.float64).ravel()
+        t_cValues = np.asarray(t_cValues, dtype=np.float64).ravel()
+
+        reachArray = makeReaches(testing, dem, flowAccumulation, clippedStreamNetwork, precipMap, regionNumber,
+                                 tempData, nValues[0], t_cValues[0], hydrologyCache=hydrologyCache,
+                                 hydrologyEngine=hydrologyEngine, maxRasterMemory=maxRasterMemory,
+                                 numWorkers=numWorkers, checkpointFolder=checkpointFolder,
+                                 instrumentation=instrumentation, drainageMethod=drainageMethod)
+
+        """The grid goes straight to a .npy file, so it can be bigger than memory"""
+        arcpy.AddMessage("Sweeping " + str(len(nValues) * len(t_cValues)) + " pairs of n and t_c...")
+        with instrumentation.stage("sweep", len(reachArray)):
+            grainSizes = np.lib.format.open_memmap(outputDataPath + "\\sweepGrainSizes.npy", mode="w+",
+                                                   dtype=np.float64,
+                                                   shape=(len(nValues), len(t_cValues), len(reachArray)))
+            GrainSizeCalibration.sweepGrainSizes(reachArray, nValues, t_cValues, grainSizes)
+            grainSizes.flush()
+            del grainSizes
+        sweepResults = {"nValues": nValues, "t_cValues": t_cValues, "featureIds": reachArray.featureIds}
+
+        if observedField is not None:
+            observedGrainSizes = readObservedGrainSizes(clippedStreamNetwork, observedField, reachArray.featureIds)
+            errors, numMeasured = GrainSizeCalibration.sweepErrors(reachArray, nValues, t_cValues, observedGrainSizes)
+            arcpy.AddMessage("Comparing against " + str(numMeasured) + " measured reaches")
+            fittedT_cs = np.full(len(nValues), np.nan)
+            for i, n in enumerate(nValues):
+                t_cs, fittedT_cs[i] = GrainSizeCalibration.fitT_c(reachArray, n, observedGrainSizes)
+                arcpy.AddMessage("Best fitting t_c for n = " + str(n) + ": " + str(fittedT_cs[i]))
+            sweepResults.update({"observedGrainSizes": observedGrainSizes, "logErrors": errors,
+                                 "fittedT_cs": fittedT_cs})
+            if numMeasured > 0:
+                i, j = np.unravel_index(np.nanargmin(errors), errors.shape)
+                arcpy.AddMessage("Best pair in the grid: n = " + str(nValues[i]) + ", t_c = " + str(t_cValues[j]) +
+                                 " (RMS log10 error " + str(errors[i, j]) + ")")
+
+        np.savez(outputDataPath + "\\sweep.npz", **sweepResults)
+    finally:
+        instrumentation.finish(outputDataPath + "\\timings.json")
+    return reachArray
+
+
+def runRegions(dem,
+               flowAccumulation,
+               streamNetwork,
+               precipMap,
+               regions,
+               regionField,
+               outputFolder,
+               nValue,
+               t_cValue,
+               regionNumber,
+               testing,
+               cacheFolder=None,
+               cacheSizeLimit=DEFAULT_MAX_BYTES,
+               hydrologyEngine=ARCGIS_ENGINE,
+               maxRasterMemory=None,
+               numWorkers=1,
+               checkpointFolder=None,
+               profile=False,
+               batchSize=DEFAULT_BATCH_SIZE,
+               drainageMethod=SAMPLED_DRAINAGE):
+    """
+    Runs the tool over many regions at once, like every HUC10 in a state. The rasters and precipitation map are read
+    once for every region, the stream network is read once and each reach is put in its region as it's read, rather
+    than clipping the network once per region. Chunks of reaches are spread across the workers a region at a time.
+    The merged output of every region goes to the GrainSize folder, each region's output goes to its own folder in
+    GrainSize\\regions, and a summary of every region goes to regionSummary.csv and regionSummary.json
+    :param regions: A feature class of region polygons, like HUC10 boundaries
+    :param regionField: The field with the name of each region, like its HUC code
+    :return: A list with a summary dictionary for each region. The other parameters are the same as main()
+    """
+    tempData, outputDataPath, streamNetwork, hydrologyCache, checkpointFolder = \
+        prepareRun(dem, flowAccumulation, streamNetwork, precipMap, None, outputFolder, testing, cacheFolder,
+                   cacheSizeLimit, hydrologyEngine, checkpointFolder)
+    instrumentation = makeInstrumentation(outputDataPath, profile)
+    try:
+        with instrumentation.stage("readRegions"):
+            regionIndex = RegionIndex.fromFeatureClass(regions, regionField)
+        arcpy.AddMessage("Regions to calculate: " + str(len(regionIndex.names)))
+
+        sr = arcpy.Describe(streamNetwork).spatialReference
+        attributes = {"n": nValue, "t_c": t_cValue, "regionNumber": regionNumber}
+        writer = ReachOutputWriter(outputDataPath, sr, testing, attributes)
+        regionIds = []
+        try:
+            for reaches in streamReaches(testing, dem, flowAccumulation, streamNetwork, precipMap, regionNumber,
+                                         tempData, nValue, t_cValue, hydrologyCache=hydrologyCache,
+                                         hydrologyEngine=hydrologyEngine, maxRasterMemory=maxRasterMemory,
+                                         numWorkers=numWorkers, checkpointFolder=checkpointFolder,
+                                         instrumentation=instrumentation, batchSize=batchSize,
+                                         drainageMethod=drainageMethod, regionIndex=regionIndex):
+                with instrumentation.stage("output", len(reaches)):
+                    writer.write(reaches)
+                regionIds.append(reaches.regionIds)
+        except:
+            writer.abort()
+            raise
+        with instrumentation.stage("output"):
+            writer.close()
+
+        """Splits the merged output into a folder for each region"""
+        arcpy.AddMessage("Writing the output of each region...")
+        regionIds = np.concatenate(regionIds) if regionIds else np.zeros(0, dtype=np.int64)
+        with instrumentation.stage("regionOutput", len(regionIds)):
+            summaries = writeRegionOutputs(outputDataPath, regionIds, regionIndex.names, sr.factoryCode or None,
+                                           sr.exportToString().split(";")[0], attributes)
+    finally:
+        timings = instrumentation.finish(outputDataPath + "\\timings.json")
+    emptyRegions = [summary["region"] for summary in summaries if summary["reaches"] == 0]
+    writeRegionSummary(outputDataPath + "\\regionSummary.csv", summaries,
+                       {"reaches": len(regionIds), "regions": len(summaries), "emptyRegions": emptyRegions,
+                        "elapsedSeconds": timings["elapsedSeconds"] if timings else None,
+                        "attributes": attributes})
+    if emptyRegions:
+        arcpy.AddWarning(str(len(emptyRegions)) + " regions have no reaches in them: " + ", ".join(emptyRegions[:10]) +
+                         (", ..." if len(emptyRegions) > 10 else ""))
+    return summaries
+
+
+def readObservedGrainSizes(streamNetwork, observedField, featureIds):
+    """
+    Reads measured grain sizes out of the stream network
+    :param streamNetwork: The stream network the reaches came from
+    :param observedField: The field with measured grain sizes
+    :param featureIds: The feature ID of each reach
+    :return: An array with the measured grain size of each reach, NaN where it wasn't measured
+    """
+    observed = {}
+    searchCursor = arcpy.da.SearchCursor(streamNetwork, ['OID@', observedField])
+    for row in searchCursor:
+        if row[1] is not None and row[1] > 0:
+            observed[row[0]] = float(row[1])
+    del searchCursor
+    return np.array([observed.get(featureId, np.nan) for featureId in featureIds.tolist()], dtype=np.float64)
+
+
+def prepareRun(dem, flowAccumulation, streamNetwork, precipMap, clippingRegion, outputFolder, testing, cacheFolder=None,
+               cacheSizeLimit=DEFAULT_MAX_BYTES, hydrologyEngine=ARCGIS_ENGINE, checkpointFolder=None):
+    """
+    Sets up the folders, clipped stream network and caches that a run of the tool needs
+    :return: The temporary data folder, the output folder, the clipped stream network, the HydrologyCache (None if we
+    were given flow accumulation), and the checkpoint folder
+    """
     # TODO Implement projection checks. Look into sr.abbreviation, sr.alias,
     arcpy.env.overwriteOutput = True
-    arcpy.CheckOutExtension("Spatial")  # We'll be using a bunch of spatial analysis tools
+    if flowAccumulation == None and hydrologyEngine == ARCGIS_ENGINE:
+        arcpy.CheckOutExtension("Spatial")  # Only the ArcGIS hydrology tools need Spatial Analyst
 
     if testing:
         arcpy.AddMessage("Currently in TestMode")
 
-    """Creates the temporary data folder, where we'll put all our intermediate results"""
-    if not os.path.exists(outputFolder+"\\temporaryData"):
-        os.makedirs(outputFolder+"\\temporaryData")
-    tempData = outputFolder + "\\temporaryData"
+    tempData, outputDataPath, hydrologyCache, checkpointFolder = \
+        prepareFolders(outputFolder, flowAccumulation, cacheFolder, cacheSizeLimit, checkpointFolder)
 
     streamSR = arcpy.Describe(streamNetwork).spatialReference
     demSR = arcpy.Describe(dem).spatialReference
@@ -55,11 +296,6 @@ def main(dem,
     if streamSR.PCSName != demSR.PCSName != precipSR.PCSName != precipSR.PCSName:
         arcpy.AddError("DEM AND STREAM NETWORK USE DIFFERENT PROJECTIONS")
 
-    """Creates our output folder, where we'll put our final results"""
-    if not os.path.exists(outputFolder+"\GrainSize"):
-        os.makedirs(outputFolder+"\GrainSize")
-    outputDataPath = outputFolder+"\GrainSize"
-
     """Clips our stream network to a HUC10 region"""
     if clippingRegion != None:
         clippedStreamNetwork = tempData + "\clippedStreamNetwork.shp"
@@ -68,143 +304,10 @@ def main(dem,
     else:
         clippedStreamNetwork = streamNetwork
 
-    """Makes the reaches"""
-    reachArray = makeReaches(testing, dem, flowAccumulation, clippedStreamNetwork, precipMap, regionNumber, tempData,
-                             nValue, t_cValue)
-
-    """Writes our output to a folder"""
-    writeOutput(reachArray, outputDataPath, arcpy.Describe(streamNetwork).spatialReference)
-
-    """Writes data to a text file. Delete in final build"""
-    writeResults(reachArray, testing, outputDataPath)
-
-
-def makeReaches(testing, dem, flowAccumulation, streamNetwork, precipMap, regionNumber, tempData, nValue, t_cValue):
-    """
-    Goes through every reach in the stream network, calculates its width and Q_2 value, and stores that data in a
-    Reach object, which is then placed in an array
-    :param testing: Bool, tells ushether or not we want to only do a small number of reaches for testing purposes.
-    :param streamNetwork: The path to a .shp file that contains our stream network
-    :param precipMap: The path to a .shp file that contains polygons that have precipitation data
-    :param regionNumber: What region we use to calculate our Q_2 value
-    :param tempData: Where we're going to put our temp data, because ArcGIS can't give us an easy way to get data from
-    a raster at a point
-    :param nValue: Our Manning coefficient
-    :param t_cValue: Our Shields critical value
-    :return: An array of reaches, with a calculated Grain size for each
-    """
-
-    reaches = []
-    numReaches = int(arcpy.GetCount_management(streamNetwork).getOutput(0))
-    numReachesString = str(numReaches)
-    arcpy.AddMessage("Reaches to calculate: " + numReachesString)
-
-
-    if flowAccumulation == None:
-        arcpy.AddMessage("Calculating Drainage Area...")
-        filledDEM = arcpy.sa.Fill(dem)
-        flowDirection = arcpy.sa.FlowDirection(filledDEM)
-        flowAccumulation = arcpy.sa.FlowAccumulation(flowDirection)
-    cellSizeX = arcpy.GetRasterProperties_management(flowAccumulation, "CELLSIZEX")
-    cellSizeY = arcpy.GetRasterProperties_management(flowAccumulation, "CELLSIZEY")
-    cellSize = float(cellSizeX.getOutput(0)) * float(cellSizeY.getOutput(0))
-    arcpy.SetProgressor("step", "Creating Reach 1 out of " + numReachesString, 0, numReaches, 1)
-
-    arcpy.AddMessage("Creating Reach Array...")
-    polylineCursor = arcpy.da.SearchCursor(streamNetwork, ['SHAPE@'])
-
-    """If testing, only go through the loop once. Otherwise, go through every reach"""
-    if testing:
-        numTests = 500
-        slopeTime = 0.0
-        precipTime = 0.0
-        flowAccTime = 0.0
-        variableTime = 0.0
-        wrapUpTime = 0.0
-        start = timer()
-        for i in range(numTests):
-            arcpy.AddMessage("Creating Reach " + str(i + 1) + " out of " + str(numTests))
-            row = polylineCursor.next()
-
-            arcpy.AddMessage("Calculating Slope...")
-            tempStart = timer()
-            lastPointElevation = findElevationAtPoint(dem, row[0].lastPoint, tempData)
-            firstPointElevation = findElevationAtPoint(dem, row[0].firstPoint, tempData)
-            tempEnd = timer()
-            slopeTime += (tempEnd - tempStart)
-            arcpy.AddMessage("Time to calculate slope: " + str(tempEnd - tempStart) + " seconds")
-
-            arcpy.AddMessage("Calculating Precipitation...")
-            tempStart = timer()
-            precip = findPrecipitation(precipMap, tempData, row[0].lastPoint)
-            tempEnd = timer()
-            precipTime += (tempEnd - tempStart)
-            arcpy.AddMessage("Time to calculate precipitation: " + str(tempEnd - tempStart) + " seconds")
-
-            arcpy.AddMessage("Calculating Flow Accumulation...")
-            tempStart = timer()
-            flowAccAtPoint = findFlowAccumulation(flowAccumulation, tempData, cellSize)
-            tempEnd = timer()
-            flowAccTime += (tempEnd - tempStart)
-            arcpy.AddMessage("Time to calculate flow accumulation: " + str(tempEnd - tempStart) + " seconds")
-
-            arcpy.AddMessage("Finding Variables...")
-            tempStart = timer()
-            slope = findSlope(row, firstPointElevation, lastPointElevation)
-            width = findWidth(flowAccAtPoint, precip)
-            q_2 = findQ_2(flowAccAtPoint, firstPointElevation, precip, regionNumber, tempData)
-            tempEnd = timer()
-            variableTime += (tempEnd - tempStart)
-            arcpy.AddMessage("Time to calculate variables: " + str(tempEnd - tempStart) + " seconds")
-
-            tempStart = timer()
-            reach = Reach(width, q_2, slope, row[0])
-            reach.calculateGrainSize(nValue, t_cValue)
-
-            reaches.append(reach)
-            arcpy.AddMessage("Reach " + str(i + 1) + " complete.")
-            tempEnd = timer()
-            wrapUpTime += (tempEnd - tempStart)
-        end = timer()
-        totalTime = end - start
-
-        arcpy.AddMessage("Average time spent calculating slope: " + str(slopeTime / numTests) + " seconds")
-        arcpy.AddMessage("Average time spent calculating precipitation: " + str(precipTime / numTests) + " seconds")
-        arcpy.AddMessage("Average time spent calculating flow accumulation " + str(flowAccTime / numTests) + " seconds")
-        arcpy.AddMessage("Average time spent calculating variables: " + str(variableTime / numTests) + " seconds")
-        arcpy.AddMessage("Average time spent putting it together:" + str(wrapUpTime / numTests) + " seconds")
-        arcpy.AddMessage("Average time per reach: " + str(totalTime / numTests) + " seconds")
-    else:
-        i = 0
-        for row in polylineCursor:
-            lastPointElevation = findElevationAtPoint(dem, row[0].lastPoint, tempData)
-            firstPointElevation = findElevationAtPoint(dem, row[0].firstPoint, tempData)
-            precip = findPrecipitation(precipMap, tempData, row[0].lastPoint)
-            flowAccAtPoint = findFlowAccumulation(flowAccumulation, tempData, cellSize)
-
-            slope = findSlope(row, firstPointElevation, lastPointElevation)
-            width = findWidth(flowAccAtPoint, precip)
-            q_2 = findQ_2(flowAccAtPoint, firstPointElevation, precip, regionNumber, tempData)
-
-            reach = Reach(width, q_2, slope, row[0])
-            reach.calculateGrainSize(nValue, t_cValue)
+    return tempData, outputDataPath, clippedStreamNetwork, hydrologyCache, checkpointFolder
 
-            reaches.append(reach)
 
-            i += 1
-            arcpy.SetProgressorLabel("Creating Reach " + str(i) + " out of " + numReachesString)
-            arcpy.SetProgressorPosition()
-
-    del row
-    del polylineCursor
-
-    arcpy.AddMessage("Reach Array Created.")
-
-    return reaches
-
-
-def getMinJanTemp(tempData):
-    minJanTempMap = "C:\Users\A02150284\Documents\GIS Data\JanMinTemp\PRISM_tmin_30yr_normal_800mM2_01_asc.asc"
+def getMinJanTemp(tempData, minJanTempMap=DEFAULT_MIN_JAN_TEMP_MAP):
     pointLayer = tempData + "\pointJanTemp"
     arcpy.sa.ExtractValuesToPoints(tempData + "\point.shp", minJanTempMap, pointLayer)
     searchCursor = arcpy.da.SearchCursor(pointLayer + ".shp", "RASTERVALU")
@@ -224,57 +327,18 @@ def findQ_2(flowAccAtPoint, elevation, precip, regionNumber, tempData):
     :return: Q_2 (float)
     """
     """These equations are based on the USGS database. To find your region, go to the following website:
-    https://pubs.usgs.gov/fs/fs-016-01/ """
-    if regionNumber == 1:
-        q_2 = 0.35 * (flowAccAtPoint**0.923) * (precip ** 1.24)
-    elif regionNumber == 2:
-        q_2 = 0.09 * (flowAccAtPoint**0.877) * (precip ** 1.51)
-    elif regionNumber == 3:
-        q_2 = 0.817 * (flowAccAtPoint**0.877) * (precip ** 1.02)
-    elif regionNumber == 4:
-        q_2 = 0.025 * (flowAccAtPoint**0.880) * (precip ** 1.70)
-    elif regionNumber == 5:
-        q_2 = 14.7 * (flowAccAtPoint**0.815)
-    elif regionNumber == 6:
-        q_2 = 2.24 * (flowAccAtPoint**0.719) * (precip ** 0.833)
-    elif regionNumber == 7:
-        q_2 = 8.77 * (flowAccAtPoint**0.629)
-    elif regionNumber == 8:
-        q_2 = 12.0 * (flowAccAtPoint**0.761)
-    elif regionNumber == 9:
-        q_2 = 0.803 * (flowAccAtPoint**0.672) * (precip ** 1.16)
-    elif regionNumber == 12:
-        q_2 = 0.508 * (flowAccAtPoint ** 0.901) * ((elevation / 1000)**0.132) * (precip ** 0.926)
-    elif regionNumber == 13:
-        q_2 = 12.6 * (flowAccAtPoint ** 0.879) * ((elevation / 1000) ** -0.161)
-    elif regionNumber == 14:
-        q_2 = 9.49 * (flowAccAtPoint ** 0.903) * ((elevation / 1000)**0.055)
-    elif regionNumber == 15:
-        q_2 = 9.49 * (flowAccAtPoint ** 0.903) * ((elevation / 1000)**0.055)
-    elif regionNumber == 16:
-        q_2 = 0.000141 * (flowAccAtPoint ** 0.904) * (precip ** 3.25)
-    elif regionNumber == 100:
-        minJanTemp = getMinJanTemp(tempData)
-        q_2 = .00013 * (flowAccAtPoint**0.8) * (precip ** 1.24) * ((minJanTemp + 273) ** 2.53)
-    else:
+    https://pubs.usgs.gov/fs/fs-016-01/ 
+    The equations themselves are in Q2Regions.csv"""
+    q2Registry = getDefaultRegistry()
+    if regionNumber not in q2Registry:
         arcpy.AddError("Incorrect Q_2 value entered")
+        raise ValueError("There is no Q_2 equation for region " + str(regionNumber))
 
-    q_2 /= 35.3147  # converts from cubic feet to cubic meters
-
-    return q_2
-
+    minJanTemp = None
+    if q2Registry[regionNumber].needsTemperature:
+        minJanTemp = getMinJanTemp(tempData)
 
-def findWidth(flowAccAtPoint, precip):
-    """
-    Estimates the width of a reach, based on its drainage area and precipitation levels
-    :param flowAccAtPoint: A float with flow accumulation at a point
-    :param precip: A float with the precipitation at a point
-    :return: Estimated width
-    """
-    width = 0.177 * (flowAccAtPoint ** 0.397) * (precip ** 0.453)  # This is the equation we're using to estimate width
-    if width < .3:  # establishes a minimum width value
-        width = .3
-    return width
+    return q2Registry.evaluate(regionNumber, flowAccAtPoint, elevation, precip, minJanTemp)
 
 
 def findSlope(polyline, firstPointElevation, secondPointElevation):
@@ -359,12 +423,7 @@ def findElevationAtPoint(dem, point, tempData):
     
     Testing new feature
     """
-    sr = arcpy.Describe(dem).spatialReference
-    arcpy.env.workspace = tempData
-    arcpy.CreateFeatureclass_management(tempData, "point.shp", "POINT", "", "DISABLED", "DISABLED", sr)
-    cursor = arcpy.da.InsertCursor(tempData+"\point.shp", ["SHAPE@"])
-    cursor.insertRow([point])
-    del cursor
+    writePoint(point, tempData, arcpy.Describe(dem).spatialReference)
     pointLayer = tempData+"\pointElevation"
     arcpy.sa.ExtractValuesToPoints(tempData+"\point.shp", dem, pointLayer)
     searchCursor = arcpy.da.SearchCursor(pointLayer+".shp", "RASTERVALU")
@@ -377,45 +436,104 @@ def findElevationAtPoint(dem, point, tempData):
     # return float(arcpy.GetCellValue_management(dem, str(point.X) + " " + str(point.Y)).getOutput(0))
 
 
-def writeResults(reachArray, testing, outputData):
-    """This function is meant to save the results for future study"""
-    testOutput = open(outputData + "\Data(readable).txt", "w")
-    i = 0
-    for reach in reachArray:
-        i += 1
-        testOutput.write("Reach " + str(i) + ":")
-        testOutput.write("\nWidth: " + str(reach.width) + " meters")
-        testOutput.write("\nQ_2: " + str(reach.q_2) + " cubic meters per second")
-        testOutput.write("\nSlope: " + str(reach.slope))
-        testOutput.write("\nGrain Size: " + str(reach.grainSize) + "\n\n")
-    testOutput.close()
-
-    inputDataFile = open(outputData + "Data(for_reach_construction).txt", "w")
-    for reach in reachArray:
-        inputDataFile.write("\n" + str(reach.width))
-        inputDataFile.write("\n" + str(reach.q_2))
-        inputDataFile.write("\n" + str(reach.slope))
-        inputDataFile.write("\n" + str(reach.grainSize))
-    inputDataFile.close()
-
-
-def writeOutput(reachArray, outputDataPath, sr):
-    arcpy.env.workspace = outputDataPath
-    outputShape = outputDataPath + "\GrainSize.shp"
-    tempLayer = outputDataPath + "\GrainSize_lyr"
-    outputLayer = outputDataPath + "\GrainSize.lyr"
-    arcpy.CreateFeatureclass_management(outputDataPath, "GrainSize.shp", "POLYLINE", "", "DISABLED", "DISABLED")
-    arcpy.AddField_management(outputShape, "GrainSize", "DOUBLE")
-
-    insertCursor = arcpy.da.InsertCursor(outputShape, ["SHAPE@", "GrainSize"])
-    for reach in reachArray:
-        insertCursor.insertRow([reach.polyline, reach.grainSize])
-    del insertCursor
-
-    arcpy.DefineProjection_management(outputShape, sr)
-
-    arcpy.MakeFeatureLayer_management(outputShape, tempLayer)
-    arcpy.SaveToLayerFile_management(tempLayer, outputLayer)
+def writePoint(point, tempData, sr):
+    """
+    Writes a single point to point.shp in our temp folder, so that the geoprocessing tools can find values at it
+    :param point: The ArcPy Point we want to write
+    :param tempData: Where we can dump all our random data points
+    :param sr: The spatial reference of the point
+    :return: None
+    """
+    arcpy.env.workspace = tempData
+    arcpy.CreateFeatureclass_management(tempData, "point.shp", "POINT", "", "DISABLED", "DISABLED", sr)
+    cursor = arcpy.da.InsertCursor(tempData+"\\point.shp", ["SHAPE@"])
+    cursor.insertRow([point])
+    del cursor
+
+
+class ReachOutputWriter(object):
+    def __init__(self, outputDataPath, sr, testing=False, attributes=None):
+        """
+        Writes reaches to our output a batch at a time, as they're found:
+            GrainSize.gpkg, with every reach's geometry, grain size, width, Q_2, slope and drainage area
+            GrainSize.shp and GrainSize.lyr, with the same attributes, for ArcMap
+            GrainSizeResults.bin, a binary file of columns that loadReaches() reads straight back into a ReachTable
+            Data(readable).txt, if we're testing
+        :param outputDataPath: The folder to write to
+        :param sr: The spatial reference of the stream network
+        :param testing: Whether to write the readable text file too
+        :param attributes: An optional dictionary of values to keep with the results, like n and t_c
+        """
+        self.outputDataPath = outputDataPath
+        self.numReaches = 0
+        arcpy.env.workspace = outputDataPath
+        self.fileWriter = ReachFileWriter(outputDataPath, sr.factoryCode or None, sr.exportToString().split(";")[0],
+                                          attributes)
+
+        self.outputShape = outputDataPath + "\\GrainSize.shp"
+        arcpy.CreateFeatureclass_management(outputDataPath, "GrainSize.shp", "POLYLINE", "", "DISABLED", "DISABLED",
+                                            sr)
+        for name, fieldType in SHAPEFILE_FIELDS:
+            arcpy.AddField_management(self.outputShape, name, fieldType)
+        self.insertCursor = arcpy.da.InsertCursor(self.outputShape,
+                                                  ["SHAPE@"] + [name for name, fieldType in SHAPEFILE_FIELDS])
+        self.readableFile = open(outputDataPath + "\\Data(readable).txt", "w") if testing else None
+
+    def write(self, reaches):
+        """
+        Writes a batch of reaches to every output
+        :param reaches: A ReachTable with its polylines
+        :return: None
+        """
+        self.fileWriter.write(reaches)
+
+        """arcpy can't insert polylines in bulk, so the cursor is fed whole rows built from the columns"""
+        rows = zip(reaches.polylines, reaches.grainSize.tolist(), reaches.width.tolist(), reaches.q_2.tolist(),
+                   reaches.slope.tolist(), reaches.flowAccumulation.tolist(), reaches.featureIds.tolist())
+        for row in rows:
+            self.insertCursor.insertRow(row)
+
+        if self.readableFile is not None:
+            lines = []
+            columns = zip(reaches.width.tolist(), reaches.q_2.tolist(), reaches.slope.tolist(),
+                          reaches.grainSize.tolist())
+            for i, (width, q_2, slope, grainSize) in enumerate(columns):
+                lines.append("Reach " + str(self.numReaches + i + 1) + ":\nWidth: " + str(width) + " meters\nQ_2: " +
+                             str(q_2) + " cubic meters per second\nSlope: " + str(slope) + "\nGrain Size: " +
+                             str(grainSize) + "\n\n")
+            self.readableFile.write("".join(lines))
+        self.numReaches += len(reaches)
+
+    def close(self):
+        """Finishes every output, and makes the layer file for the shapefile"""
+        del self.insertCursor
+        if self.readableFile is not None:
+            self.readableFile.close()
+        self.fileWriter.close()
+
+        tempLayer = self.outputDataPath + "\\GrainSize_lyr"
+        arcpy.MakeFeatureLayer_management(self.outputShape, tempLayer)
+        arcpy.SaveToLayerFile_management(tempLayer, self.outputDataPath + "\\GrainSize.lyr")
+
+    def abort(self):
+        """Stops writing. The shapefile keeps whatever was written, but the other files are thrown away"""
+        del self.insertCursor
+        if self.readableFile is not None:
+            self.readableFile.close()
+        self.fileWriter.abort()
+
+
+def writeOutput(reachArray, outputDataPath, sr, testing=False, attributes=None):
+    """
+    Writes a whole ReachTable to our output in one go. See ReachOutputWriter
+    """
+    writer = ReachOutputWriter(outputDataPath, sr, testing, attributes)
+    try:
+        writer.write(reachArray)
+    except:
+        writer.abort()
+        raise
+    writer.close()
 
 
 if __name__ == '__main__':
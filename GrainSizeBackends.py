@@ -0,0 +1,269 @@
+########################################################################################################################
+# Name: Grain Size Backends
+# Purpose: Everything the grain size pipeline reads or reports goes through a backend, so the computation itself never
+# needs ArcGIS. The ArcGIS backend reads feature classes and rasters through arcpy and reports to the geoprocessing
+# messages, and only imports arcpy once one is made. The local backend reads GeoJSON vectors and ESRI ASCII grids (or
+# rasters saved by RasterSampler.save()) straight from disk and reports to standard output, so the tool can run on any
+# machine with NumPy.
+#
+# A backend has these methods:
+#   message(text), warning(text), error(text)
+#   setProgressor(label, numSteps), setProgressorLabel(label), stepProgressor()
+#   countFeatures(featureClass): how many features readPolylines() will give
+#   readPolylines(featureClass): a generator of (polyline, feature ID). Each polyline has firstPoint and lastPoint
+#       (with X and Y), length, WKB and extent (with XMin, YMin, XMax and YMax), like an arcpy Polyline
+#   featureExtent(featureClass): (xMin, yMin, xMax, yMax) of every feature
+#   spatialReference(featureClass): (EPSG code or None, well known text or None)
+#   readPolygons(featureClass, field): a list of polygons, each a list of rings of (x, y), and each one's field value
+#   openRaster(raster, extent, margin, maxMemory, tileCacheFolder): a RasterSampler or TiledRaster, like openRaster()
+#   readRaster(raster): the whole raster as a RasterSampler
+#   rasterCellArea(raster): the area of one cell
+#   arcgisDrainageRasters(dem): RasterSamplers of the "filledDEM", "flowDirection" and "flowAccumulation" found by the
+#       Spatial Analyst tools
+########################################################################################################################
+
+import json
+import struct
+import sys
+import numpy as np
+from GrainSizePrecip import readPolygons
+from GrainSizeRaster import RasterSampler
+from GrainSizeTiles import openRaster, openTiled, readAsciiGrid, readAsciiHeader, asciiGridGeometry
+
+_WKB_LINESTRING = 2
+_WKB_MULTILINESTRING = 5
+
+
+class ArcpyBackend(object):
+    def __init__(self):
+        """Reads inputs that ArcGIS can read, and reports to the geoprocessing messages"""
+        import arcpy
+        self.arcpy = arcpy
+
+    def message(self, text):
+        self.arcpy.AddMessage(text)
+
+    def warning(self, text):
+        self.arcpy.AddWarning(text)
+
+    def error(self, text):
+        self.arcpy.AddError(text)
+
+    def setProgressor(self, label, numSteps):
+        self.arcpy.SetProgressor("step", label, 0, numSteps, 1)
+
+    def setProgressorLabel(self, label):
+        self.arcpy.SetProgressorLabel(label)
+
+    def stepProgressor(self):
+        self.arcpy.SetProgressorPosition()
+
+    def countFeatures(self, featureClass):
+        return int(self.arcpy.GetCount_management(featureClass).getOutput(0))
+
+    def readPolylines(self, featureClass):
+        searchCursor = self.arcpy.da.SearchCursor(featureClass, ['SHAPE@', 'OID@'])
+        try:
+            for row in searchCursor:
+                yield row[0], row[1]
+        finally:
+            del searchCursor
+
+    def featureExtent(self, featureClass):
+        extent = self.arcpy.Describe(featureClass).extent
+        return extent.XMin, extent.YMin, extent.XMax, extent.YMax
+
+    def spatialReference(self, featureClass):
+        sr = self.arcpy.Describe(featureClass).spatialReference
+        return sr.factoryCode or None, sr.exportToString().split(";")[0]
+
+    def readPolygons(self, featureClass, field):
+        return readPolygons(featureClass, field)
+
+    def openRaster(self, raster, extent=None, margin=1, maxMemory=None, tileCacheFolder=None):
+        return openRaster(raster, extent, margin, maxMemory, tileCacheFolder)
+
+    def readRaster(self, raster):
+        return RasterSampler.fromRaster(raster)
+
+    def rasterCellArea(self, raster):
+        cellSizeX = self.arcpy.GetRasterProperties_management(raster, "CELLSIZEX")
+        cellSizeY = self.arcpy.GetRasterProperties_management(raster, "CELLSIZEY")
+        return float(cellSizeX.getOutput(0)) * float(cellSizeY.getOutput(0))
+
+    def arcgisDrainageRasters(self, dem):
+        self.arcpy.CheckOutExtension("Spatial")
+        filledDEM = self.arcpy.sa.Fill(dem)
+        flowDirection = self.arcpy.sa.FlowDirection(filledDEM)
+        flowAccumulation = self.arcpy.sa.FlowAccumulation(flowDirection)
+        return {"filledDEM": RasterSampler.fromRaster(filledDEM),
+                "flowDirection": RasterSampler.fromRaster(flowDirection),
+                "flowAccumulation": RasterSampler.fromRaster(flowAccumulation)}
+
+
+class Point(object):
+    def __init__(self, x, y):
+        self.X = x
+        self.Y = y
+
+
+class Extent(object):
+    def __init__(self, xMin, yMin, xMax, yMax):
+        self.XMin = xMin
+        self.YMin = yMin
+        self.XMax = xMax
+        self.YMax = yMax
+
+
+class Polyline(object):
+    def __init__(self, parts):
+        """
+        A polyline read without ArcGIS, with the parts of an arcpy Polyline that the pipeline uses
+        :param parts: A list of parts, each a list of at least two (x, y) vertices
+        """
+        self.parts = [np.array([vertex[:2] for vertex in part], dtype=np.float64) for part in parts]
+        self.firstPoint = Point(float(self.parts[0][0, 0]), float(self.parts[0][0, 1]))
+        self.lastPoint = Point(float(self.parts[-1][-1, 0]), float(self.parts[-1][-1, 1]))
+        self.length = float(sum(np.hypot(np.diff(part[:, 0]), np.diff(part[:, 1])).sum() for part in self.parts))
+        vertices = np.concatenate(self.parts)
+        self.extent = Extent(float(vertices[:, 0].min()), float(vertices[:, 1].min()), float(vertices[:, 0].max()),
+                             float(vertices[:, 1].max()))
+
+    @property
+    def WKB(self):
+        """The polyline as little endian well known binary, a LineString if it has one part"""
+        def lineString(part):
+            return struct.pack("<BII", 1, _WKB_LINESTRING, len(part)) + np.ascontiguousarray(part, "<f8").tobytes()
+        if len(self.parts) == 1:
+            return lineString(self.parts[0])
+        return struct.pack("<BII", 1, _WKB_MULTILINESTRING, len(self.parts)) + \
+            b"".join(lineString(part) for part in self.parts)
+
+
+class LocalBackend(object):
+    def __init__(self, report=None):
+        """
+        Reads inputs from local files without ArcGIS. Vectors are GeoJSON files, and rasters are ESRI ASCII grids (.asc)
+        or .npy files saved by RasterSampler.save(). A RasterSampler can also be given in place of any raster
+        :param report: A function that takes a line of text. Defaults to printing it
+        """
+        self.report = report
+        self._featureCollections = {}
+
+    def message(self, text):
+        if self.report is not None:
+            self.report(text)
+        else:
+            sys.stdout.write(text + "\n")
+
+    def warning(self, text):
+        self.message("Warning: " + text)
+
+    def error(self, text):
+        self.message("Error: " + text)
+
+    def setProgressor(self, label, numSteps):
+        return
+
+    def setProgressorLabel(self, label):
+        return
+
+    def stepProgressor(self):
+        return
+
+    def _features(self, featureClass):
+        """Reads a GeoJSON file once, keeping the features that have a geometry"""
+        featureClass = str(featureClass)
+        if featureClass not in self._featureCollections:
+            with open(featureClass) as geoJsonFile:
+                collection = json.load(geoJsonFile)
+            features = collection["features"] if collection.get("type") == "FeatureCollection" else [collection]
+            self._featureCollections[featureClass] = (collection, [(i, feature) for i, feature in enumerate(features)
+                                                                   if feature.get("geometry")])
+        return self._featureCollections[featureClass]
+
+    def countFeatures(self, featureClass):
+        return len(self._features(featureClass)[1])
+
+    def readPolylines(self, featureClass):
+        for i, feature in self._features(featureClass)[1]:
+            geometry = feature["geometry"]
+            if geometry["type"] == "LineString":
+                parts = [geometry["coordinates"]]
+            elif geometry["type"] == "MultiLineString":
+                parts = geometry["coordinates"]
+            else:
+                raise ValueError(str(featureClass) + " has a " + geometry["type"] + ", but the stream network must "
+                                 "be lines")
+            featureId = feature.get("id")
+            yield Polyline(parts), featureId if isinstance(featureId, int) else i
+
+    def featureExtent(self, featureClass):
+        xMin, yMin, xMax, yMax = np.inf, np.inf, -np.inf, -np.inf
+        for polyline, featureId in self.readPolylines(featureClass):
+            extent = polyline.extent
+            xMin, yMin = min(xMin, extent.XMin), min(yMin, extent.YMin)
+            xMax, yMax = max(xMax, extent.XMax), max(yMax, extent.YMax)
+        return xMin, yMin, xMax, yMax
+
+    def spatialReference(self, featureClass):
+        """Only the old GeoJSON "crs" member can say which projection a file is in"""
+        crs = self._features(featureClass)[0].get("crs") or {}
+        name = str((crs.get("properties") or {}).get("name", ""))
+        code = name.rsplit(":", 1)[-1]
+        return (int(code), None) if "EPSG" in name.upper() and code.isdigit() else (None, None)
+
+    def readPolygons(self, featureClass, field):
+        polygons = []
+        values = []
+        for i, feature in self._features(featureClass)[1]:
+            geometry = feature["geometry"]
+            if geometry["type"] == "Polygon":
+                rings = geometry["coordinates"]
+            elif geometry["type"] == "MultiPolygon":
+                rings = [ring for polygon in geometry["coordinates"] for ring in polygon]  # holes are just more rings
+            else:
+                raise ValueError(str(featureClass) + " has a " + geometry["type"] + ", but it must be polygons")
+            polygons.append([[tuple(vertex[:2]) for vertex in ring] for ring in rings])
+            values.append((feature.get("properties") or {}).get(field))
+        return polygons, values
+
+    def openRaster(self, raster, extent=None, margin=1, maxMemory=None, tileCacheFolder=None):
+        if isinstance(raster, RasterSampler):
+            return raster
+        raster = str(raster)
+        if raster.lower().endswith(".npy"):
+            sampler = RasterSampler.load(raster)  # memory mapped, so only the cells we sample are read
+            return sampler.window(extent, margin) if extent is not None else sampler
+        if maxMemory is not None and tileCacheFolder is not None:
+            with open(raster) as asciiFile:
+                numRows, numCols = asciiGridGeometry(readAsciiHeader(asciiFile))[:2]
+            if numRows * numCols * 4 > maxMemory:
+                return openTiled(raster, tileCacheFolder, maxMemory)
+        return readAsciiGrid(raster, extent, margin)
+
+    def readRaster(self, raster):
+        return self.openRaster(raster)
+
+    def rasterCellArea(self, raster):
+        if isinstance(raster, RasterSampler):
+            return raster.cellSize
+        raster = str(raster)
+        if raster.lower().endswith(".npy"):
+            with open(raster + ".json") as metadataFile:
+                metadata = json.load(metadataFile)
+            return metadata["cellWidth"] * metadata["cellHeight"]
+        with open(raster) as asciiFile:
+            cellSize = asciiGridGeometry(readAsciiHeader(asciiFile))[4]
+        return cellSize * cellSize
+
+    def arcgisDrainageRasters(self, dem):
+        raise ValueError("The ArcGIS hydrology engine needs ArcGIS. Use the Native engine instead")
+
+
+def getBackend(backend=None):
+    """
+    :param backend: A backend, or None
+    :return: The backend, or an ArcpyBackend if it was None
+    """
+    return ArcpyBackend() if backend is None else backend
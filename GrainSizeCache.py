@@ -0,0 +1,207 @@
+########################################################################################################################
+# Name: Grain Size Hydrology Cache
+# Purpose: Keeps the rasters we derive from a DEM (filled DEM, flow direction and flow accumulation) on disk between
+# runs. Each set of rasters is stored under a hash of the DEM's contents and the parameters used to derive them, as
+# .npy files that can be memory mapped, so rerunning the tool on the same basin skips the hydrology entirely, even from
+# a copy of the DEM somewhere else or from another machine sharing the cache folder. So that a rerun doesn't have to
+# read the whole DEM just to hash it, we also remember which contents hash we found for a file with a given path, size
+# and modification time. That stamp only ever saves us hashing the DEM again: files that changed too recently for their
+# modification time to be trusted are always hashed. The cache is kept under a size limit by throwing out whatever was
+# used least recently.
+########################################################################################################################
+
+import hashlib
+import json
+import os
+import shutil
+import time
+import numpy as np
+from GrainSizeRaster import RasterSampler
+
+CACHE_VERSION = 3
+STAMP_SETTLE_SECONDS = 10.0  # how long ago a file must have changed for its stamp to be trusted
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3  # 10 GB
+_ROWS_PER_HASH_CHUNK = 1024
+
+
+class HydrologyCache(object):
+    def __init__(self, cacheFolder, maxBytes=DEFAULT_MAX_BYTES):
+        """
+        :param cacheFolder: Where we keep the cached rasters. It can be shared between runs and output folders
+        :param maxBytes: How large the cache may grow before we start throwing out old entries
+        """
+        self.cacheFolder = cacheFolder
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(cacheFolder):
+            os.makedirs(cacheFolder)
+
+    @staticmethod
+    def makeKey(demSampler, parameters=None):
+        """
+        Hashes a DEM and the parameters used to process it
+        :param demSampler: A RasterSampler of the whole DEM
+        :param parameters: A dictionary of anything else that changes the derived rasters
+        :return: A hex string that identifies the DEM and parameters
+        """
+        keyHash = hashlib.sha1()
+        description = {"version": CACHE_VERSION,
+                       "shape": list(demSampler.array.shape),
+                       "dtype": str(demSampler.array.dtype),
+                       "xMin": demSampler.xMin, "yMax": demSampler.yMax,
+                       "cellWidth": demSampler.cellWidth, "cellHeight": demSampler.cellHeight,
+                       "noData": None if demSampler.noData is None else float(demSampler.noData),
+                       "parameters": parameters or {}}
+        keyHash.update(json.dumps(description, sort_keys=True).encode("utf-8"))
+
+        """We hash a block of rows at a time, so we never make a copy of the whole DEM"""
+        for firstRow in range(0, demSampler.numRows, _ROWS_PER_HASH_CHUNK):
+            keyHash.update(np.ascontiguousarray(demSampler.array[firstRow:firstRow + _ROWS_PER_HASH_CHUNK]).tobytes())
+        return keyHash.hexdigest()
+
+    @staticmethod
+    def makeStamp(raster, parameters=None, now=None):
+        """
+        Hashes where a DEM is stored and when it last changed, so findKey() can tell us the key of a DEM we've hashed
+        before without reading it. Rasters stored as folders, like ESRI grids, are stamped by every file in the folder,
+        and rasters in a geodatabase by the geodatabase folder
+        :param raster: The path to a DEM
+        :param parameters: A dictionary of anything else that changes the derived rasters
+        :param now: The current time. Defaults to time.time()
+        :return: A hex string that identifies the DEM file and parameters, or None if the DEM isn't a file we can stamp,
+        or it changed so recently that a rewrite might not change its modification time
+        """
+        source = str(raster)
+        if not os.path.exists(source) and os.path.isdir(os.path.dirname(source)):
+            source = os.path.dirname(source)
+        if not os.path.exists(source):
+            return None
+        if os.path.isdir(source):
+            stamps = []
+            for folder, subfolders, fileNames in os.walk(source):
+                for fileName in fileNames:
+                    filePath = os.path.join(folder, fileName)
+                    stamps.append((os.path.getmtime(filePath), os.path.getsize(filePath)))
+            lastModified = max([mtime for mtime, size in stamps] or [os.path.getmtime(source)])
+            size = sum(size for mtime, size in stamps)
+        else:
+            lastModified = os.path.getmtime(source)
+            size = os.path.getsize(source)
+        if (time.time() if now is None else now) - lastModified < STAMP_SETTLE_SECONDS:
+            return None
+        description = {"version": CACHE_VERSION,
+                       "path": os.path.abspath(str(raster)),
+                       "modified": repr(lastModified),
+                       "size": size,
+                       "parameters": parameters or {}}
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _entryFolder(self, key):
+        return os.path.join(self.cacheFolder, key)
+
+    def _stampFile(self, stamp):
+        return os.path.join(self.cacheFolder, "stamps", stamp + ".json")
+
+    def findKey(self, stamp):
+        """
+        :param stamp: The stamp from makeStamp()
+        :return: The key from makeKey() we found the last time we hashed the DEM with this stamp, or None if we haven't
+        """
+        try:
+            with open(self._stampFile(stamp)) as stampFile:
+                return json.load(stampFile)["key"]
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def rememberKey(self, stamp, key):
+        """
+        Remembers the contents hash of a DEM file, so findKey() can skip hashing it next time
+        :param stamp: The stamp from makeStamp()
+        :param key: The key from makeKey()
+        """
+        stampFolder = os.path.dirname(self._stampFile(stamp))
+        if not os.path.exists(stampFolder):
+            os.makedirs(stampFolder)
+        with open(self._stampFile(stamp), "w") as stampFile:
+            json.dump({"key": key}, stampFile)
+
+    def get(self, key, names):
+        """
+        Finds a set of cached rasters
+        :param key: The key from makeKey()
+        :param names: The names of every raster we need
+        :return: A dictionary of memory mapped RasterSamplers, or None if any of them isn't cached
+        """
+        entryFolder = self._entryFolder(key)
+        completeFile = os.path.join(entryFolder, "complete.json")
+        if not os.path.exists(completeFile) or \
+                not all(os.path.exists(os.path.join(entryFolder, name + ".npy")) for name in names):
+            self.misses += 1
+            return None
+
+        os.utime(completeFile, None)  # marks the entry as recently used
+        self.hits += 1
+        return self._load(key, names)
+
+    def _load(self, key, names):
+        entryFolder = self._entryFolder(key)
+        return dict((name, RasterSampler.load(os.path.join(entryFolder, name + ".npy"))) for name in names)
+
+    def put(self, key, rasters):
+        """
+        Stores a set of rasters, then trims the cache back under its size limit
+        :param key: The key from makeKey()
+        :param rasters: A dictionary of name to RasterSampler
+        :return: A dictionary of the same rasters memory mapped from the cache, so the ones given can be let go of
+        """
+        entryFolder = self._entryFolder(key)
+        if not os.path.exists(entryFolder):
+            os.makedirs(entryFolder)
+        for name, sampler in rasters.items():
+            sampler.save(os.path.join(entryFolder, name + ".npy"))
+
+        """This file is written last, so an entry that was interrupted halfway never looks complete"""
+        with open(os.path.join(entryFolder, "complete.json"), "w") as completeFile:
+            json.dump({"created": time.time(), "rasters": sorted(rasters)}, completeFile)
+
+        self.evict(keep=key)
+        return self._load(key, sorted(rasters))
+
+    def entries(self):
+        """
+        Lists every complete entry in the cache
+        :return: A list of (last used time, size in bytes, key), oldest first
+        """
+        entries = []
+        for key in os.listdir(self.cacheFolder):
+            entryFolder = self._entryFolder(key)
+            completeFile = os.path.join(entryFolder, "complete.json")
+            if not os.path.isdir(entryFolder) or not os.path.exists(completeFile):
+                continue
+            size = sum(os.path.getsize(os.path.join(entryFolder, fileName)) for fileName in os.listdir(entryFolder))
+            entries.append((os.path.getmtime(completeFile), size, key))
+        entries.sort()
+        return entries
+
+    def evict(self, keep=None):
+        """
+        Deletes the least recently used entries until the cache fits in its size limit
+        :param keep: A key that should not be deleted, like the one we just stored
+        :return: A list of the keys that were deleted
+        """
+        entries = self.entries()
+        totalSize = sum(size for lastUsed, size, key in entries)
+        evicted = []
+        for lastUsed, size, key in entries:
+            if totalSize <= self.maxBytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entryFolder(key), ignore_errors=True)
+            totalSize -= size
+            evicted.append(key)
+        return evicted
+
+    def summary(self):
+        return "Hydrology cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses"
@@ -0,0 +1,96 @@
+########################################################################################################################
+# Name: Grain Size Calibration
+# Purpose: Tries many values of n and t_c on a stream network whose width, Q_2 and slope have already been found. The
+# grain size equation is a power law of those variables, so every (n, t_c) pair costs only a few multiplications per
+# reach, and the whole grid comes out as one array. Given grain sizes measured in the field, we can also find the t_c
+# that fits them best.
+########################################################################################################################
+
+import numpy as np
+from GrainSizeReach import calculateT_cs
+
+
+def sweepGrainSizes(reaches, nValues, t_cValues, out=None):
+    """
+    Finds the grain size of every reach for every pair of n and t_c. The operations are done in the same order as
+    calculateGrainSizes(), so each value matches what a full run with that pair would give
+    :param reaches: A ReachTable with widths, Q_2s and slopes
+    :param nValues: The Manning coefficients to try
+    :param t_cValues: The Shields critical values to try
+    :param out: An optional array of shape (len(nValues), len(t_cValues), len(reaches)) to write into, like a memory
+    mapped .npy file for grids too big for memory
+    :return: An array where [i, j, k] is the grain size of reach k with nValues[i] and t_cValues[j], in millimeters
+    """
+    nValues = np.asarray(nValues, dtype=np.float64).ravel()
+    t_cValues = np.asarray(t_cValues, dtype=np.float64).ravel()
+    if out is None:
+        out = np.empty((len(nValues), len(t_cValues), len(reaches)))
+
+    """The parts of the equation that don't depend on n or t_c are only raised to their powers once"""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        q_2Term = reaches.q_2 ** .6
+        widthTerm = reaches.width ** -.6
+        slopeTerm = reaches.slope ** .7
+        for i, n in enumerate(nValues):
+            nTerm = (n ** .6) * q_2Term * widthTerm * slopeTerm
+            for j, t_c in enumerate(t_cValues):
+                grainSize = nTerm / t_c
+                grainSize /= 1.65
+                grainSize *= 1000  # converts to millimeters
+                out[i, j] = grainSize
+    return out
+
+
+def fitT_c(reaches, n, observedGrainSizes):
+    """
+    Finds the t_c of each reach that has a measured grain size, and the single t_c that fits all of them best. Grain
+    size is inversely proportional to t_c, so the best fit in log space is the geometric mean of the reaches' t_cs
+    :param reaches: A ReachTable with widths, Q_2s and slopes
+    :param n: Our Manning coefficient
+    :param observedGrainSizes: An array with the measured grain size of each reach, in millimeters. NaN or anything
+    not above 0 means the reach wasn't measured
+    :return: An array with the t_c of each reach (NaN where it wasn't measured or can't be found), and the fitted t_c
+    (NaN if no reach could be used)
+    """
+    observedGrainSizes = np.asarray(observedGrainSizes, dtype=np.float64)
+    t_cs = np.full(len(reaches), np.nan)
+    with np.errstate(invalid="ignore"):
+        measured = np.isfinite(observedGrainSizes) & (observedGrainSizes > 0)
+    t_cs[measured] = calculateT_cs(n, reaches.q_2[measured], reaches.width[measured], reaches.slope[measured],
+                                   observedGrainSizes[measured])
+    with np.errstate(invalid="ignore"):
+        usable = np.isfinite(t_cs) & (t_cs > 0)
+    if not usable.any():
+        return t_cs, np.nan
+    return t_cs, float(np.exp(np.mean(np.log(t_cs[usable]))))
+
+
+def sweepErrors(reaches, nValues, t_cValues, observedGrainSizes):
+    """
+    Measures how well each pair of n and t_c predicts the grain sizes measured in the field
+    :param reaches: A ReachTable with widths, Q_2s and slopes
+    :param nValues: The Manning coefficients to try
+    :param t_cValues: The Shields critical values to try
+    :param observedGrainSizes: An array with the measured grain size of each reach. NaN or anything not above 0 means
+    the reach wasn't measured
+    :return: An array where [i, j] is the root mean square error of log10(predicted / measured) with nValues[i] and
+    t_cValues[j], and the number of reaches it was measured over
+    """
+    observedGrainSizes = np.asarray(observedGrainSizes, dtype=np.float64)
+    with np.errstate(invalid="ignore"):
+        measured = np.isfinite(observedGrainSizes) & (observedGrainSizes > 0)
+    measuredReaches = _subset(reaches, measured)
+    predicted = sweepGrainSizes(measuredReaches, nValues, t_cValues)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        logErrors = np.log10(predicted / observedGrainSizes[measured])
+    usable = np.isfinite(logErrors).all(axis=(0, 1))
+    numUsed = int(np.count_nonzero(usable))
+    if numUsed == 0:
+        return np.full(predicted.shape[:2], np.nan), 0
+    return np.sqrt(np.mean(logErrors[:, :, usable] ** 2, axis=2)), numUsed
+
+
+def _subset(reaches, mask):
+    """Makes a ReachTable of just some of the reaches"""
+    return type(reaches)(reaches.width[mask], reaches.q_2[mask], reaches.slope[mask],
+                         featureIds=reaches.featureIds[mask])
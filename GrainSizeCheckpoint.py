@@ -0,0 +1,200 @@
+########################################################################################################################
+# Name: Grain Size Checkpoint
+# Purpose: Saves the variables of each reach to disk as soon as they are found, so a run that stops partway can pick up
+# where it left off. Reaches are identified by their feature ID and a hash of their geometry, so after the stream
+# network is edited only the reaches that were added or changed have to be found again. The store also remembers a key
+# for the inputs it was made with (DEM, precipitation, Q_2 equation, and so on), and is thrown out if they change.
+########################################################################################################################
+
+import glob
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+CHECKPOINT_VERSION = 2  # 2 samples drainage area around the point itself, rather than the center of its cell
+DEFAULT_CHECKPOINT_INTERVAL = 10000  # how many reaches we find between checkpoints
+_HASH_DTYPE = "S20"  # a SHA-1 digest
+
+
+def fileStamp(path):
+    """
+    Describes a file by its path, size and modification time, so we notice when it's replaced. Feature classes and
+    rasters in a geodatabase are stamped by the geodatabase folder
+    :param path: The path to a file
+    :return: A string
+    """
+    path = str(path)
+    source = path
+    if not os.path.exists(source) and os.path.exists(os.path.dirname(source)):
+        source = os.path.dirname(source)
+    if not os.path.exists(source):
+        return path
+    return os.path.abspath(path) + "|" + repr(os.path.getmtime(source)) + "|" + str(os.path.getsize(source))
+
+
+def makeInputsKey(inputs):
+    """
+    Hashes everything that changes the variables of a reach, other than the reach itself
+    :param inputs: A dictionary of name to value. Files should be given as their fileStamp()
+    :return: A hex string
+    """
+    description = {"version": CHECKPOINT_VERSION, "inputs": inputs}
+    return hashlib.sha1(json.dumps(description, sort_keys=True, default=repr).encode("utf-8")).hexdigest()
+
+
+def hashGeometries(polylines):
+    """
+    Hashes the geometry of every reach, so we can tell when a reach has been edited
+    :param polylines: A list of ArcPy Polylines
+    :return: An array of SHA-1 digests
+    """
+    return np.array([hashlib.sha1(bytes(polyline.WKB)).digest() for polyline in polylines], dtype=_HASH_DTYPE)
+
+
+class ReachCheckpoint(object):
+    def __init__(self, folder, inputsKey):
+        """
+        Opens a checkpoint store. If it was made with different inputs, everything in it is thrown out
+        :param folder: Where we keep the checkpoint files
+        :param inputsKey: The key from makeInputsKey() for this run
+        """
+        self.folder = folder
+        self.inputsKey = inputsKey
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        manifestPath = os.path.join(folder, "manifest.json")
+        manifest = None
+        if os.path.exists(manifestPath):
+            with open(manifestPath) as manifestFile:
+                manifest = json.load(manifestFile)
+        if manifest is None or manifest.get("version") != CHECKPOINT_VERSION or manifest.get("inputsKey") != inputsKey:
+            for partPath in self._partPaths():
+                os.remove(partPath)
+            with open(manifestPath, "w") as manifestFile:
+                json.dump({"version": CHECKPOINT_VERSION, "inputsKey": inputsKey, "created": time.time()},
+                          manifestFile)
+        partNumbers = [int(os.path.basename(partPath)[len("part_"):-len(".npz")]) for partPath in self._partPaths()]
+        self._nextPart = max(partNumbers) if partNumbers else 0  # later parts win, so numbers only ever go up
+
+    def _partPaths(self):
+        return sorted(glob.glob(os.path.join(self.folder, "part_*.npz")))
+
+    def append(self, featureIds, geometryHashes, columns):
+        """
+        Saves the variables of a batch of reaches. Each batch goes in its own file, which only shows up once it's
+        completely written
+        :param featureIds: An array with the feature ID of each reach
+        :param geometryHashes: An array with the geometry hash of each reach
+        :param columns: A dictionary of name to an array with one value per reach
+        :return: None
+        """
+        if len(featureIds) == 0:
+            return
+        self._nextPart += 1
+        partPath = os.path.join(self.folder, "part_%06d.npz" % self._nextPart)
+        partialPath = partPath + "." + str(os.getpid()) + ".partial"
+        with open(partialPath, "wb") as partFile:
+            np.savez(partFile, featureIds=np.asarray(featureIds, dtype=np.int64),
+                     geometryHashes=np.asarray(geometryHashes, dtype=_HASH_DTYPE),
+                     **dict(("column_" + name, values) for name, values in columns.items()))
+        if os.path.exists(partPath):
+            os.remove(partPath)
+        os.rename(partialPath, partPath)
+
+    def _loadAll(self):
+        """Loads every saved batch. A reach saved more than once keeps its latest values"""
+        featureIds, geometryHashes, columns = [], [], {}
+        for partPath in self._partPaths():
+            try:
+                part = np.load(partPath)
+                try:
+                    names = [name for name in part.files if name.startswith("column_")]
+                    partColumns = dict((name[len("column_"):], part[name]) for name in names)
+                    partIds, partHashes = part["featureIds"], part["geometryHashes"]
+                finally:
+                    part.close()  # so the file can be deleted on Windows
+            except (IOError, ValueError, KeyError):
+                continue  # a damaged file just means those reaches get found again
+            featureIds.append(partIds)
+            geometryHashes.append(partHashes)
+            for name, values in partColumns.items():
+                columns.setdefault(name, []).append(values)
+        if not featureIds:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=_HASH_DTYPE), {}
+        numRows = sum(len(ids) for ids in featureIds)
+        columns = dict((name, np.concatenate(values)) for name, values in columns.items()
+                       if sum(len(v) for v in values) == numRows)
+        return np.concatenate(featureIds), np.concatenate(geometryHashes), columns
+
+    def loadIndex(self):
+        """
+        Loads every saved reach once, so many batches of reaches can be looked up without reading the files again
+        :return: A CheckpointIndex
+        """
+        return CheckpointIndex(*self._loadAll())
+
+    def lookup(self, featureIds, geometryHashes, names):
+        """
+        Finds which reaches already have saved variables. See CheckpointIndex.lookup()
+        """
+        return self.loadIndex().lookup(featureIds, geometryHashes, names)
+
+    def compact(self, featureIds, geometryHashes, columns):
+        """
+        Replaces every saved batch with one file that holds just the reaches of the current network
+        :return: None
+        """
+        oldParts = self._partPaths()
+        self.append(featureIds, geometryHashes, columns)
+        newParts = set(self._partPaths()) - set(oldParts)
+        for partPath in oldParts:
+            if partPath not in newParts:
+                os.remove(partPath)
+
+
+class CheckpointIndex(object):
+    def __init__(self, featureIds, geometryHashes, columns):
+        """
+        The saved reaches, sorted by feature ID so a batch of reaches can be found with a binary search. A reach saved
+        more than once keeps only its latest values
+        :param featureIds: An array with the feature ID of each saved reach, oldest first
+        :param geometryHashes: An array with the geometry hash of each saved reach
+        :param columns: A dictionary of name to an array with one value per saved reach
+        """
+        order = np.argsort(featureIds, kind="mergesort")  # a stable sort keeps later saves after earlier ones
+        sortedIds = featureIds[order]
+        latest = np.ones(len(sortedIds), dtype=bool)
+        latest[:-1] = sortedIds[1:] != sortedIds[:-1]
+        order = order[latest]
+        self.featureIds = featureIds[order]
+        self.geometryHashes = geometryHashes[order]
+        self.columns = dict((name, values[order]) for name, values in columns.items())
+
+    def __len__(self):
+        return len(self.featureIds)
+
+    def lookup(self, featureIds, geometryHashes, names):
+        """
+        Finds which reaches already have saved variables
+        :param featureIds: An array with the feature ID of each reach
+        :param geometryHashes: An array with the geometry hash of each reach
+        :param names: The columns we need. A reach only counts as saved if every one of them is
+        :return: A boolean array of the reaches that were found, and a dictionary of name to array with their values.
+        Reaches that weren't found are NaN
+        """
+        featureIds = np.asarray(featureIds, dtype=np.int64)
+        numReaches = len(featureIds)
+        found = np.zeros(numReaches, dtype=bool)
+        columns = dict((name, np.full(numReaches, np.nan)) for name in names)
+        if len(self) == 0 or numReaches == 0 or not all(name in self.columns for name in names):
+            return found, columns
+
+        rows = np.minimum(np.searchsorted(self.featureIds, featureIds), len(self) - 1)
+        found = (self.featureIds[rows] == featureIds) & \
+            (self.geometryHashes[rows] == np.asarray(geometryHashes, dtype=_HASH_DTYPE))
+        for name in names:
+            columns[name][found] = self.columns[name][rows[found]]
+        return found, columns
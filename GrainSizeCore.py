@@ -0,0 +1,818 @@
+########################################################################################################################
+# Name: Grain Size Core
+# Purpose: The grain size pipeline itself, with nothing that needs ArcGIS. Every input is read and every message is
+# reported through a backend (see GrainSizeBackends), so the same code runs inside the ArcMap toolbox through arcpy, or
+# anywhere NumPy is installed straight from local files. Importing this module never imports arcpy. Run it as a script
+# to find the grain sizes of a stream network from the command line:
+#     python GrainSizeCore.py dem.asc streams.geojson precip.geojson outputFolder 0.035 0.045 1
+########################################################################################################################
+
+import argparse
+import os
+import numpy as np
+import GrainSizeHydrology
+import GrainSizeParallel
+from GrainSizeBackends import LocalBackend, getBackend
+from GrainSizeCache import HydrologyCache, DEFAULT_MAX_BYTES
+from GrainSizeCheckpoint import ReachCheckpoint, DEFAULT_CHECKPOINT_INTERVAL, fileStamp, hashGeometries, makeInputsKey
+from GrainSizeHydrology import ARCGIS_ENGINE, NATIVE_ENGINE
+from GrainSizeInstrumentation import Instrumentation
+from GrainSizeNetwork import SAMPLED_DRAINAGE, NETWORK_DRAINAGE, DEFAULT_SNAP_TOLERANCE, findNetworkDrainage
+from GrainSizeOutput import GeoPackageWriter, ResultsFileWriter
+from GrainSizePipeline import REACH_VARIABLES, ReachInputs, computeReachVariables, sampleDrainageAreas
+from GrainSizePrecip import PrecipitationIndex
+from GrainSizeQ2 import getDefaultRegistry
+from GrainSizeRaster import RasterSampler, NEAREST, pointExtent, pointFootprint, focalMaximum
+from GrainSizeReach import ReachTable
+from GrainSizeTiles import DEFAULT_MAX_MEMORY, TiledRaster
+from hashlib import sha1
+from itertools import islice
+from math import sqrt
+
+HYDROLOGY_RASTERS = ["filledDEM", "flowDirection", "flowAccumulation"]
+DEFAULT_BATCH_SIZE = 50000  # how many reaches are read, found and written at a time
+TEST_REACHES = 500  # how many reaches we go through when testing
+DEFAULT_MIN_JAN_TEMP_MAP = r"C:\Users\A02150284\Documents\GIS Data\JanMinTemp\PRISM_tmin_30yr_normal_800mM2_01_asc.asc"
+
+
+def run(dem,
+        flowAccumulation,
+        streamNetwork,
+        precipMap,
+        outputFolder,
+        nValue,
+        t_cValue,
+        regionNumber,
+        testing=False,
+        cacheFolder=None,
+        cacheSizeLimit=DEFAULT_MAX_BYTES,
+        hydrologyEngine=NATIVE_ENGINE,
+        maxRasterMemory=None,
+        numWorkers=1,
+        checkpointFolder=None,
+        profile=False,
+        batchSize=DEFAULT_BATCH_SIZE,
+        drainageMethod=SAMPLED_DRAINAGE,
+        backend=None):
+    """
+    Runs the tool without ArcGIS, writing GrainSizeResults.bin, GrainSize.gpkg and timings.json to the GrainSize folder
+    in outputFolder. The stream network isn't clipped, so clip it beforehand if needed
+    :param dem: The DEM, like an ESRI ASCII grid
+    :param flowAccumulation: A flow accumulation raster, or None to find one from the DEM
+    :param streamNetwork: The stream network, like a GeoJSON file of lines
+    :param precipMap: Polygons with precipitation data in their "Inches" property, like a GeoJSON file
+    :param hydrologyEngine: Which engine finds drainage area if we weren't given flow accumulation. Only "Native" works
+    without ArcGIS
+    :param backend: What reads the inputs and reports messages. Defaults to a LocalBackend
+    :return: How many reaches were written. The other parameters are the same as GrainSize.main()
+    """
+    if backend is None:
+        backend = LocalBackend()
+    if testing:
+        backend.message("Currently in TestMode")
+    tempData, outputDataPath, hydrologyCache, checkpointFolder = \
+        prepareFolders(outputFolder, flowAccumulation, cacheFolder, cacheSizeLimit, checkpointFolder)
+    instrumentation = makeInstrumentation(outputDataPath, profile, backend)
+
+    try:
+        srsId, srsWkt = backend.spatialReference(streamNetwork)
+        attributes = {"n": nValue, "t_c": t_cValue, "regionNumber": regionNumber}
+        writer = ReachFileWriter(outputDataPath, srsId, srsWkt, attributes)
+        try:
+            for reaches in streamReaches(testing, dem, flowAccumulation, streamNetwork, precipMap, regionNumber,
+                                         tempData, nValue, t_cValue, hydrologyCache=hydrologyCache,
+                                         hydrologyEngine=hydrologyEngine, maxRasterMemory=maxRasterMemory,
+                                         numWorkers=numWorkers, checkpointFolder=checkpointFolder,
+                                         instrumentation=instrumentation, batchSize=batchSize,
+                                         drainageMethod=drainageMethod, backend=backend):
+                with instrumentation.stage("output", len(reaches)):
+                    writer.write(reaches)
+        except:
+            writer.abort()
+            raise
+        with instrumentation.stage("output"):
+            writer.close()
+    finally:
+        instrumentation.finish(os.path.join(outputDataPath, "timings.json"))
+    return writer.numReaches
+
+
+def prepareFolders(outputFolder, flowAccumulation, cacheFolder=None, cacheSizeLimit=DEFAULT_MAX_BYTES,
+                   checkpointFolder=None):
+    """
+    Sets up the folders and caches that a run of the tool needs
+    :return: The temporary data folder, the output folder, the HydrologyCache (None if we were given flow
+    accumulation), and the checkpoint folder
+    """
+    """Creates the temporary data folder, where we'll put all our intermediate results"""
+    tempData = os.path.join(outputFolder, "temporaryData")
+    if not os.path.exists(tempData):
+        os.makedirs(tempData)
+
+    """Creates our output folder, where we'll put our final results"""
+    outputDataPath = os.path.join(outputFolder, "GrainSize")
+    if not os.path.exists(outputDataPath):
+        os.makedirs(outputDataPath)
+
+    """Sets up the cache for the drainage area rasters, which we only need if we weren't given flow accumulation"""
+    hydrologyCache = None
+    if flowAccumulation == None:
+        if cacheFolder == None:
+            cacheFolder = os.path.join(outputFolder, "hydrologyCache")
+        hydrologyCache = HydrologyCache(cacheFolder, cacheSizeLimit)
+
+    if checkpointFolder == None:
+        checkpointFolder = os.path.join(outputFolder, "checkpoint")
+
+    return tempData, outputDataPath, hydrologyCache, checkpointFolder
+
+
+def makeInstrumentation(outputDataPath, profile=False, backend=None):
+    """
+    Makes the Instrumentation for a run, which reports a summary of where the time went every minute
+    :param outputDataPath: Where the profile and trace go
+    :param profile: Whether to profile the run with cProfile and write a trace of every stage
+    :param backend: What the summaries are reported through. Defaults to the geoprocessing messages
+    :return: An Instrumentation
+    """
+    backend = getBackend(backend)
+    if profile:
+        return Instrumentation(report=backend.message, profilePath=os.path.join(outputDataPath, "profile.prof"),
+                               tracePath=os.path.join(outputDataPath, "trace.json"))
+    return Instrumentation(report=backend.message)
+
+
+def makeReaches(testing, dem, flowAccumulation, streamNetwork, precipMap, regionNumber, tempData, nValue, t_cValue,
+                elevationMethod=NEAREST, q2Registry=None, minJanTempMap=DEFAULT_MIN_JAN_TEMP_MAP, hydrologyCache=None,
+                hydrologyEngine=ARCGIS_ENGINE, maxRasterMemory=None, tileCacheFolder=None, numWorkers=1,
+                checkpointFolder=None, checkpointInterval=DEFAULT_CHECKPOINT_INTERVAL, instrumentation=None,
+                drainageMethod=SAMPLED_DRAINAGE, snapTolerance=DEFAULT_SNAP_TOLERANCE, backend=None):
+    """
+    Goes through every reach in the stream network, calculates its width and Q_2 value, and stores that data in a
+    ReachTable. Each step is done for every reach at once, rather than one reach at a time. This holds every reach in
+    memory, so it's meant for things that need all of them together, like a sweep. Use streamReaches() otherwise
+    :param testing: Bool, tells ushether or not we want to only do a small number of reaches for testing purposes.
+    :param streamNetwork: The path to a .shp file that contains our stream network
+    :param precipMap: The path to a .shp file that contains polygons that have precipitation data
+    :param regionNumber: What region we use to calculate our Q_2 value
+    :param tempData: Where we're going to put our temp data
+    :param nValue: Our Manning coefficient
+    :param t_cValue: Our Shields critical value
+    :return: A ReachTable of every reach, with a calculated Grain size for each. The other parameters are the same as
+    streamReaches()
+    """
+    batches = list(streamReaches(testing, dem, flowAccumulation, streamNetwork, precipMap, regionNumber, tempData,
+                                 nValue, t_cValue, elevationMethod, q2Registry, minJanTempMap, hydrologyCache,
+                                 hydrologyEngine, maxRasterMemory, tileCacheFolder, numWorkers, checkpointFolder,
+                                 checkpointInterval, instrumentation, batchSize=None, drainageMethod=drainageMethod,
+                                 snapTolerance=snapTolerance, backend=backend))
+    if not batches:
+        return ReachTable([], [], [], [])
+    return batches[0]
+
+
+def streamReaches(testing, dem, flowAccumulation, streamNetwork, precipMap, regionNumber, tempData, nValue, t_cValue,
+                  elevationMethod=NEAREST, q2Registry=None, minJanTempMap=DEFAULT_MIN_JAN_TEMP_MAP, hydrologyCache=None,
+                  hydrologyEngine=ARCGIS_ENGINE, maxRasterMemory=None, tileCacheFolder=None, numWorkers=1,
+                  checkpointFolder=None, checkpointInterval=DEFAULT_CHECKPOINT_INTERVAL, instrumentation=None,
+                  batchSize=DEFAULT_BATCH_SIZE, drainageMethod=SAMPLED_DRAINAGE, snapTolerance=DEFAULT_SNAP_TOLERANCE,
+                  regionIndex=None, backend=None):
+    """
+    Reads the stream network from its cursor a batch at a time, and finds the width, Q_2 and grain size of each batch.
+    Only one batch of polylines is in memory at once, so a batch can be written out before the next one is read
+    :param testing: Bool, tells ushether or not we want to only do a small number of reaches for testing purposes.
+    :param streamNetwork: The path to a .shp file that contains our stream network
+    :param precipMap: The path to a .shp file that contains polygons that have precipitation data
+    :param regionNumber: What region we use to calculate our Q_2 value
+    :param tempData: Where we're going to put our temp data
+    :param nValue: Our Manning coefficient
+    :param t_cValue: Our Shields critical value
+    :param elevationMethod: How we sample the DEM at the ends of each reach, either "nearest" or "bilinear"
+    :param q2Registry: The Q2Registry with our Q_2 equations. Defaults to the ones in Q2Regions.csv
+    :param minJanTempMap: A raster of minimum January temperatures, for regions whose Q_2 equation needs it
+    :param hydrologyCache: A HydrologyCache to reuse the drainage area rasters from earlier runs on the same DEM
+    :param hydrologyEngine: Which engine finds drainage area if we weren't given flow accumulation, "ArcGIS" or "Native"
+    :param maxRasterMemory: The most memory, in bytes, any one raster may take up. Rasters that are bigger are read a
+    tile at a time through a cache in tileCacheFolder. None reads every raster straight into memory if the reaches fit
+    in one batch, and tiles rasters bigger than the tile cache's default limit if they don't
+    :param tileCacheFolder: Where we keep the tiled copies of rasters. Defaults to a folder in tempData
+    :param numWorkers: How many processes to spread the reaches across. 1 does everything in this process, and less
+    than 1 means one per core. Results are the same whatever the number
+    :param checkpointFolder: Where we save each reach's variables as we go. Reaches already saved there by an earlier
+    run, with the same geometry and inputs, are reused rather than found again. None turns checkpoints off
+    :param checkpointInterval: How many reaches we find between checkpoints
+    :param instrumentation: The Instrumentation that times each stage. Defaults to one that reports through the
+    backend, with a full summary at the end if we're testing
+    :param batchSize: How many reaches to read at a time. None reads every reach in one batch
+    :param drainageMethod: "Sampled" samples drainage area and precipitation at the first point of each reach on its
+    own. "Network" snaps the ends of the reaches together and passes drainage area and area weighted precipitation down
+    the stream network, which means reading the ends of every reach once before the first batch
+    :param snapTolerance: How close, in map units, the ends of two reaches have to be to count as connected
+    :param regionIndex: An optional RegionIndex. If given, only the reaches whose first point is in one of its regions
+    are found, no chunk of reaches crosses a region, and each ReachTable has a regionIds array with the region of each
+    of its reaches
+    :param backend: What reads the inputs and reports progress. Defaults to an ArcpyBackend
+    :return: A generator of ReachTables, one per batch, in the order the cursor reads the reaches
+    """
+    backend = getBackend(backend)
+    ownInstrumentation = instrumentation is None
+    if ownInstrumentation:
+        instrumentation = Instrumentation(report=backend.message)
+    numReaches = backend.countFeatures(streamNetwork)
+    backend.message("Reaches to calculate: " + str(numReaches))
+
+    if q2Registry is None:
+        q2Registry = getDefaultRegistry()
+    if regionNumber not in q2Registry:
+        backend.error("Incorrect Q_2 value entered")
+        raise ValueError("There is no Q_2 equation for region " + str(regionNumber))
+    q2Equation = q2Registry[regionNumber]
+    if tileCacheFolder is None:
+        tileCacheFolder = os.path.join(tempData, "tileCache")
+    flowAccumulation, cellSize, flowAccumulationSource = findFlowAccumulationRaster(dem, flowAccumulation,
+                                                                                    hydrologyCache, hydrologyEngine,
+                                                                                    instrumentation, backend)
+
+    """If testing, only go through a small number of reaches. Otherwise, go through every reach"""
+    if testing:
+        numReaches = min(numReaches, TEST_REACHES)
+    if batchSize is None:
+        batchSize = max(numReaches, 1)
+    numBatches = max(-(-numReaches // batchSize), 1)
+
+    """With more than one batch, the rasters are opened for the whole stream network rather than just the reaches in
+    memory, so unless we were told otherwise, any raster too big for the tile cache's default limit is read a tile at a
+    time. That keeps our peak memory from growing with the size of the network"""
+    if maxRasterMemory is None and numBatches > 1:
+        maxRasterMemory = DEFAULT_MAX_MEMORY
+
+    """The network needs every reach at once, so its drainage areas are found before the first batch"""
+    inputs = None
+    network = None
+    networkKey = None
+    if drainageMethod == NETWORK_DRAINAGE:
+        with instrumentation.stage("network", numReaches):
+            network, networkKey, inputs = findReachNetwork(streamNetwork, numReaches, dem, flowAccumulation, cellSize,
+                                                           precipMap, q2Equation, minJanTempMap, elevationMethod,
+                                                           maxRasterMemory, tileCacheFolder, snapTolerance, backend)
+    elif drainageMethod != SAMPLED_DRAINAGE:
+        raise ValueError("Unknown drainage area method: " + str(drainageMethod))
+
+    """Loads the reaches that an earlier run with the same inputs already found"""
+    checkpoint = None
+    if checkpointFolder is not None:
+        with instrumentation.stage("checkpointLookup"):
+            checkpoint = openCheckpoint(checkpointFolder, dem, flowAccumulationSource, precipMap, q2Equation,
+                                        minJanTempMap, elevationMethod, networkKey)
+            checkpointIndex = checkpoint.loadIndex()
+    backend.message("Creating Reach Array...")
+    backend.setProgressor("Finding Grain Sizes...", numBatches)
+
+    numWorkers = GrainSizeParallel.findNumWorkers(numWorkers)
+    pool = None
+    missingElevations = 0
+    missingPrecips = 0
+    outsideRegions = 0
+    finished = False
+    polylineReader = backend.readPolylines(streamNetwork)
+    rows = islice(polylineReader, numReaches) if testing else polylineReader
+    batchNumber = 0
+    try:
+        while True:
+            batchNumber += 1
+            backend.setProgressorLabel("Finding Grain Sizes... (batch " + str(batchNumber) + " of " +
+                                       str(numBatches) + ")")
+            with instrumentation.stage("readReaches"):
+                batch = list(islice(rows, batchSize))
+                if not batch:
+                    break
+                polylines = [row[0] for row in batch]
+                featureIds = np.array([row[1] for row in batch], dtype=np.int64)
+                del batch
+                firstXs, firstYs, lastXs, lastYs = findEndPoints(polylines)
+                regionIds = None
+                if regionIndex is not None:
+                    regionIds = regionIndex.findRegions(firstXs, firstYs)
+                    kept = np.flatnonzero(regionIds >= 0)
+                    if len(kept) < len(polylines):
+                        outsideRegions += len(polylines) - len(kept)
+                        polylines = [polylines[i] for i in kept.tolist()]
+                        featureIds, regionIds = featureIds[kept], regionIds[kept]
+                        firstXs, firstYs, lastXs, lastYs = firstXs[kept], firstYs[kept], lastXs[kept], lastYs[kept]
+                batchReaches = len(polylines)
+                lengths = np.array([polyline.length for polyline in polylines], dtype=np.float64)
+            if batchReaches == 0:
+                backend.stepProgressor()
+                continue
+            flowAccumulations, precips = None, None
+            if network is not None:
+                flowAccumulations, precips = network.lookup(featureIds)
+
+            """Picks up the reaches in this batch that were already found, if their geometry hasn't changed"""
+            columns = dict((name, np.full(batchReaches, np.nan)) for name in REACH_VARIABLES)
+            remaining = np.arange(batchReaches)
+            if checkpoint is not None:
+                with instrumentation.stage("checkpointLookup", batchReaches):
+                    geometryHashes = hashGeometries(polylines)
+                    found, columns = checkpointIndex.lookup(featureIds, geometryHashes, REACH_VARIABLES)
+                    remaining = np.flatnonzero(~found)
+                    if len(remaining) < batchReaches:
+                        backend.message("Reusing " + str(batchReaches - len(remaining)) + " reaches from the last "
+                                        "run. " + str(len(remaining)) + " reaches in this batch left to calculate")
+
+            def saveChunk(indices, chunkColumns, chunkTimings, chunkReachSeconds):
+                """Puts a finished chunk of the remaining reaches into our columns, records its timings and how long
+                each of its reaches took, and checkpoints it"""
+                reachIndices = remaining[indices]
+                for name in REACH_VARIABLES:
+                    columns[name][reachIndices] = chunkColumns[name]
+                for name, seconds in chunkTimings.items():
+                    instrumentation.record(name, seconds, len(reachIndices), featureIds[reachIndices])
+                instrumentation.recordReaches(featureIds[reachIndices], chunkReachSeconds)
+                if checkpoint is not None:
+                    with instrumentation.stage("checkpoint", len(reachIndices)):
+                        checkpoint.append(featureIds[reachIndices], geometryHashes[reachIndices], chunkColumns)
+
+            if len(remaining) > 0 and inputs is None:
+                """Reads every raster and the precipitation polygons once, for just the area the reaches cover. If
+                we only have one batch, that's the area around its remaining reaches. Otherwise it's the extent of
+                the stream network, so we don't have to read every reach before we start"""
+                if numBatches == 1:
+                    extentXs, extentYs = np.concatenate((firstXs[remaining], lastXs[remaining])), \
+                        np.concatenate((firstYs[remaining], lastYs[remaining]))
+                else:
+                    xMin, yMin, xMax, yMax = backend.featureExtent(streamNetwork)
+                    extentXs = np.array([xMin, xMax])
+                    extentYs = np.array([yMin, yMax])
+                with instrumentation.stage("readInputs"):
+                    inputs = openReachInputs(dem, flowAccumulation, cellSize, precipMap, q2Equation, minJanTempMap,
+                                             extentXs, extentYs, extentXs, extentYs, elevationMethod,
+                                             maxRasterMemory, tileCacheFolder, backend=backend)
+            if len(remaining) > 0 and pool is None and numWorkers > 1:
+                pool = GrainSizeParallel.ReachPool(inputs, min(numWorkers, numReaches),
+                                                   os.path.join(tempData, "parallel"))
+
+            def part(values, indices):
+                return None if values is None else values[indices]
+
+            """Finds the slope, precipitation, drainage area, width and Q_2 of every remaining reach"""
+            if len(remaining) > 0 and pool is not None:
+                pool.compute(firstXs[remaining], firstYs[remaining], lastXs[remaining], lastYs[remaining],
+                             lengths[remaining], maxChunkSize=checkpointInterval if checkpoint else None,
+                             chunkDone=saveChunk, flowAccumulations=part(flowAccumulations, remaining),
+                             precips=part(precips, remaining), groups=part(regionIds, remaining))
+            elif len(remaining) > 0:
+                numChunks = -(-len(remaining) // checkpointInterval) if checkpoint is not None else 1
+                for chunk in GrainSizeParallel.partitionReaches(firstXs[remaining], firstYs[remaining], numChunks,
+                                                                part(regionIds, remaining)):
+                    reachIndices = remaining[chunk]
+                    chunkTimings = {}
+                    chunkReachSeconds = np.zeros(len(reachIndices))
+                    chunkColumns = computeReachVariables(inputs, firstXs[reachIndices], firstYs[reachIndices],
+                                                         lastXs[reachIndices], lastYs[reachIndices],
+                                                         lengths[reachIndices], chunkTimings,
+                                                         part(flowAccumulations, reachIndices),
+                                                         part(precips, reachIndices), chunkReachSeconds)
+                    saveChunk(chunk, chunkColumns, chunkTimings, chunkReachSeconds)
+
+            """With every reach in one batch, the checkpoint can be rewritten with just the reaches in the network"""
+            if checkpoint is not None and numBatches == 1 and len(remaining) > 0 and not testing:
+                with instrumentation.stage("checkpoint", batchReaches):
+                    checkpoint.compact(featureIds, geometryHashes, columns)
+
+            missingElevations += int(np.count_nonzero(np.isnan(columns["firstPointElevations"]) |
+                                                      np.isnan(columns["lastPointElevations"])))
+            missingPrecips += int(np.count_nonzero(np.isnan(columns["precips"])))
+
+            """Every reach's grain size in the batch is found at once, now that we know all their variables"""
+            with instrumentation.stage("reachTable", batchReaches):
+                reaches = ReachTable(columns["widths"], columns["q_2s"], columns["slopes"], polylines, featureIds)
+                reaches.calculateGrainSize(nValue, t_cValue)
+                reaches.flowAccumulation[:] = columns["flowAccumulations"]
+                if regionIds is not None:
+                    reaches.regionIds = regionIds
+            backend.stepProgressor()
+            yield reaches
+        finished = True
+    finally:
+        del rows
+        polylineReader.close()  # closes the cursor underneath it
+        if pool is not None:
+            if finished:
+                pool.close()
+            else:
+                pool.terminate()
+
+    if missingElevations > 0:
+        backend.warning(str(missingElevations) + " reaches have an end that is not covered by the DEM")
+    if missingPrecips > 0:
+        backend.warning(str(missingPrecips) + " reaches are not covered by the precipitation map")
+    if outsideRegions > 0:
+        backend.message(str(outsideRegions) + " reaches are outside every region, and were skipped")
+    if network is not None and network.numInLoops > 0:
+        backend.warning(str(network.numInLoops) + " reaches are in loops in the stream network, so their drainage "
+                        "area was sampled at their first point instead")
+    if ownInstrumentation and testing:
+        instrumentation.finish()
+
+    backend.message("Reach Array Created.")
+
+
+def findFlowAccumulationRaster(dem, flowAccumulation, hydrologyCache=None, hydrologyEngine=ARCGIS_ENGINE,
+                               instrumentation=None, backend=None):
+    """
+    Finds the flow accumulation raster to use, deriving it from the DEM if we weren't given one
+    :param dem: Path to the DEM
+    :param flowAccumulation: A flow accumulation raster, or None to find one from the DEM
+    :param hydrologyCache: A HydrologyCache to reuse the drainage area rasters from earlier runs on the same DEM
+    :param hydrologyEngine: Which engine finds drainage area, "ArcGIS" or "Native"
+    :param instrumentation: An optional Instrumentation to time the hydrology with
+    :param backend: What reads the rasters. Defaults to an ArcpyBackend
+    :return: The flow accumulation raster (or a RasterSampler of it), the area of each of its cells, and a description
+    of where it came from for the checkpoint
+    """
+    backend = getBackend(backend)
+    if instrumentation is None:
+        instrumentation = Instrumentation(enabled=False)
+    flowAccumulationSource = None
+    if flowAccumulation == None:
+        flowAccumulationSource = "derived from the DEM by " + hydrologyEngine
+        backend.message("Calculating Drainage Area...")
+        with instrumentation.stage("hydrology"):
+            flowAccumulation = findDrainageRasters(dem, hydrologyCache, hydrologyEngine, backend)["flowAccumulation"]
+    if isinstance(flowAccumulation, RasterSampler):
+        cellSize = flowAccumulation.cellSize
+        if flowAccumulationSource is None:
+            flowAccumulationSource = HydrologyCache.makeKey(flowAccumulation)
+    else:
+        flowAccumulationSource = fileStamp(flowAccumulation)
+        cellSize = backend.rasterCellArea(flowAccumulation)
+    return flowAccumulation, cellSize, flowAccumulationSource
+
+
+def openCheckpoint(checkpointFolder, dem, flowAccumulationSource, precipMap, q2Equation, minJanTempMap,
+                   elevationMethod, networkKey=None):
+    """
+    Opens the checkpoint for a run, keyed by everything besides the reaches themselves that changes their variables
+    :param networkKey: If drainage area is passed down the stream network, a hash of the network. Every reach's drainage
+    area depends on the reaches above it, so any change to the network starts the checkpoint over
+    :return: A ReachCheckpoint
+    """
+    temperatureStamp = fileStamp(minJanTempMap) if q2Equation.needsTemperature else None
+    key = {"dem": fileStamp(dem),
+           "flowAccumulation": flowAccumulationSource,
+           "precipMap": fileStamp(precipMap),
+           "q2Equation": sorted(vars(q2Equation).items()),
+           "minJanTempMap": temperatureStamp,
+           "elevationMethod": elevationMethod}
+    if networkKey is not None:
+        key["network"] = networkKey
+    return ReachCheckpoint(checkpointFolder, makeInputsKey(key))
+
+
+class ReachNetwork(object):
+    def __init__(self, featureIds, flowAccumulations, precips, numInLoops):
+        """
+        The drainage area and precipitation of every reach, found by following the stream network
+        :param featureIds: The feature ID of every reach
+        :param flowAccumulations: The drainage area of every reach
+        :param precips: The area weighted precipitation of every reach
+        :param numInLoops: How many reaches are in loops, and were sampled on their own
+        """
+        order = np.argsort(featureIds, kind="mergesort")
+        self.featureIds = np.asarray(featureIds)[order]
+        self.flowAccumulations = np.asarray(flowAccumulations)[order]
+        self.precips = np.asarray(precips)[order]
+        self.numInLoops = numInLoops
+
+    def lookup(self, featureIds):
+        """
+        :param featureIds: The feature IDs of a batch of reaches
+        :return: Arrays with the drainage area and precipitation of each of them
+        """
+        rows = np.clip(np.searchsorted(self.featureIds, featureIds), 0, max(len(self.featureIds) - 1, 0))
+        if len(featureIds) > 0 and not np.array_equal(self.featureIds[rows], featureIds):
+            raise ValueError("The stream network changed while we were reading it")
+        return self.flowAccumulations[rows], self.precips[rows]
+
+
+def findReachNetwork(streamNetwork, numReaches, dem, flowAccumulation, cellSize, precipMap, q2Equation, minJanTempMap,
+                     elevationMethod=NEAREST, maxRasterMemory=None, tileCacheFolder=None,
+                     snapTolerance=DEFAULT_SNAP_TOLERANCE, backend=None):
+    """
+    Reads the ends of every reach, opens the inputs for the area they cover, and passes drainage area and precipitation
+    down the stream network. Only the ends are kept, not the polylines
+    :param numReaches: How many reaches to read from the start of the stream network
+    :return: The ReachNetwork, a hash of the network for the checkpoint, and the ReachInputs
+    """
+    backend = getBackend(backend)
+    featureIds = np.empty(numReaches, dtype=np.int64)
+    endPoints = np.empty((4, numReaches), dtype=np.float64)
+    polylineReader = backend.readPolylines(streamNetwork)
+    numRead = 0
+    for polyline, featureId in islice(polylineReader, numReaches):
+        featureIds[numRead] = featureId
+        endPoints[:, numRead] = (polyline.firstPoint.X, polyline.firstPoint.Y, polyline.lastPoint.X,
+                                 polyline.lastPoint.Y)
+        numRead += 1
+    polylineReader.close()
+    featureIds = featureIds[:numRead]
+    firstXs, firstYs, lastXs, lastYs = endPoints[:, :numRead]
+
+    inputs = openReachInputs(dem, flowAccumulation, cellSize, precipMap, q2Equation, minJanTempMap, firstXs, firstYs,
+                             lastXs, lastYs, elevationMethod, maxRasterMemory, tileCacheFolder, backend=backend)
+    flowAccumulations, precips, numInLoops = findNetworkDrainage(inputs, firstXs, firstYs, lastXs, lastYs,
+                                                                 snapTolerance)
+    """The snapping method is part of the key, so checkpoints from when ends were snapped to a grid are started over"""
+    networkKey = sha1(featureIds.tobytes() + np.ascontiguousarray(endPoints[:, :numRead]).tobytes() +
+                      ("distance " + repr(snapTolerance)).encode("utf-8")).hexdigest()
+    return ReachNetwork(featureIds, flowAccumulations, precips, numInLoops), networkKey, inputs
+
+
+def openReachInputs(dem, flowAccumulation, cellSize, precipMap, q2Equation, minJanTempMap, firstXs, firstYs, lastXs,
+                    lastYs, elevationMethod=NEAREST, maxRasterMemory=None, tileCacheFolder=None, bufferRadius=20.0,
+                    backend=None):
+    """
+    Opens everything computeReachVariables() needs, reading only the area around the ends of our reaches
+    :param dem: Path to the DEM
+    :param flowAccumulation: A raster containing flow accumulation data, or a RasterSampler of one
+    :param cellSize: The area of each flow accumulation cell
+    :param precipMap: A feature class that has precipitation data in its polygons
+    :param q2Equation: The Q2Equation of our region
+    :param minJanTempMap: A raster of minimum January temperatures. Only opened if q2Equation needs it
+    :param maxRasterMemory: The most memory, in bytes, any one raster may take up
+    :param tileCacheFolder: Where we keep the tiled copies of rasters that are too big for memory
+    :param bufferRadius: How far from each point we look for the stream, in map units
+    :param backend: What reads the rasters and polygons. Defaults to an ArcpyBackend
+    :return: A ReachInputs
+    """
+    backend = getBackend(backend)
+    extent = pointExtent(np.concatenate((firstXs, lastXs)), np.concatenate((firstYs, lastYs)))
+    demSampler = backend.openRaster(dem, extent, 1, maxRasterMemory, tileCacheFolder)
+    flowAccSampler, filteredFlowAccSampler, footprint = openFlowAccumulation(flowAccumulation, firstXs, firstYs,
+                                                                             cellSize, bufferRadius, maxRasterMemory,
+                                                                             tileCacheFolder, backend)
+    precipIndex = PrecipitationIndex.fromFeatureClass(precipMap, "Inches", backend)
+    tempSampler = None
+    if q2Equation.needsTemperature:
+        tempSampler = backend.openRaster(minJanTempMap, pointExtent(firstXs, firstYs), 1, maxRasterMemory,
+                                         tileCacheFolder)
+    return ReachInputs(demSampler, flowAccSampler, cellSize, precipIndex, q2Equation, tempSampler, elevationMethod,
+                       footprint, bufferRadius, filteredFlowAccSampler)
+
+
+def findDrainageRasters(dem, hydrologyCache=None, hydrologyEngine=ARCGIS_ENGINE, backend=None):
+    """
+    Fills the DEM and finds its flow direction and flow accumulation. If we've done this for a DEM with the same
+    contents before, the rasters come straight out of the cache instead. The DEM is only read to hash it, and not even
+    that if the cache already knows the hash of this file
+    :param dem: Path to the DEM
+    :param hydrologyCache: A HydrologyCache, or None to always recalculate
+    :param hydrologyEngine: "ArcGIS" to use the Spatial Analyst tools, or "Native" to use GrainSizeHydrology
+    :param backend: What reads the DEM. Defaults to an ArcpyBackend, which the "ArcGIS" engine needs
+    :return: A dictionary with RasterSamplers of the "filledDEM", "flowDirection" and "flowAccumulation". Rasters that
+    went through the cache are memory mapped from it, so only the cells we sample are read
+    """
+    if hydrologyEngine not in (ARCGIS_ENGINE, NATIVE_ENGINE):
+        raise ValueError("Unknown hydrology engine: " + str(hydrologyEngine))
+    backend = getBackend(backend)
+    demSampler = None
+    key = None
+    if hydrologyCache is not None:
+        parameters = {"engine": hydrologyEngine}
+        stamp = None if isinstance(dem, RasterSampler) else HydrologyCache.makeStamp(dem, parameters)
+        if stamp is not None:
+            key = hydrologyCache.findKey(stamp)
+        if key is None:
+            demSampler = backend.readRaster(dem)
+            key = HydrologyCache.makeKey(demSampler, parameters)
+            if stamp is not None:
+                hydrologyCache.rememberKey(stamp, key)
+        cachedRasters = hydrologyCache.get(key, HYDROLOGY_RASTERS)
+        if cachedRasters is not None:
+            backend.message("Using cached drainage area rasters. " + hydrologyCache.summary())
+            return cachedRasters
+
+    if hydrologyEngine == NATIVE_ENGINE:
+        if demSampler is None:
+            demSampler = backend.readRaster(dem)
+        drainageRasters = GrainSizeHydrology.findDrainageRasters(demSampler)
+        del demSampler
+    else:
+        drainageRasters = backend.arcgisDrainageRasters(dem)
+
+    if hydrologyCache is not None:
+        """We hand back the memory mapped copies, so the rasters we just found can be let go of"""
+        drainageRasters = hydrologyCache.put(key, drainageRasters)
+        backend.message("Cached drainage area rasters. " + hydrologyCache.summary())
+    return drainageRasters
+
+
+def findMinJanTemps(minJanTempMap, xs, ys, maxRasterMemory=None, tileCacheFolder=None, backend=None):
+    """
+    Finds the minimum January temperature at many points at once, reading the temperature raster only once
+    :param minJanTempMap: A raster of minimum January temperatures, like the PRISM 30 year normals
+    :param xs: An array with the x coordinate of every point
+    :param ys: An array with the y coordinate of every point
+    :param maxRasterMemory: The most memory, in bytes, the raster may take up. If given, ASCII grids and rasters too big
+    for memory are converted once into a tile cache and read a tile at a time
+    :param tileCacheFolder: Where we keep the tile caches
+    :param backend: What reads the raster. Defaults to an ArcpyBackend
+    :return: An array of temperatures, with NaN where the raster has no data
+    """
+    tempSampler = getBackend(backend).openRaster(minJanTempMap, pointExtent(xs, ys), 1, maxRasterMemory,
+                                                 tileCacheFolder)
+    return tempSampler.sample(xs, ys)
+
+
+def findQ_2s(flowAccumulations, elevations, precips, regionNumber, minJanTemps=None, q2Registry=None):
+    """
+    Finds the value of a two year flood event for every reach at once
+    :param flowAccumulations: An array with the flow accumulation of every reach
+    :param elevations: An array with the elevation of every reach
+    :param precips: An array with the precipitation of every reach
+    :param regionNumber: What region we're in. See https://pubs.usgs.gov/fs/fs-016-01/
+    :param minJanTemps: An array with the minimum January temperature of every reach, if our region needs it
+    :param q2Registry: The Q2Registry to use. Defaults to the equations in Q2Regions.csv
+    :return: An array of Q_2 values, in cubic meters per second
+    """
+    if q2Registry is None:
+        q2Registry = getDefaultRegistry()
+    return q2Registry.evaluate(regionNumber, flowAccumulations, elevations, precips, minJanTemps)
+
+
+def findFlowAccumulations(flowAccumulation, xs, ys, cellSize, bufferRadius=20.0, maxRasterMemory=None,
+                          tileCacheFolder=None, backend=None):
+    """
+    Finds the drainage area at many points at once. Like findFlowAccumulation(), each point takes the largest flow
+    accumulation within bufferRadius of it, but the maximum is found for the whole raster in a single moving window
+    pass, so each point is then just a lookup
+    :param flowAccumulation: A raster containing flow accumulation data, or a RasterSampler of one
+    :param xs: An array with the x coordinate of every point
+    :param ys: An array with the y coordinate of every point
+    :param cellSize: The area of each cell
+    :param bufferRadius: How far from the point we look for the stream, in map units
+    :param maxRasterMemory: The most memory, in bytes, the raster may take up. If the raster is bigger, we read it a
+    tile at a time and only look at the cells around each point, rather than filtering the whole raster
+    :param tileCacheFolder: Where we keep the tiled copies of rasters that are too big for memory
+    :param backend: What reads the raster. Defaults to an ArcpyBackend
+    :return: An array with the drainage area at every point, in square kilometers
+    """
+    if len(xs) == 0:
+        return np.zeros(0)
+    flowAccSampler, filteredSampler, footprint = openFlowAccumulation(flowAccumulation, xs, ys, cellSize, bufferRadius,
+                                                                      maxRasterMemory, tileCacheFolder, backend)
+    return sampleDrainageAreas(flowAccSampler, xs, ys, cellSize, footprint, bufferRadius, filteredSampler)
+
+
+def openFlowAccumulation(flowAccumulation, xs, ys, cellSize, bufferRadius=20.0, maxRasterMemory=None,
+                         tileCacheFolder=None, backend=None):
+    """
+    Reads the part of the flow accumulation raster around our points. If it fits in memory, the largest flow
+    accumulation in the core of the footprint (the cells within bufferRadius of any point in the middle cell) is found
+    for every cell at once, which leaves only the fringe to check for each point
+    :return: A RasterSampler, the filtered RasterSampler (None if the raster was too big to filter), and the footprint
+    sampleDrainageAreas() should check for each point
+    """
+    core, fringe = pointFootprint(bufferRadius, sqrt(cellSize))
+    footprintRadius = max(max(abs(rowOffset), abs(colOffset)) for rowOffset, colOffset in core + fringe)
+
+    """We only need the part of the raster around our points, plus enough room for the window to see past them"""
+    extent = pointExtent(xs, ys)
+    flowAccSampler = getBackend(backend).openRaster(flowAccumulation, extent, footprintRadius + 1, maxRasterMemory,
+                                                    tileCacheFolder)
+    if not isinstance(flowAccSampler, TiledRaster):
+        flowAccSampler = flowAccSampler.window(extent, footprintRadius + 1)
+    if isinstance(flowAccSampler, TiledRaster) or \
+            (maxRasterMemory is not None and
+             flowAccSampler.array.size * (flowAccSampler.array.itemsize + 8) > maxRasterMemory):
+        return flowAccSampler, None, core + fringe
+    return flowAccSampler, focalMaximum(flowAccSampler, core), fringe
+
+
+def findPrecipitations(precipMap, xs, ys, backend=None):
+    """
+    Finds the precipitation at many points at once. The precipitation polygons are only read once, into an index
+    :param precipMap: A feature class that has precipitation data in its polygons
+    :param xs: An array with the x coordinate of every point
+    :param ys: An array with the y coordinate of every point
+    :param backend: What reads the polygons. Defaults to an ArcpyBackend
+    :return: An array of precipitation, in centimeters. A point that misses every polygon gets NaN, and a point on the
+    border between polygons gets the value of whichever comes first in the feature class
+    """
+    precipIndex = PrecipitationIndex.fromFeatureClass(precipMap, "Inches", backend)
+    precips = precipIndex.query(xs, ys)
+    precips *= 2.54  # converts to centimeters
+    return precips
+
+
+def findEndPoints(polylines):
+    """
+    Pulls the coordinates of the ends of every reach into arrays
+    :param polylines: A list of the Polylines of every reach
+    :return: Four float arrays: the x and y of the first points, then the x and y of the last points
+    """
+    firstXs = np.array([polyline.firstPoint.X for polyline in polylines], dtype=np.float64)
+    firstYs = np.array([polyline.firstPoint.Y for polyline in polylines], dtype=np.float64)
+    lastXs = np.array([polyline.lastPoint.X for polyline in polylines], dtype=np.float64)
+    lastYs = np.array([polyline.lastPoint.Y for polyline in polylines], dtype=np.float64)
+    return firstXs, firstYs, lastXs, lastYs
+
+
+def findElevations(dem, firstXs, firstYs, lastXs, lastYs, method=NEAREST, maxRasterMemory=None, tileCacheFolder=None,
+                   backend=None):
+    """
+    Finds the elevation at both ends of every reach, reading the DEM only once
+    :param dem: Path to the DEM
+    :param firstXs: The x coordinates of the first point of every reach
+    :param firstYs: The y coordinates of the first point of every reach
+    :param lastXs: The x coordinates of the last point of every reach
+    :param lastYs: The y coordinates of the last point of every reach
+    :param method: "nearest" to use the value of the cell each point is in, "bilinear" to interpolate
+    :param maxRasterMemory: The most memory, in bytes, the DEM may take up. Bigger DEMs are read a tile at a time
+    :param tileCacheFolder: Where we keep the tiled copies of rasters that are too big for memory
+    :param backend: What reads the DEM. Defaults to an ArcpyBackend
+    :return: Two float arrays, the elevations of the first points and of the last points. NaN where the DEM has no data
+    """
+    if len(firstXs) == 0:
+        return np.zeros(0), np.zeros(0)
+
+    """Only read the part of the DEM that the stream network actually covers"""
+    extent = pointExtent(np.concatenate((firstXs, lastXs)), np.concatenate((firstYs, lastYs)))
+    demSampler = getBackend(backend).openRaster(dem, extent, 1, maxRasterMemory, tileCacheFolder)
+
+    return demSampler.sample(firstXs, firstYs, method), demSampler.sample(lastXs, lastYs, method)
+
+
+class ReachFileWriter(object):
+    def __init__(self, outputDataPath, srsId=None, srsWkt=None, attributes=None):
+        """
+        Writes reaches to the outputs that don't need ArcGIS a batch at a time, as they're found:
+            GrainSize.gpkg, with every reach's geometry, grain size, width, Q_2, slope and drainage area
+            GrainSizeResults.bin, a binary file of columns that loadReaches() reads straight back into a ReachTable
+        :param outputDataPath: The folder to write to
+        :param srsId: The EPSG code of the stream network's spatial reference, if it has one
+        :param srsWkt: The well known text of the spatial reference
+        :param attributes: An optional dictionary of values to keep with the results, like n and t_c
+        """
+        self.numReaches = 0
+        self.resultsWriter = ResultsFileWriter(os.path.join(outputDataPath, "GrainSizeResults.bin"), attributes)
+        self.geoPackageWriter = GeoPackageWriter(os.path.join(outputDataPath, "GrainSize.gpkg"), srsId=srsId,
+                                                 srsWkt=srsWkt)
+
+    def write(self, reaches):
+        """
+        Writes a batch of reaches to every output
+        :param reaches: A ReachTable with its polylines
+        :return: None
+        """
+        self.resultsWriter.write(reaches)
+        polylines = reaches.polylines
+        geometries = [bytes(polyline.WKB) for polyline in polylines]
+        envelopes = np.array([(polyline.extent.XMin, polyline.extent.YMin, polyline.extent.XMax, polyline.extent.YMax)
+                              for polyline in polylines], dtype=np.float64).reshape(-1, 4)
+        self.geoPackageWriter.write(reaches, geometries, envelopes)
+        self.numReaches += len(reaches)
+
+    def close(self):
+        self.resultsWriter.close()
+        self.geoPackageWriter.close()
+
+    def abort(self):
+        """Stops writing, and throws away what was written"""
+        self.resultsWriter.abort()
+        self.geoPackageWriter.abort()
+
+
+def parseArguments(arguments=None):
+    """Reads the command line arguments for run()"""
+    parser = argparse.ArgumentParser(description="Finds the grain size of every reach in a stream network without "
+                                                 "ArcGIS. Rasters are ESRI ASCII grids (.asc) or .npy files saved by "
+                                                 "RasterSampler.save(), and the stream network and precipitation map "
+                                                 "are GeoJSON files")
+    parser.add_argument("dem")
+    parser.add_argument("streamNetwork")
+    parser.add_argument("precipMap")
+    parser.add_argument("outputFolder")
+    parser.add_argument("nValue", type=float)
+    parser.add_argument("t_cValue", type=float)
+    parser.add_argument("regionNumber", type=int)
+    parser.add_argument("--flowAccumulation", help="a flow accumulation raster. Found from the DEM if not given")
+    parser.add_argument("--testing", action="store_true", help="only go through the first " + str(TEST_REACHES) +
+                                                               " reaches")
+    parser.add_argument("--maxRasterMemory", type=int, help="the most memory, in MB, any one raster may take up")
+    parser.add_argument("--numWorkers", type=int, default=1, help="how many processes to use. 0 for one per core")
+    parser.add_argument("--batchSize", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--drainageMethod", choices=[SAMPLED_DRAINAGE, NETWORK_DRAINAGE], default=SAMPLED_DRAINAGE)
+    parser.add_argument("--checkpointFolder")
+    parser.add_argument("--profile", action="store_true", help="write a cProfile dump and a trace of every stage")
+    return parser.parse_args(arguments)
+
+
+if __name__ == '__main__':
+    arguments = parseArguments()
+    run(arguments.dem, arguments.flowAccumulation, arguments.streamNetwork, arguments.precipMap,
+        arguments.outputFolder, arguments.nValue, arguments.t_cValue, arguments.regionNumber, arguments.testing,
+        maxRasterMemory=arguments.maxRasterMemory * 1024 ** 2 if arguments.maxRasterMemory else None,
+        numWorkers=arguments.numWorkers, checkpointFolder=arguments.checkpointFolder, profile=arguments.profile,
+        batchSize=arguments.batchSize, drainageMethod=arguments.drainageMethod)
@@ -0,0 +1,265 @@
+########################################################################################################################
+# Name: Grain Size Hydrology
+# Purpose: Finds drainage area from a DEM without Spatial Analyst. Depressions are filled with a priority flood, every
+# cell is given a D8 flow direction, and flow accumulation is found in one pass over the cells in upstream to downstream
+# order. The results use the same conventions as the ArcGIS tools, so they can be used in place of Fill, FlowDirection
+# and FlowAccumulation.
+#
+# On a float32 DEM, memory use peaks at about 26 bytes per cell, half of which is the three rasters that come back,
+# plus about 40 bytes for each cell waiting in the priority flood's heap at the same time.
+########################################################################################################################
+
+import array
+import heapq
+from collections import deque
+import numpy as np
+from GrainSizeRaster import RasterSampler
+
+ARCGIS_ENGINE = "ArcGIS"
+NATIVE_ENGINE = "Native"
+
+OUTLET = 0  # The direction we give cells that flow off the edge of the DEM
+NO_DATA_DIRECTION = 255
+BLOCK_CELLS = 2 ** 20  # how many cells we work on at once when building the large index arrays
+
+"""The ArcGIS D8 codes, along with the (row, column) offset of the neighbour each one points to"""
+DIRECTIONS = [(1, 0, 1),
+              (2, 1, 1),
+              (4, 1, 0),
+              (8, 1, -1),
+              (16, 0, -1),
+              (32, -1, -1),
+              (64, -1, 0),
+              (128, -1, 1)]
+
+
+def _pad(array, value):
+    """Puts a one cell border around an array, so every real cell has eight neighbours"""
+    padded = np.full((array.shape[0] + 2, array.shape[1] + 2), value, dtype=array.dtype)
+    padded[1:-1, 1:-1] = array
+    return padded
+
+
+def _pythonArray(values, typecode):
+    """Copies a 1D NumPy array into a Python array a block at a time, so we never hold a third copy of it as bytes"""
+    pythonArray = array.array(typecode)
+    for firstCell in range(0, len(values), BLOCK_CELLS):
+        pythonArray.extend(array.array(typecode, values[firstCell:firstCell + BLOCK_CELLS].tobytes()))
+    return pythonArray
+
+
+def _validCells(sampler):
+    """Returns a boolean array of the cells that have data"""
+    elevations = sampler.array
+    valid = ~np.isnan(elevations) if elevations.dtype.kind == "f" else np.ones(elevations.shape, dtype=bool)
+    if sampler.noData is not None:
+        valid &= elevations != sampler.noData
+    return valid
+
+
+def fillAndFloodDirections(elevations, valid):
+    """
+    Fills every depression in a DEM with a priority flood, starting from the cells on the edge of the data and working
+    inwards from the lowest. As each cell is reached, we also note which neighbour reached it, which gives us a way
+    across the flat areas that filling creates
+    :param elevations: A 2D array of elevations
+    :param valid: A 2D boolean array of the cells that have data
+    :return: The filled elevations (NaN where there is no data), and an array of D8 codes pointing each cell at the
+    neighbour that flooded it (OUTLET for the edge cells we started from)
+    """
+    numRows, numCols = elevations.shape
+    paddedCols = numCols + 2
+    dtype = np.float32 if elevations.dtype == np.float32 else np.float64
+    filled = _pad(elevations.astype(dtype, copy=False), np.nan)
+    filled[1:-1, 1:-1][~valid] = np.nan
+    filled = filled.ravel()
+    closed = _pad(~valid, True).ravel()
+    floodDirections = np.zeros(closed.shape, dtype=np.uint8)
+
+    """The flat index offset to each neighbour, and the code that points from that neighbour back to us"""
+    neighbours = [(rowOffset * paddedCols + colOffset, code) for code, rowOffset, colOffset in DIRECTIONS]
+    reverseCodes = dict((code, reverseCode) for (code, rowOffset, colOffset) in DIRECTIONS
+                        for (reverseCode, reverseRow, reverseCol) in DIRECTIONS
+                        if reverseRow == -rowOffset and reverseCol == -colOffset)
+    neighbours = [(offset, reverseCodes[code]) for offset, code in neighbours]
+
+    """Every cell with data that touches the edge or a cell without data is where the flood starts"""
+    paddedValid = ~closed.reshape(numRows + 2, paddedCols)
+    touchesEdge = np.zeros(paddedValid.shape, dtype=bool)
+    for code, rowOffset, colOffset in DIRECTIONS:
+        touchesEdge[1:-1, 1:-1] |= ~paddedValid[1 + rowOffset:numRows + 1 + rowOffset,
+                                                1 + colOffset:numCols + 1 + colOffset]
+    touchesEdge &= paddedValid
+    seeds = np.flatnonzero(touchesEdge)
+    del paddedValid, touchesEdge
+    closed[seeds] = True
+
+    """
+    Heap entries are single integers rather than (elevation, cell) tuples, which take about three times the memory.
+    Each cell's rank in (elevation, cell) order goes in the high bits and the cell in the low bits, so the entries pop
+    in the same order the tuples would. Cells only go into the heap at their original elevation, so the ranks can all
+    be found up front
+    """
+    numPaddedCells = len(filled)
+    cellBits = int(numPaddedCells).bit_length()
+    indexCode = "i" if numPaddedCells < 2 ** 31 else "q"
+    ranks = np.empty(numPaddedCells, dtype=np.int32 if indexCode == "i" else np.int64)
+    order = np.argsort(filled, kind="mergesort")  # NaN sorts last, and never goes into the heap
+    for firstCell in range(0, numPaddedCells, BLOCK_CELLS):
+        lastCell = min(firstCell + BLOCK_CELLS, numPaddedCells)
+        ranks[order[firstCell:lastCell]] = np.arange(firstCell, lastCell, dtype=ranks.dtype)
+    del order
+    heap = ((ranks[seeds].astype(np.int64) << cellBits) | seeds).tolist()
+    heapq.heapify(heap)
+    del seeds
+
+    """Plain Python arrays are much quicker than NumPy arrays to index one cell at a time, and take no more memory"""
+    ranks = _pythonArray(ranks, indexCode)
+    filled = _pythonArray(filled, "f" if dtype == np.float32 else "d")
+    closed = bytearray(closed.tobytes())
+    floodDirections = bytearray(floodDirections.tobytes())
+
+    cellMask = (1 << cellBits) - 1
+    pit = deque()
+    while heap or pit:
+        if pit:
+            cell = pit.popleft()
+        else:
+            cell = heapq.heappop(heap) & cellMask
+        elevation = filled[cell]
+        for offset, reverseCode in neighbours:
+            neighbour = cell + offset
+            if closed[neighbour]:
+                continue
+            closed[neighbour] = True
+            floodDirections[neighbour] = reverseCode
+            if filled[neighbour] <= elevation:
+                filled[neighbour] = elevation  # raises the cell to the level of the water spilling into it
+                pit.append(neighbour)
+            else:
+                heapq.heappush(heap, (ranks[neighbour] << cellBits) | neighbour)
+    del ranks, closed
+
+    filled = np.frombuffer(filled, dtype=dtype).reshape(numRows + 2, paddedCols)[1:-1, 1:-1]
+    floodDirections = np.frombuffer(floodDirections, dtype=np.uint8).reshape(numRows + 2, paddedCols)[1:-1, 1:-1]
+    return filled, floodDirections
+
+
+def flowDirections(filled, floodDirections, cellWidth=1.0, cellHeight=1.0):
+    """
+    Points every cell at its steepest downhill neighbour. Cells with no downhill neighbour (flat areas left by filling)
+    keep the direction the flood reached them from, so they still drain out
+    :param filled: A 2D array of filled elevations, NaN where there is no data
+    :param floodDirections: The directions from fillAndFloodDirections()
+    :return: A 2D uint8 array of ArcGIS D8 codes, with OUTLET for cells that flow off the DEM and NO_DATA_DIRECTION
+    where there is no data
+    """
+    numRows, numCols = filled.shape
+    padded = _pad(filled, np.nan)
+    steepestDrop = np.zeros(filled.shape, dtype=filled.dtype)
+    directions = np.array(floodDirections, dtype=np.uint8)
+    with np.errstate(invalid="ignore"):
+        for code, rowOffset, colOffset in DIRECTIONS:
+            distance = np.hypot(rowOffset * cellHeight, colOffset * cellWidth)
+            drop = (filled - padded[1 + rowOffset:numRows + 1 + rowOffset, 1 + colOffset:numCols + 1 + colOffset])
+            drop /= distance
+            steeper = drop > steepestDrop  # NaN neighbours never compare as steeper
+            directions[steeper] = code
+            steepestDrop[steeper] = drop[steeper]
+    directions[np.isnan(filled)] = NO_DATA_DIRECTION
+    return directions
+
+
+def flowAccumulation(directions, valid):
+    """
+    Counts how many cells flow into each cell, like the ArcGIS tool (a cell does not count itself). Cells are handled
+    in waves, starting with the ones that nothing flows into, so each cell is only visited once
+    :param directions: A 2D array of D8 codes from flowDirections()
+    :param valid: A 2D boolean array of the cells that have data
+    :return: A 2D float array of flow accumulation, NaN where there is no data
+    """
+    numRows, numCols = directions.shape
+    numCells = numRows * numCols
+    indexType = np.int32 if numCells < 2 ** 31 else np.int64
+    flatValid = valid.ravel()
+
+    """
+    Finds the flat index of the cell each cell flows into (-1 if it flows off the DEM or into a cell without data), and
+    counts the cells flowing into each cell, a band of rows at a time so the temporaries stay small. A cell can only
+    have one donor in each direction, so each direction's donors can be counted with plain indexing
+    """
+    receivers = np.full(numCells, -1, dtype=indexType)
+    donorCounts = np.zeros(numCells, dtype=np.uint8)
+    readyChunks = []
+    rowsPerBand = max(BLOCK_CELLS // max(numCols, 1), 1)
+    for firstRow in range(0, numRows, rowsPerBand):
+        lastRow = min(firstRow + rowsPerBand, numRows)
+        bandDirections = directions[firstRow:lastRow].ravel()
+        bandValid = flatValid[firstRow * numCols:lastRow * numCols]
+        bandReceivers = receivers[firstRow * numCols:lastRow * numCols]
+        rows, cols = np.divmod(np.arange(len(bandDirections), dtype=indexType), indexType(numCols))
+        rows += firstRow
+        for code, rowOffset, colOffset in DIRECTIONS:
+            isCode = np.flatnonzero((bandDirections == code) & bandValid)
+            receiverRows = rows[isCode] + rowOffset
+            receiverCols = cols[isCode] + colOffset
+            inside = (receiverRows >= 0) & (receiverRows < numRows) & (receiverCols >= 0) & (receiverCols < numCols)
+            codeReceivers = receiverRows[inside] * numCols + receiverCols[inside]
+            receiving = flatValid[codeReceivers]
+            codeReceivers = codeReceivers[receiving]
+            bandReceivers[isCode[inside][receiving]] = codeReceivers
+            donorCounts[codeReceivers] += 1
+    del rows, cols, isCode, receiverRows, receiverCols, inside, codeReceivers, receiving
+
+    """Cells that nothing flows into are ready to pass their flow on first"""
+    for firstCell in range(0, numCells, BLOCK_CELLS):
+        lastCell = min(firstCell + BLOCK_CELLS, numCells)
+        ready = np.flatnonzero((donorCounts[firstCell:lastCell] == 0) & flatValid[firstCell:lastCell])
+        if len(ready) > 0:
+            readyChunks.append((ready + firstCell).astype(indexType))
+
+    """
+    Each cell passes its flow on once everything above it has, and in turn may make the cell below it ready. The ready
+    cells are handled at most BLOCK_CELLS at a time, and the order doesn't change the counts
+    """
+    accumulation = np.zeros(numCells, dtype=np.float64)
+    while readyChunks:
+        wave = readyChunks.pop()
+        if len(wave) > BLOCK_CELLS:
+            readyChunks.append(wave[BLOCK_CELLS:])
+            wave = wave[:BLOCK_CELLS]
+        waveReceivers = receivers[wave]
+        flowing = waveReceivers >= 0
+        wave, waveReceivers = wave[flowing], waveReceivers[flowing]
+        if len(wave) == 0:
+            continue
+        uniqueReceivers, inverse = np.unique(waveReceivers, return_inverse=True)
+        accumulation[uniqueReceivers] += np.bincount(inverse, weights=accumulation[wave] + 1)
+        donorCounts[uniqueReceivers] -= np.bincount(inverse).astype(np.uint8)
+        ready = uniqueReceivers[donorCounts[uniqueReceivers] == 0]
+        if len(ready) > 0:
+            readyChunks.append(ready)
+    del receivers, donorCounts
+
+    accumulation[~flatValid] = np.nan
+    return accumulation.reshape(numRows, numCols)
+
+
+def findDrainageRasters(demSampler):
+    """
+    Runs the whole chain on a DEM
+    :param demSampler: A RasterSampler of the DEM
+    :return: A dictionary with RasterSamplers of the "filledDEM", "flowDirection" and "flowAccumulation"
+    """
+    valid = _validCells(demSampler)
+    filled, floodDirections = fillAndFloodDirections(demSampler.array, valid)
+    directions = flowDirections(filled, floodDirections, demSampler.cellWidth, demSampler.cellHeight)
+    del floodDirections
+    accumulation = flowAccumulation(directions, valid)
+
+    def makeSampler(array, noData=None):
+        return RasterSampler(array, demSampler.xMin, demSampler.yMax, demSampler.cellWidth, demSampler.cellHeight,
+                             noData)
+    return {"filledDEM": makeSampler(filled),
+            "flowDirection": makeSampler(directions, NO_DATA_DIRECTION),
+            "flowAccumulation": makeSampler(accumulation)}
@@ -0,0 +1,247 @@
+########################################################################################################################
+# Name: Grain Size Instrumentation
+# Purpose: Keeps track of where a run spends its time. Each stage of the pipeline is timed every time it runs, and we
+# keep the number of calls, the number of reaches, the total time, percentiles of the time per call, and the slowest
+# calls. Where a step's time can be told apart between reaches, the slowest reaches are kept too, by feature ID. A
+# summary is reported at a fixed interval rather than after every step, and a cProfile dump or a trace event file
+# (which chrome://tracing and Perfetto can open) can be written on request. When it's turned off, every method returns
+# straight away.
+########################################################################################################################
+
+import cProfile
+import heapq
+import json
+import os
+import threading
+import numpy as np
+from timeit import default_timer as timer
+
+DEFAULT_SUMMARY_INTERVAL = 60.0  # seconds between summaries
+DEFAULT_NUM_SLOWEST = 10
+_FEATURE_IDS_KEPT = 20  # how many feature IDs we remember for each of the slowest calls
+
+
+class _StageStatistics(object):
+    def __init__(self):
+        self.calls = 0
+        self.items = 0
+        self.totalSeconds = 0.0
+        self.durations = []
+
+
+class _NoStage(object):
+    """What stage() gives back when instrumentation is off"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+class _Stage(object):
+    def __init__(self, instrumentation, name, numItems, featureIds):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.numItems = numItems
+        self.featureIds = featureIds
+
+    def __enter__(self):
+        self.start = timer()
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback):
+        self.instrumentation.record(self.name, timer() - self.start, self.numItems, self.featureIds, self.start)
+        return False
+
+
+class Instrumentation(object):
+    def __init__(self, enabled=True, report=None, summaryInterval=DEFAULT_SUMMARY_INTERVAL, profilePath=None,
+                 tracePath=None, numSlowest=DEFAULT_NUM_SLOWEST):
+        """
+        :param enabled: False turns everything off, so the only cost is a method call
+        :param report: A function that takes a line of text, like arcpy.AddMessage. Summaries go here
+        :param summaryInterval: The least time, in seconds, between summaries. None only reports at the end
+        :param profilePath: If given, the run is profiled with cProfile and the stats are dumped here
+        :param tracePath: If given, every stage is written here as a trace event file
+        :param numSlowest: How many of the slowest calls, and of the slowest reaches, to remember
+        """
+        self.enabled = enabled
+        self.report = report
+        self.summaryInterval = summaryInterval
+        self.profilePath = profilePath if enabled else None
+        self.tracePath = tracePath if enabled else None
+        self.numSlowest = numSlowest
+        self.stages = {}
+        self.stageOrder = []
+        self.slowest = []  # a heap of (seconds, order, stage name, number of reaches, feature IDs)
+        self.slowestReaches = []  # a heap of (seconds, feature ID)
+        self.traceEvents = []
+        self.numRecorded = 0
+        self.started = timer()
+        self.lastSummary = self.started
+        self._lock = threading.Lock()
+        self._profiler = None
+        if self.profilePath is not None:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def stage(self, name, numItems=0, featureIds=None):
+        """
+        Times a stage:
+            with instrumentation.stage("precipitation", len(xs)):
+                ...
+        :param name: The name of the stage
+        :param numItems: How many reaches the stage handles
+        :param featureIds: An optional array with the feature IDs of those reaches, so a slow call can be traced back
+        """
+        if not self.enabled:
+            return _NO_STAGE
+        return _Stage(self, name, numItems, featureIds)
+
+    def record(self, name, seconds, numItems=0, featureIds=None, start=None):
+        """
+        Records a stage that was timed somewhere else, like in a worker process
+        :param name: The name of the stage
+        :param seconds: How long it took
+        :param numItems: How many reaches it handled
+        :param featureIds: An optional array with the feature IDs of those reaches
+        :param start: When it started, on our timer. Defaults to seconds before now
+        """
+        if not self.enabled:
+            return
+        now = timer()
+        if start is None:
+            start = now - seconds
+        with self._lock:
+            statistics = self.stages.get(name)
+            if statistics is None:
+                statistics = self.stages[name] = _StageStatistics()
+                self.stageOrder.append(name)
+            statistics.calls += 1
+            statistics.items += int(numItems)
+            statistics.totalSeconds += seconds
+            statistics.durations.append(seconds)
+            self.numRecorded += 1
+
+            if featureIds is not None:
+                entry = (seconds, self.numRecorded, name, int(numItems),
+                         np.asarray(featureIds)[:_FEATURE_IDS_KEPT].tolist())
+                if len(self.slowest) < self.numSlowest:
+                    heapq.heappush(self.slowest, entry)
+                else:
+                    heapq.heappushpop(self.slowest, entry)
+            if self.tracePath is not None:
+                self.traceEvents.append({"name": name, "ph": "X", "pid": os.getpid(), "tid": 0,
+                                         "ts": (start - self.started) * 1e6, "dur": seconds * 1e6,
+                                         "args": {"reaches": int(numItems)}})
+        self.tick(now)
+
+    def recordReaches(self, featureIds, seconds):
+        """
+        Records how long each of a chunk of reaches took, keeping the slowest of them. Reaches with no time of their
+        own are left out
+        :param featureIds: An array with the feature ID of each reach
+        :param seconds: An array with the time spent on each reach by itself, like the reachSeconds from
+        computeReachVariables()
+        """
+        if not self.enabled or len(featureIds) == 0:
+            return
+        seconds = np.asarray(seconds, dtype=np.float64)
+        """We keep one more than we report, to tell whether the slowest reaches are really slower than the rest"""
+        slowest = np.argsort(seconds, kind="mergesort")[-(self.numSlowest + 1):]
+        with self._lock:
+            for i in slowest[seconds[slowest] > 0].tolist():
+                entry = (float(seconds[i]), int(featureIds[i]))
+                if len(self.slowestReaches) <= self.numSlowest:
+                    heapq.heappush(self.slowestReaches, entry)
+                else:
+                    heapq.heappushpop(self.slowestReaches, entry)
+
+    def tick(self, now=None):
+        """Reports a summary if it's been long enough since the last one"""
+        if not self.enabled or self.report is None or self.summaryInterval is None:
+            return
+        if now is None:
+            now = timer()
+        if now - self.lastSummary >= self.summaryInterval:
+            self.lastSummary = now
+            for line in self.summaryLines():
+                self.report(line)
+
+    def summary(self):
+        """
+        :return: A dictionary with the statistics of every stage, in the order they first ran, the slowest calls, and
+        the slowest reaches
+        """
+        stages = []
+        for name in self.stageOrder:
+            statistics = self.stages[name]
+            durations = np.array(statistics.durations)
+            p50, p90, p99 = np.percentile(durations, [50, 90, 99])
+            stages.append({"name": name,
+                           "calls": statistics.calls,
+                           "reaches": statistics.items,
+                           "totalSeconds": statistics.totalSeconds,
+                           "p50Seconds": float(p50),
+                           "p90Seconds": float(p90),
+                           "p99Seconds": float(p99),
+                           "maxSeconds": float(durations.max()),
+                           "secondsPerReach": statistics.totalSeconds / statistics.items if statistics.items else None})
+        slowest = [{"stage": name, "seconds": seconds, "reaches": numItems, "featureIds": featureIds}
+                   for seconds, order, name, numItems, featureIds in sorted(self.slowest, reverse=True)]
+        """A reach is only reported if it took longer than every reach we left out. Otherwise its place in the ranking
+        would come down to which of several reaches that took the same time we happened to keep"""
+        slowestReaches = sorted(self.slowestReaches, reverse=True)
+        if len(slowestReaches) > self.numSlowest:
+            slowestReaches = [entry for entry in slowestReaches[:self.numSlowest] if entry[0] > slowestReaches[-1][0]]
+        slowestReaches = [{"featureId": featureId, "seconds": seconds} for seconds, featureId in slowestReaches]
+        return {"elapsedSeconds": timer() - self.started, "stages": stages, "slowest": slowest,
+                "slowestReaches": slowestReaches}
+
+    def summaryLines(self):
+        """The summary as lines of text"""
+        summary = self.summary()
+        lines = ["Timing after " + "%.1f" % summary["elapsedSeconds"] + " seconds:"]
+        for stage in summary["stages"]:
+            line = "  " + stage["name"] + ": " + "%.3f" % stage["totalSeconds"] + " s over " + str(stage["calls"]) + \
+                   " calls"
+            if stage["reaches"]:
+                line += ", " + str(stage["reaches"]) + " reaches (" + "%.3g" % stage["secondsPerReach"] + " s each)"
+            if stage["calls"] > 1:
+                line += ", p50 " + "%.3f" % stage["p50Seconds"] + " s, p99 " + "%.3f" % stage["p99Seconds"] + " s"
+            lines.append(line)
+        for call in summary["slowest"][:3]:
+            lines.append("  Slow " + call["stage"] + " call: " + "%.3f" % call["seconds"] + " s for " +
+                         str(call["reaches"]) + " reaches")
+        if summary["slowestReaches"]:
+            lines.append("  Slowest reaches to find precipitation for, by feature ID: " +
+                         ", ".join(str(reach["featureId"]) + " (" + "%.3g" % reach["seconds"] + " s)"
+                                   for reach in summary["slowestReaches"][:5]))
+        return lines
+
+    def finish(self, summaryPath=None):
+        """
+        Stops the profiler, writes the profile and trace files, and reports a final summary
+        :param summaryPath: If given, the summary is also written here as JSON
+        :return: The summary dictionary, or None if instrumentation is off
+        """
+        if not self.enabled:
+            return None
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profilePath)
+            self._profiler = None
+        if self.tracePath is not None:
+            with open(self.tracePath, "w") as traceFile:
+                json.dump({"traceEvents": self.traceEvents, "displayTimeUnit": "ms"}, traceFile)
+        summary = self.summary()
+        if summaryPath is not None:
+            with open(summaryPath, "w") as summaryFile:
+                json.dump(summary, summaryFile, indent=2)
+        if self.report is not None:
+            for line in self.summaryLines():
+                self.report(line)
+        return summary
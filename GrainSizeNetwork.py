@@ -0,0 +1,223 @@
+########################################################################################################################
+# Name: Grain Size Network
+# Purpose: Finds drainage area by following the stream network rather than sampling every reach on its own. The ends of
+# the reaches are snapped together into nodes, flow accumulation is sampled once at each node, and each reach adds only
+# the area that drains into it along its length. Drainage area and area weighted precipitation are then passed
+# downstream in one topological pass, so a reach always drains at least as much as the reaches above it, and the area
+# at a confluence is exactly the sum of its tributaries. Reaches are taken to flow from their first point to their last.
+########################################################################################################################
+
+import numpy as np
+from GrainSizePipeline import sampleDrainageAreas
+
+SAMPLED_DRAINAGE = "Sampled"
+NETWORK_DRAINAGE = "Network"
+DEFAULT_SNAP_TOLERANCE = 0.5  # map units. Reach ends at most this far apart are treated as the same node
+
+
+def snapEndPoints(firstXs, firstYs, lastXs, lastYs, tolerance=DEFAULT_SNAP_TOLERANCE):
+    """
+    Snaps together the ends of reaches that are within a tolerance of each other, and gives every group of ends a node
+    number. Any two ends within the tolerance share a node, and so does any chain of them
+    :param firstXs: The x coordinates of the first point of every reach
+    :param firstYs: The y coordinates of the first point of every reach
+    :param lastXs: The x coordinates of the last point of every reach
+    :param lastYs: The y coordinates of the last point of every reach
+    :param tolerance: How close, in map units, two ends have to be to share a node
+    :return: The node at the first point of every reach, the node at the last point of every reach, and the x and y
+    coordinates of every node (the first reach end that was snapped to it)
+    """
+    numReaches = len(firstXs)
+    xs = np.concatenate((firstXs, lastXs)).astype(np.float64)
+    ys = np.concatenate((firstYs, lastYs)).astype(np.float64)
+    if len(xs) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0), np.zeros(0)
+
+    roots = np.arange(len(xs))
+    pairs = findNearbyPairs(xs, ys, tolerance)
+    if len(pairs[0]) > 0:
+        roots = joinPairs(roots, *pairs)
+
+    """Each group is numbered in the order of its first end, and that end is where the node is"""
+    firstEnds, nodes = np.unique(roots, return_inverse=True)
+    return nodes[:numReaches], nodes[numReaches:], xs[firstEnds], ys[firstEnds]
+
+
+def findNearbyPairs(xs, ys, tolerance):
+    """
+    Finds every pair of points within a distance of each other. The points are put in a grid of cells as wide as the
+    distance, so each point only has to be compared with the points in its own cell and the cells next to it
+    :param xs: An array of x coordinates
+    :param ys: An array of y coordinates
+    :param tolerance: The distance, in map units
+    :return: Two integer arrays, the first and second point of every pair
+    """
+    cols = np.floor(xs / tolerance).astype(np.int64)
+    rows = np.floor(ys / tolerance).astype(np.int64)
+    cols -= cols.min()
+    rows -= rows.min()
+    numRows = int(rows.max()) + 2  # a spare row, so the cell above the top row isn't the bottom of the next column
+    cells = cols * numRows + rows
+    order = np.argsort(cells, kind="mergesort")
+    sortedCells = cells[order]
+
+    firstPoints = []
+    secondPoints = []
+    """Half of the neighbouring cells are enough, since each pair only has to be found once"""
+    for colOffset, rowOffset in ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1)):
+        neighbours = sortedCells + colOffset * numRows + rowOffset
+        starts = np.searchsorted(sortedCells, neighbours, side="left")
+        ends = np.searchsorted(sortedCells, neighbours, side="right")
+        if (colOffset, rowOffset) == (0, 0):
+            starts = np.arange(1, len(order) + 1)  # only the points after this one in its own cell
+        counts = np.maximum(ends - starts, 0)
+        if counts.sum() == 0:
+            continue
+        first = np.repeat(np.arange(len(order)), counts)
+        second = np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        first, second = order[first], order[second]
+        close = (xs[first] - xs[second]) ** 2 + (ys[first] - ys[second]) ** 2 <= tolerance ** 2
+        firstPoints.append(first[close])
+        secondPoints.append(second[close])
+    if not firstPoints:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(firstPoints), np.concatenate(secondPoints)
+
+
+def joinPairs(roots, firstPoints, secondPoints):
+    """
+    Union-find over whole arrays at once. Every pair is joined under the smaller root of its two points, then every
+    point jumps to its root's root, until nothing changes
+    :param roots: An integer array with the root of every point, like np.arange() for points that aren't joined yet
+    :param firstPoints: The first point of every pair to join
+    :param secondPoints: The second point of every pair to join
+    :return: The root of every point, which is the smallest point in its group
+    """
+    roots = roots.copy()
+    while True:
+        smaller = np.minimum(roots[firstPoints], roots[secondPoints])
+        newRoots = roots.copy()
+        np.minimum.at(newRoots, roots[firstPoints], smaller)
+        np.minimum.at(newRoots, roots[secondPoints], smaller)
+        np.minimum.at(newRoots, firstPoints, smaller)
+        np.minimum.at(newRoots, secondPoints, smaller)
+        newRoots = newRoots[newRoots]
+        if np.array_equal(newRoots, roots):
+            return roots
+        roots = newRoots
+
+
+class StreamGraph(object):
+    def __init__(self, upNodes, downNodes, numNodes=None):
+        """
+        The stream network as a directed graph, where each reach runs from its up node to its down node
+        :param upNodes: The node at the upstream end of every reach
+        :param downNodes: The node at the downstream end of every reach
+        :param numNodes: How many nodes there are. Defaults to one more than the largest node number
+        """
+        self.upNodes = np.asarray(upNodes, dtype=np.int64)
+        self.downNodes = np.asarray(downNodes, dtype=np.int64)
+        if numNodes is None:
+            numNodes = int(max(self.upNodes.max(), self.downNodes.max())) + 1 if len(self.upNodes) else 0
+        self.numNodes = numNodes
+        self.numInflows = np.bincount(self.downNodes, minlength=numNodes)  # reaches that end at each node
+        self.numOutflows = np.bincount(self.upNodes, minlength=numNodes)  # reaches that start at each node
+
+        """The reaches that start at each node, so we can find them without searching"""
+        self._reachesByUpNode = np.argsort(self.upNodes, kind="mergesort")
+        self._upNodeStarts = np.concatenate(([0], np.cumsum(self.numOutflows)))
+
+    def __len__(self):
+        return len(self.upNodes)
+
+    def reachesStartingAt(self, nodes):
+        """
+        :param nodes: An array of nodes
+        :return: An array of every reach that starts at any of them
+        """
+        starts = self._upNodeStarts[nodes]
+        counts = self._upNodeStarts[nodes + 1] - starts
+        if counts.sum() == 0:
+            return np.zeros(0, dtype=np.int64)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return self._reachesByUpNode[np.repeat(starts, counts) + offsets]
+
+    def accumulate(self, nodeDrainageAreas, localPrecips):
+        """
+        Passes drainage area and precipitation down the network. A reach with nothing flowing into it drains the area
+        sampled at its upstream node. Any other reach drains the sum of what flows out of the reaches above it, shared
+        equally among the reaches that leave that node. On the way down each reach adds the area that drains into it
+        along its length. That is how much the area sampled at its downstream node is more than the areas sampled at
+        the upstream nodes of every reach that ends there, shared equally among those reaches
+        :param nodeDrainageAreas: An array with the drainage area sampled at every node
+        :param localPrecips: An array with the precipitation of the area that drains into every reach. NaN is left out
+        of the average
+        :return: Arrays with the drainage area and area weighted precipitation at the upstream end of every reach, and
+        how many reaches are in loops and kept their sampled values
+        """
+        numReaches = len(self)
+        nodeDrainageAreas = np.asarray(nodeDrainageAreas, dtype=np.float64)
+        localPrecips = np.asarray(localPrecips, dtype=np.float64)
+        sampledAbove = np.bincount(self.downNodes, nodeDrainageAreas[self.upNodes], self.numNodes)
+        nodeAreas = np.maximum(nodeDrainageAreas - sampledAbove, 0)
+        nodeAreas[np.isnan(nodeAreas)] = 0
+        localAreas = nodeAreas[self.downNodes] / self.numInflows[self.downNodes]
+        precipKnown = ~np.isnan(localPrecips)
+
+        drainageAreas = nodeDrainageAreas[self.upNodes].copy()
+        precips = localPrecips.copy()
+        inflowAreas = np.zeros(self.numNodes)  # drainage area flowing into each node
+        inflowWeights = np.zeros(self.numNodes)  # the part of it whose precipitation we know
+        inflowPrecips = np.zeros(self.numNodes)  # precipitation times area, summed over that part
+        waiting = self.numInflows.copy()  # reaches still to be finished above each node
+        done = np.zeros(numReaches, dtype=bool)
+
+        """Every pass finishes the reaches whose up node has nothing left waiting above it"""
+        frontier = self.reachesStartingAt(np.flatnonzero(waiting == 0))
+        while len(frontier) > 0:
+            upNodes = self.upNodes[frontier]
+            fedFromAbove = self.numInflows[upNodes] > 0
+            shares = np.where(fedFromAbove, 1.0 / self.numOutflows[upNodes], 0.0)
+            weights = np.where(fedFromAbove, inflowWeights[upNodes] * shares,
+                               np.where(precipKnown[frontier], drainageAreas[frontier], 0.0))
+            precipTotals = np.where(fedFromAbove, inflowPrecips[upNodes] * shares,
+                                    np.where(precipKnown[frontier], drainageAreas[frontier] * precips[frontier], 0.0))
+            drainageAreas[frontier] = np.where(fedFromAbove, inflowAreas[upNodes] * shares, drainageAreas[frontier])
+            with np.errstate(invalid="ignore", divide="ignore"):
+                precips[frontier] = np.where(weights > 0, precipTotals / weights, localPrecips[frontier])
+
+            """Adds what drains into each reach along its length, and passes it all to the node below"""
+            localWeights = np.where(precipKnown[frontier], localAreas[frontier], 0.0)
+            downNodes = self.downNodes[frontier]
+            np.add.at(inflowAreas, downNodes, drainageAreas[frontier] + localAreas[frontier])
+            np.add.at(inflowWeights, downNodes, weights + localWeights)
+            np.add.at(inflowPrecips, downNodes, precipTotals + localWeights * np.where(precipKnown[frontier],
+                                                                                         localPrecips[frontier], 0.0))
+            np.add.at(waiting, downNodes, -1)
+            done[frontier] = True
+            finishedNodes = np.unique(downNodes)
+            frontier = self.reachesStartingAt(finishedNodes[waiting[finishedNodes] == 0])
+
+        return drainageAreas, precips, int(numReaches - np.count_nonzero(done))
+
+
+def findNetworkDrainage(inputs, firstXs, firstYs, lastXs, lastYs, tolerance=DEFAULT_SNAP_TOLERANCE):
+    """
+    Finds the drainage area and precipitation of every reach by following the stream network
+    :param inputs: The ReachInputs to sample flow accumulation and precipitation from
+    :param firstXs: The x coordinates of the first point of every reach
+    :param firstYs: The y coordinates of the first point of every reach
+    :param lastXs: The x coordinates of the last point of every reach
+    :param lastYs: The y coordinates of the last point of every reach
+    :param tolerance: How close, in map units, two reach ends have to be to count as connected
+    :return: Arrays with the drainage area (in square kilometers) and precipitation (in centimeters) at the first point
+    of every reach, and how many reaches are in loops and kept the values sampled at their first point
+    """
+    upNodes, downNodes, nodeXs, nodeYs = snapEndPoints(firstXs, firstYs, lastXs, lastYs, tolerance)
+    graph = StreamGraph(upNodes, downNodes, len(nodeXs))
+    nodeDrainageAreas = sampleDrainageAreas(inputs.flowAccSampler, nodeXs, nodeYs, inputs.cellSize, inputs.footprint,
+                                            inputs.bufferRadius, inputs.filteredFlowAccSampler)
+    localPrecips = inputs.precipIndex.query(firstXs, firstYs)
+    localPrecips *= 2.54  # converts to centimeters
+    return graph.accumulate(nodeDrainageAreas, localPrecips)
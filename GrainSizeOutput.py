@@ -0,0 +1,388 @@
+########################################################################################################################
+# Name: Grain Size Output
+# Purpose: Writes the results of a run in bulk, a whole column at a time. The results file holds each of the reach
+# table's columns as raw binary after a small JSON header, so it can be memory mapped and loaded back into a ReachTable
+# without parsing any text. The GeoPackage writer puts every reach, with its geometry and all of its attributes, into a
+# SQLite database in a single transaction. Both can be written a batch of reaches at a time, both can be read back a
+# subset of reaches at a time, and neither needs ArcGIS.
+########################################################################################################################
+
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import numpy as np
+from GrainSizeReach import ReachTable
+
+RESULTS_MAGIC = b"GSRESULT"
+RESULTS_VERSION = 1
+RESULT_COLUMNS = [("featureIds", "<i8"),
+                  ("width", "<f8"),
+                  ("q_2", "<f8"),
+                  ("slope", "<f8"),
+                  ("grainSize", "<f8"),
+                  ("t_c", "<f8"),
+                  ("flowAccumulation", "<f8")]
+_ALIGNMENT = 64  # bytes. Every column starts on a boundary like this, so it can be mapped straight into an array
+_COPY_BUFFER_SIZE = 16 * 1024 ** 2
+
+GEOPACKAGE_APPLICATION_ID = 0x47504B47  # "GPKG"
+GEOPACKAGE_VERSION = 10200  # 1.2
+_GEOMETRY_TYPES = {1: "POINT", 2: "LINESTRING", 3: "POLYGON", 4: "MULTIPOINT", 5: "MULTILINESTRING",
+                   6: "MULTIPOLYGON", 7: "GEOMETRYCOLLECTION"}
+_CUSTOM_SRS_ID = 100000  # where a spatial reference without an EPSG code goes
+_geometryHeader = struct.Struct("<2sBBi")
+_envelope = struct.Struct("<4d")
+_ENVELOPE_SIZES = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}  # bytes, by the envelope code in a geometry's flags
+_FIDS_PER_QUERY = 500  # SQLite allows 999 parameters in a query
+
+
+def _align(offset):
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+class ResultsFileWriter(object):
+    def __init__(self, path, attributes=None):
+        """
+        Writes a results file a batch of reaches at a time. Each column is appended to its own scratch file as batches
+        come in, and they're put together into the results file when it's closed, so only one batch is ever in memory
+        :param path: Where to write the file
+        :param attributes: An optional dictionary of anything else worth keeping with the results, like n and t_c. It
+        must be JSON serializable
+        """
+        self.path = path
+        self.attributes = attributes or {}
+        self.partialPath = path + "." + str(os.getpid()) + ".partial"
+        self.numReaches = 0
+        self.columnFiles = [open(self.partialPath + "." + name, "wb") for name, dtype in RESULT_COLUMNS]
+
+    def write(self, reaches):
+        """
+        Adds a batch of reaches to the file
+        :param reaches: A ReachTable
+        :return: None
+        """
+        for columnFile, (name, dtype) in zip(self.columnFiles, RESULT_COLUMNS):
+            columnFile.write(np.ascontiguousarray(getattr(reaches, name), dtype=dtype).tobytes())
+        self.numReaches += len(reaches)
+
+    def close(self):
+        """Puts the columns together into the results file, which only shows up once it's complete"""
+        for columnFile in self.columnFiles:
+            columnFile.close()
+        columns = []
+        offset = 0
+        for name, dtype in RESULT_COLUMNS:
+            columns.append({"name": name, "dtype": dtype, "offset": offset})
+            offset = _align(offset + self.numReaches * np.dtype(dtype).itemsize)
+        header = json.dumps({"version": RESULTS_VERSION, "numReaches": self.numReaches, "columns": columns,
+                             "attributes": self.attributes}).encode("utf-8")
+        dataStart = _align(len(RESULTS_MAGIC) + 4 + len(header))
+
+        with open(self.partialPath, "wb") as resultsFile:
+            resultsFile.write(RESULTS_MAGIC)
+            resultsFile.write(struct.pack("<I", len(header)))
+            resultsFile.write(header)
+            for column, (name, dtype) in zip(columns, RESULT_COLUMNS):
+                resultsFile.write(b"\0" * (dataStart + column["offset"] - resultsFile.tell()))
+                with open(self.partialPath + "." + name, "rb") as columnFile:
+                    shutil.copyfileobj(columnFile, resultsFile, _COPY_BUFFER_SIZE)
+            resultsFile.write(b"\0" * (dataStart + offset - resultsFile.tell()))
+        self._removeColumnFiles()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self.partialPath, self.path)
+
+    def abort(self):
+        """Throws away everything written so far"""
+        for columnFile in self.columnFiles:
+            columnFile.close()
+        self._removeColumnFiles()
+
+    def _removeColumnFiles(self):
+        for name, dtype in RESULT_COLUMNS:
+            if os.path.exists(self.partialPath + "." + name):
+                os.remove(self.partialPath + "." + name)
+
+
+def writeResultsFile(path, reaches, attributes=None):
+    """
+    Writes every column of a ReachTable to a binary results file
+    :param path: Where to write the file
+    :param reaches: The ReachTable to write
+    :param attributes: An optional dictionary of anything else worth keeping with the results, like n and t_c. It must
+    be JSON serializable
+    :return: None
+    """
+    writer = ResultsFileWriter(path, attributes)
+    try:
+        writer.write(reaches)
+    except:
+        writer.abort()
+        raise
+    writer.close()
+
+
+def readResultsFile(path, mmap=True):
+    """
+    Reads a results file written by writeResultsFile()
+    :param path: The results file
+    :param mmap: If True, the columns are memory mapped read only rather than read into memory
+    :return: A dictionary of the columns, keyed by name, and the dictionary of attributes it was written with
+    """
+    with open(path, "rb") as resultsFile:
+        magic = resultsFile.read(len(RESULTS_MAGIC))
+        if magic != RESULTS_MAGIC:
+            raise ValueError(path + " is not a grain size results file")
+        headerLength, = struct.unpack("<I", resultsFile.read(4))
+        header = json.loads(resultsFile.read(headerLength).decode("utf-8"))
+        if header["version"] != RESULTS_VERSION:
+            raise ValueError(path + " is version " + str(header["version"]) + " of the results file, but we can only "
+                             "read version " + str(RESULTS_VERSION))
+        dataStart = _align(len(RESULTS_MAGIC) + 4 + headerLength)
+        numReaches = header["numReaches"]
+
+        columns = {}
+        for column in header["columns"]:
+            dtype = np.dtype(str(column["dtype"]))
+            if numReaches == 0:
+                columns[column["name"]] = np.empty(0, dtype=dtype)
+            elif mmap:
+                columns[column["name"]] = np.memmap(path, dtype=dtype, mode="r", offset=dataStart + column["offset"],
+                                                    shape=(numReaches,))
+            else:
+                resultsFile.seek(dataStart + column["offset"])
+                columns[column["name"]] = np.fromfile(resultsFile, dtype=dtype, count=numReaches)
+    return columns, header["attributes"]
+
+
+def loadReaches(path, rows=None):
+    """
+    Rebuilds the ReachTable that was written to a results file. It has no polylines, but its feature IDs can be used to
+    join it back to the stream network
+    :param path: The results file
+    :param rows: An optional array with the positions of the reaches to load. None loads every reach
+    :return: A ReachTable
+    """
+    columns, attributes = readResultsFile(path)
+    if rows is not None:
+        columns = dict((name, values[rows]) for name, values in columns.items())
+    reaches = ReachTable(columns["width"], columns["q_2"], columns["slope"], featureIds=columns["featureIds"])
+    reaches.grainSize = np.array(columns["grainSize"])
+    reaches.t_c = np.array(columns["t_c"])
+    reaches.flowAccumulation = np.array(columns["flowAccumulation"])
+    return reaches
+
+
+def readGeoPackageGeometries(path, fids, tableName="GrainSize"):
+    """
+    Reads the geometries of some features out of a GeoPackage, like one written by GeoPackageWriter. Their feature IDs
+    count up from 1 in the order the reaches were written
+    :param path: The .gpkg file
+    :param fids: An array with the feature IDs to read
+    :param tableName: The name of the feature table
+    :return: A list with the WKB of each feature's geometry (None where it has none), and an array with the (xMin, yMin,
+    xMax, yMax) of each one, NaN where the geometry has no envelope
+    """
+    fids = np.asarray(fids, dtype=np.int64)
+    geometries = [None] * len(fids)
+    envelopes = np.full((len(fids), 4), np.nan)
+    positions = dict((fid, i) for i, fid in enumerate(fids.tolist()))
+    connection = sqlite3.connect(path)
+    try:
+        for start in range(0, len(fids), _FIDS_PER_QUERY):
+            chunk = fids[start:start + _FIDS_PER_QUERY].tolist()
+            rows = connection.execute('SELECT fid, geom FROM "' + tableName + '" WHERE fid IN (' +
+                                      ", ".join("?" * len(chunk)) + ")", chunk)
+            for fid, blob in rows:
+                if blob is None:
+                    continue
+                blob = bytes(blob)
+                magic, version, flags, srsId = _geometryHeader.unpack_from(blob)
+                envelopeSize = _ENVELOPE_SIZES[(flags >> 1) & 0x07]
+                i = positions[fid]
+                geometries[i] = blob[_geometryHeader.size + envelopeSize:]
+                if envelopeSize > 0:
+                    xMin, xMax, yMin, yMax = _envelope.unpack_from(blob, _geometryHeader.size)
+                    envelopes[i] = (xMin, yMin, xMax, yMax)
+    finally:
+        connection.close()
+    return geometries, envelopes
+
+
+def _geometryType(geometries):
+    """Finds the GeoPackage geometry type that covers every WKB geometry"""
+    types = set()
+    for prefix in set(bytes(wkb[:5]) for wkb in geometries if wkb is not None and len(wkb) >= 5):
+        typeCode, = struct.unpack("<I" if bytearray(prefix[:1])[0] == 1 else ">I", prefix[1:5])
+        types.add(_GEOMETRY_TYPES.get(typeCode % 1000, "GEOMETRY"))  # Z and M types are 1000s more
+    return types.pop() if len(types) == 1 else "GEOMETRY"
+
+
+class GeoPackageWriter(object):
+    def __init__(self, path, tableName="GrainSize", srsId=None, srsWkt=None):
+        """
+        Writes reaches, with their geometry and every attribute, to a GeoPackage a batch at a time. Everything goes in a
+        single transaction, which is committed when the writer is closed
+        :param path: Where to write the .gpkg file. Anything already there is replaced once the writer is closed
+        :param tableName: The name of the feature table
+        :param srsId: The EPSG code of the geometries' spatial reference, if it has one
+        :param srsWkt: The well known text of the spatial reference, if known
+        """
+        self.path = path
+        self.tableName = tableName
+        self.partialPath = path + "." + str(os.getpid()) + ".partial"
+        if srsId is not None and srsId > 0:
+            srsRow = ("EPSG:" + str(srsId), int(srsId), "EPSG", int(srsId), srsWkt or "undefined")
+        elif srsWkt:
+            srsRow = ("Custom", _CUSTOM_SRS_ID, "NONE", _CUSTOM_SRS_ID, srsWkt)
+        else:
+            srsRow = None
+        self.srsId = srsRow[1] if srsRow is not None else -1
+        self.geometryTypes = set()
+        self.extent = None
+        self.numReaches = 0
+        self._tableCreated = False
+
+        if os.path.exists(self.partialPath):
+            os.remove(self.partialPath)
+        self.connection = sqlite3.connect(self.partialPath, isolation_level=None)  # we manage the transaction
+        try:
+            self.connection.execute("PRAGMA page_size = 65536")  # bigger pages mean fewer to write for a big table
+            self.connection.execute("PRAGMA application_id = " + str(GEOPACKAGE_APPLICATION_ID))
+            self.connection.execute("PRAGMA user_version = " + str(GEOPACKAGE_VERSION))
+            self.connection.execute("PRAGMA journal_mode = OFF")  # the file is only renamed into place once complete
+            self.connection.execute("PRAGMA synchronous = OFF")
+            self.connection.execute("BEGIN")
+            self.connection.execute("CREATE TABLE gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, "
+                                    "srs_id INTEGER NOT NULL PRIMARY KEY, organization TEXT NOT NULL, "
+                                    "organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, "
+                                    "description TEXT)")
+            srsRows = [("Undefined cartesian SRS", -1, "NONE", -1, "undefined"),
+                       ("Undefined geographic SRS", 0, "NONE", 0, "undefined")]
+            if srsRow is not None:
+                srsRows.append(srsRow)
+            self.connection.executemany("INSERT INTO gpkg_spatial_ref_sys (srs_name, srs_id, organization, "
+                                        "organization_coordsys_id, definition) VALUES (?, ?, ?, ?, ?)", srsRows)
+            self.connection.execute("CREATE TABLE gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, "
+                                    "data_type TEXT NOT NULL, identifier TEXT UNIQUE, description TEXT DEFAULT '', "
+                                    "last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')), "
+                                    "min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER, "
+                                    "CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) "
+                                    "REFERENCES gpkg_spatial_ref_sys(srs_id))")
+            self.connection.execute("CREATE TABLE gpkg_geometry_columns (table_name TEXT NOT NULL, "
+                                    "column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL, "
+                                    "srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL, "
+                                    "CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name), "
+                                    "CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) "
+                                    "REFERENCES gpkg_contents(table_name), "
+                                    "CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) "
+                                    "REFERENCES gpkg_spatial_ref_sys (srs_id))")
+        except:
+            self.abort()
+            raise
+
+    def _createTable(self, geometryType):
+        """The feature table is made once we know what type of geometry goes in it"""
+        self.connection.execute('CREATE TABLE "' + self.tableName + '" (fid INTEGER PRIMARY KEY AUTOINCREMENT, ' +
+                                'geom ' + geometryType + ', ' +
+                                ", ".join('"' + name + '" ' + ("INTEGER" if dtype[1] == "i" else "DOUBLE")
+                                          for name, dtype in RESULT_COLUMNS) + ")")
+        self.connection.execute("INSERT INTO gpkg_contents (table_name, data_type, identifier, srs_id) "
+                                "VALUES (?, 'features', ?, ?)", (self.tableName, self.tableName, self.srsId))
+        self.connection.execute("INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', ?, ?, 0, 0)",
+                                (self.tableName, geometryType, self.srsId))
+        self._tableCreated = True
+
+    def write(self, reaches, geometries, envelopes=None):
+        """
+        Adds a batch of reaches
+        :param reaches: A ReachTable
+        :param geometries: A list with the WKB of each reach's geometry, or None where it has none
+        :param envelopes: An optional array with the (xMin, yMin, xMax, yMax) of each geometry. If given, each geometry
+        carries its envelope, which lets readers filter by area without parsing it, and the table's extent is recorded
+        :return: None
+        """
+        numReaches = len(reaches)
+        if len(geometries) != numReaches:
+            raise ValueError("There must be one geometry per reach")
+        if numReaches == 0:
+            return
+        batchType = _geometryType(geometries)
+        self.geometryTypes.add(batchType)
+        if not self._tableCreated:
+            self._createTable(batchType)
+
+        if envelopes is not None:
+            envelopes = np.asarray(envelopes, dtype=np.float64).reshape(numReaches, 4)
+            finite = np.isfinite(envelopes).all(axis=1)
+            if finite.any():
+                batchExtent = (envelopes[finite, 0].min(), envelopes[finite, 1].min(), envelopes[finite, 2].max(),
+                               envelopes[finite, 3].max())
+                if self.extent is not None:
+                    batchExtent = (min(self.extent[0], batchExtent[0]), min(self.extent[1], batchExtent[1]),
+                                   max(self.extent[2], batchExtent[2]), max(self.extent[3], batchExtent[3]))
+                self.extent = tuple(float(value) for value in batchExtent)
+
+        """Each geometry is the standard GeoPackage header (flags say little endian, with or without an envelope) +
+        its WKB"""
+        def makeBlobs():
+            if envelopes is None:
+                header = _geometryHeader.pack(b"GP", 0, 0x01, self.srsId)
+                for wkb in geometries:
+                    yield None if wkb is None else sqlite3.Binary(header + bytes(wkb))
+            else:
+                header = _geometryHeader.pack(b"GP", 0, 0x03, self.srsId)
+                for wkb, (xMin, yMin, xMax, yMax) in zip(geometries, envelopes.tolist()):
+                    yield None if wkb is None else sqlite3.Binary(header + _envelope.pack(xMin, xMax, yMin, yMax) +
+                                                                  bytes(wkb))
+
+        attributeNames = [name for name, dtype in RESULT_COLUMNS]
+        attributeColumns = [getattr(reaches, name).tolist() for name in attributeNames]
+        self.connection.executemany('INSERT INTO "' + self.tableName + '" (geom, ' +
+                                    ", ".join('"' + name + '"' for name in attributeNames) + ") VALUES (?" +
+                                    ", ?" * len(attributeNames) + ")",
+                                    zip(makeBlobs(), *attributeColumns))
+        self.numReaches += numReaches
+
+    def close(self):
+        """Records the table's extent, commits, and puts the GeoPackage in place"""
+        try:
+            if not self._tableCreated:
+                self._createTable("GEOMETRY")
+            if len(self.geometryTypes) > 1:
+                self.connection.execute("UPDATE gpkg_geometry_columns SET geometry_type_name = 'GEOMETRY' "
+                                        "WHERE table_name = ?", (self.tableName,))
+            if self.extent is not None:
+                self.connection.execute("UPDATE gpkg_contents SET min_x = ?, min_y = ?, max_x = ?, max_y = ? "
+                                        "WHERE table_name = ?", self.extent + (self.tableName,))
+            self.connection.execute("COMMIT")
+        except:
+            self.abort()
+            raise
+        self.connection.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self.partialPath, self.path)
+
+    def abort(self):
+        """Throws away everything written so far"""
+        self.connection.close()
+        if os.path.exists(self.partialPath):
+            os.remove(self.partialPath)
+
+
+def writeGeoPackage(path, reaches, geometries, tableName="GrainSize", srsId=None, srsWkt=None, envelopes=None):
+    """
+    Writes every reach, with its geometry and every attribute, to a GeoPackage in a single transaction. See
+    GeoPackageWriter for the parameters
+    :return: None
+    """
+    writer = GeoPackageWriter(path, tableName, srsId, srsWkt)
+    try:
+        writer.write(reaches, geometries, envelopes)
+    except:
+        writer.abort()
+        raise
+    writer.close()
@@ -0,0 +1,246 @@
+########################################################################################################################
+# Name: Grain Size Parallel
+# Purpose: Finds the variables of every reach across a pool of worker processes. Reaches are sorted along a Z-order
+# curve and cut into chunks, so each chunk covers a compact part of the map and its workers touch as few raster tiles as
+# possible. The inputs are saved once to a scratch folder for this run and memory mapped by every worker, and each
+# worker gets its own scratch folder inside it. A ReachPool keeps its workers between batches of reaches. Reaches can
+# also be grouped, like by region, so no chunk crosses a group and the biggest groups are started first. Results are put
+# back in the order the reaches were read, so they don't depend on how many workers there were or which one finished
+# first.
+########################################################################################################################
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+from GrainSizePipeline import ReachInputs, computeReachVariables
+
+DEFAULT_CHUNKS_PER_WORKER = 4  # more chunks than workers, so a slow chunk doesn't leave the other workers idle
+MORTON_BITS = 16
+
+_workerInputs = None  # the ReachInputs that each worker loads once, when it starts
+
+
+def mortonCodes(xs, ys, bits=MORTON_BITS):
+    """
+    Finds where each point falls along a Z-order curve over the points' bounding box. Points that are close together
+    on the map tend to be close together on the curve
+    :param xs: An array of x coordinates
+    :param ys: An array of y coordinates
+    :param bits: How many bits of each coordinate to use
+    :return: An integer array with the position of each point on the curve
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    codes = np.zeros(len(xs), dtype=np.uint64)
+    if len(xs) == 0:
+        return codes
+
+    def quantize(values):
+        finite = np.isfinite(values)
+        if not finite.any():
+            return np.zeros(len(values), dtype=np.uint64)
+        low, high = values[finite].min(), values[finite].max()
+        scale = (2 ** bits - 1) / (high - low) if high > low else 0.0
+        scaled = np.where(finite, (values - low) * scale, 0.0)
+        return np.clip(scaled, 0, 2 ** bits - 1).astype(np.uint64)
+    cols = quantize(xs)
+    rows = quantize(ys)
+
+    for bit in range(bits):
+        codes |= ((cols >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit)
+        codes |= ((rows >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit + 1)
+    return codes
+
+
+def partitionReaches(xs, ys, numChunks, groups=None):
+    """
+    Splits reaches into spatially compact chunks of nearly equal size
+    :param xs: The x coordinate of each reach
+    :param ys: The y coordinate of each reach
+    :param numChunks: How many chunks we want. We give back fewer if there aren't enough reaches
+    :param groups: An optional integer array with the group (like the region) of each reach. No chunk holds reaches
+    from more than one group, and the chunks of the biggest groups come first, so they start first
+    :return: A list of integer arrays, each holding the indices of the reaches in one chunk
+    """
+    order = np.argsort(mortonCodes(xs, ys), kind="mergesort")  # a stable sort, so ties always split the same way
+    numChunks = max(min(int(numChunks), len(order)), 1)
+    if groups is None:
+        return [chunk for chunk in np.array_split(order, numChunks) if len(chunk) > 0]
+
+    """Each group gets its share of the chunks, but at least one"""
+    groups = np.asarray(groups)[order]
+    order = order[np.argsort(groups, kind="mergesort")]
+    groupIds, groupStarts, groupSizes = np.unique(np.sort(groups), return_index=True, return_counts=True)
+    chunkSize = -(-len(order) // numChunks)
+    chunks = []
+    for start, size in sorted(zip(groupStarts.tolist(), groupSizes.tolist()), key=lambda group: -group[1]):
+        chunks.extend(np.array_split(order[start:start + size], -(-size // chunkSize)))
+    return chunks
+
+
+def findNumWorkers(numWorkers):
+    """Turns a requested number of workers into an actual one. Anything less than 1 means one per core"""
+    if numWorkers is None or numWorkers < 1:
+        return multiprocessing.cpu_count()
+    return int(numWorkers)
+
+
+def _useStandalonePython():
+    """
+    Inside ArcMap, sys.executable is ArcMap itself, so new processes would open more copies of ArcMap. Points
+    multiprocessing at the Python that ships with it instead
+    """
+    if os.name != "nt" or os.path.basename(sys.executable).lower().startswith("python"):
+        return
+    for name in ("python.exe", "pythonw.exe"):
+        candidate = os.path.join(sys.exec_prefix, name)
+        if os.path.exists(candidate):
+            multiprocessing.set_executable(candidate)
+            return
+
+
+def _initializeWorker(inputsPath, scratchFolder):
+    """Loads the inputs once per worker, and gives the worker its own scratch folder"""
+    global _workerInputs
+    workerFolder = os.path.join(scratchFolder, "worker_" + str(os.getpid()))
+    if not os.path.exists(workerFolder):
+        os.makedirs(workerFolder)
+    tempfile.tempdir = workerFolder
+    _workerInputs = ReachInputs.load(inputsPath)
+
+
+def _evaluateChunk(task):
+    """Finds the variables of one chunk of reaches in a worker"""
+    chunkNumber, indices, firstXs, firstYs, lastXs, lastYs, lengths, flowAccumulations, precips = task
+    timings = {}
+    reachSeconds = np.zeros(len(indices))
+    columns = computeReachVariables(_workerInputs, firstXs, firstYs, lastXs, lastYs, lengths, timings,
+                                    flowAccumulations, precips, reachSeconds)
+    return chunkNumber, indices, columns, timings, reachSeconds
+
+
+class ReachPool(object):
+    def __init__(self, inputs, numWorkers, scratchFolder):
+        """
+        A pool of worker processes that each load the inputs once, so it can find the variables of many batches of
+        reaches without starting over for each one. Close it when done, or use it in a with statement
+        :param inputs: The ReachInputs to use
+        :param numWorkers: How many processes to use. Less than 1 means one per core
+        :param scratchFolder: Where to make this pool's scratch folder. It is deleted when the pool is closed
+        """
+        self.numWorkers = findNumWorkers(numWorkers)
+        if not os.path.exists(scratchFolder):
+            os.makedirs(scratchFolder)
+        self.runFolder = tempfile.mkdtemp(prefix="parallel_", dir=scratchFolder)  # unique, so runs can share a folder
+        self.pool = None
+        try:
+            inputsPath = inputs.save(os.path.join(self.runFolder, "inputs"))
+            _useStandalonePython()
+            self.pool = multiprocessing.Pool(self.numWorkers, _initializeWorker, (inputsPath, self.runFolder))
+        except:
+            self.terminate()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback):
+        if exceptionType is None:
+            self.close()
+        else:
+            self.terminate()
+        return False
+
+    def compute(self, firstXs, firstYs, lastXs, lastYs, lengths, timings=None,
+                chunksPerWorker=DEFAULT_CHUNKS_PER_WORKER, progress=None, maxChunkSize=None, chunkDone=None,
+                flowAccumulations=None, precips=None, groups=None):
+        """
+        Does the same thing as computeReachVariables(), but splits the reaches across the pool
+        :param firstXs: The x coordinates of the first point of every reach
+        :param firstYs: The y coordinates of the first point of every reach
+        :param lastXs: The x coordinates of the last point of every reach
+        :param lastYs: The y coordinates of the last point of every reach
+        :param lengths: The length of every reach
+        :param timings: An optional dictionary that the seconds spent on each step, summed over every worker, are added
+        to
+        :param chunksPerWorker: How many chunks to cut the reaches into for each worker
+        :param progress: An optional function that is called with (chunksDone, numChunks) as chunks finish
+        :param maxChunkSize: The most reaches to put in one chunk. None only splits by chunksPerWorker
+        :param chunkDone: An optional function that is called with (indices, columns, timings, reachSeconds) for each
+        chunk as it finishes, where indices are the positions of the chunk's reaches in the arrays we were given,
+        timings are the seconds the worker spent on each step of that chunk, and reachSeconds is each reach's share of
+        them
+        :param flowAccumulations: An optional array with the drainage area of every reach, found beforehand
+        :param precips: An optional array with the precipitation of every reach, found beforehand
+        :param groups: An optional integer array with the group of every reach. See partitionReaches()
+        :return: The same dictionary of arrays as computeReachVariables(), in the same order as the reaches we were
+        given
+        """
+        if timings is None:
+            timings = {}
+        numReaches = len(firstXs)
+        numChunks = self.numWorkers * chunksPerWorker
+        if maxChunkSize is not None:
+            numChunks = max(numChunks, -(-numReaches // int(maxChunkSize)))
+        chunks = partitionReaches(firstXs, firstYs, numChunks, groups)
+
+        def part(values, chunk):
+            return None if values is None else values[chunk]
+        tasks = ((chunkNumber, chunk, firstXs[chunk], firstYs[chunk], lastXs[chunk], lastYs[chunk], lengths[chunk],
+                  part(flowAccumulations, chunk), part(precips, chunk))
+                 for chunkNumber, chunk in enumerate(chunks))
+        columns = {}
+        chunksDone = 0
+        for chunkNumber, indices, chunkColumns, chunkTimings, chunkReachSeconds in \
+                self.pool.imap_unordered(_evaluateChunk, tasks):
+            for name, values in chunkColumns.items():
+                if name not in columns:
+                    columns[name] = np.empty(numReaches, dtype=values.dtype)
+                columns[name][indices] = values
+            for name, seconds in chunkTimings.items():
+                timings[name] = timings.get(name, 0.0) + seconds
+            if chunkDone is not None:
+                chunkDone(indices, chunkColumns, chunkTimings, chunkReachSeconds)
+            chunksDone += 1
+            if progress is not None:
+                progress(chunksDone, len(chunks))
+        return columns
+
+    def close(self):
+        """Waits for the workers to finish and deletes the scratch folder"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        shutil.rmtree(self.runFolder, ignore_errors=True)
+
+    def terminate(self):
+        """Stops the workers straight away and deletes the scratch folder"""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        shutil.rmtree(self.runFolder, ignore_errors=True)
+
+
+def computeReachVariablesInParallel(inputs, firstXs, firstYs, lastXs, lastYs, lengths, numWorkers, scratchFolder,
+                                    timings=None, chunksPerWorker=DEFAULT_CHUNKS_PER_WORKER, progress=None,
+                                    maxChunkSize=None, chunkDone=None, flowAccumulations=None, precips=None,
+                                    groups=None):
+    """
+    Does the same thing as computeReachVariables(), but splits the reaches across a pool of processes that only lasts
+    for this call. See ReachPool.compute() for the parameters
+    :param numWorkers: How many processes to use. Less than 1 means one per core
+    :param scratchFolder: Where to make this run's scratch folder. It is deleted once we're done
+    :return: The same dictionary of arrays as computeReachVariables(), in the same order as the reaches we were given
+    """
+    numReaches = len(firstXs)
+    if numReaches == 0:
+        return computeReachVariables(inputs, firstXs, firstYs, lastXs, lastYs, lengths, timings, flowAccumulations,
+                                     precips)
+    with ReachPool(inputs, min(findNumWorkers(numWorkers), numReaches), scratchFolder) as pool:
+        return pool.compute(firstXs, firstYs, lastXs, lastYs, lengths, timings, chunksPerWorker, progress,
+                            maxChunkSize, chunkDone, flowAccumulations, precips, groups)
@@ -0,0 +1,215 @@
+########################################################################################################################
+# Name: Grain Size Pipeline
+# Purpose: Finds the slope, precipitation, drainage area, width and Q_2 of a batch of reaches from inputs that have
+# already been opened. Nothing here needs ArcGIS, so a batch can be handed to another process, which just loads the
+# inputs from the scratch folder they were saved to.
+########################################################################################################################
+
+import os
+import pickle
+import numpy as np
+from timeit import default_timer as timer
+from GrainSizeRaster import RasterSampler, NEAREST
+from GrainSizeTiles import TiledRaster, DEFAULT_MAX_MEMORY
+
+"""The rasters in a ReachInputs, which are saved as files rather than pickled"""
+RASTER_INPUTS = ("demSampler", "flowAccSampler", "filteredFlowAccSampler", "tempSampler")
+
+"""The columns computeReachVariables() gives back"""
+REACH_VARIABLES = ["firstPointElevations", "lastPointElevations", "slopes", "precips", "flowAccumulations", "widths",
+                   "q_2s"]
+
+
+class ReachInputs(object):
+    def __init__(self, demSampler, flowAccSampler, cellSize, precipIndex, q2Equation, tempSampler=None,
+                 elevationMethod=NEAREST, footprint=None, bufferRadius=None, filteredFlowAccSampler=None):
+        """
+        Everything we need to find the variables of a reach, already opened
+        :param demSampler: A RasterSampler of the DEM
+        :param flowAccSampler: A RasterSampler of flow accumulation. If footprint is None, each cell should already hold
+        the largest flow accumulation within the buffer around it
+        :param cellSize: The area of each flow accumulation cell
+        :param precipIndex: A PrecipitationIndex of the precipitation polygons, in inches
+        :param q2Equation: The Q2Equation of our region
+        :param tempSampler: A RasterSampler of minimum January temperature, if q2Equation needs it
+        :param elevationMethod: How we sample the DEM, "nearest" or "bilinear"
+        :param footprint: The cells around each point to take the largest flow accumulation from, if flowAccSampler
+        hasn't already been filtered
+        :param bufferRadius: How far from each point we look for the stream. Cells of the footprint farther than this
+        from the point are left out
+        :param filteredFlowAccSampler: An optional RasterSampler holding, for each cell, the largest flow accumulation
+        in the core of its footprint. See sampleDrainageAreas()
+        """
+        self.demSampler = demSampler
+        self.flowAccSampler = flowAccSampler
+        self.cellSize = cellSize
+        self.precipIndex = precipIndex
+        self.q2Equation = q2Equation
+        self.tempSampler = tempSampler
+        self.elevationMethod = elevationMethod
+        self.footprint = footprint
+        self.bufferRadius = bufferRadius
+        self.filteredFlowAccSampler = filteredFlowAccSampler
+
+    def save(self, folder):
+        """
+        Saves the inputs so another process can load them. Rasters are saved as .npy files that the other process
+        memory maps, so the operating system shares one copy of them between every process
+        :param folder: Where to save the inputs
+        :return: The path to load the inputs from
+        """
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        state = dict(self.__dict__)
+        for name in RASTER_INPUTS:
+            sampler = state[name]
+            if isinstance(sampler, TiledRaster):
+                state[name] = ("tiled", sampler.path, sampler.maxCachedTiles)
+            elif sampler is not None:
+                path = os.path.join(folder, name + ".npy")
+                sampler.save(path)
+                state[name] = ("array", path)
+        path = os.path.join(folder, "reachInputs.pickle")
+        with open(path, "wb") as inputsFile:
+            pickle.dump(state, inputsFile, pickle.HIGHEST_PROTOCOL)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        """Loads inputs saved by save()"""
+        with open(path, "rb") as inputsFile:
+            state = pickle.load(inputsFile)
+        for name in RASTER_INPUTS:
+            saved = state[name]
+            if saved is None:
+                continue
+            if saved[0] == "tiled":
+                tiledRaster = TiledRaster(saved[1], DEFAULT_MAX_MEMORY)
+                tiledRaster.maxCachedTiles = saved[2]
+                state[name] = tiledRaster
+            else:
+                state[name] = RasterSampler.load(saved[1])
+        inputs = cls.__new__(cls)
+        inputs.__dict__.update(state)
+        return inputs
+
+
+def computeReachVariables(inputs, firstXs, firstYs, lastXs, lastYs, lengths, timings=None, flowAccumulations=None,
+                          precips=None, reachSeconds=None):
+    """
+    Finds the variables of a batch of reaches. Precipitation, drainage area and Q_2 are found at the first point of each
+    reach
+    :param inputs: The ReachInputs to use
+    :param firstXs: The x coordinates of the first point of every reach
+    :param firstYs: The y coordinates of the first point of every reach
+    :param lastXs: The x coordinates of the last point of every reach
+    :param lastYs: The y coordinates of the last point of every reach
+    :param lengths: The length of every reach
+    :param timings: An optional dictionary that the seconds spent on each step ("elevation", "precipitation",
+    "flowAccumulation" and "variables", which covers slope, width and Q_2) are added to
+    :param flowAccumulations: An optional array with the drainage area of every reach, found beforehand (like by
+    following the stream network). If None, it is sampled at the first point of every reach
+    :param precips: An optional array with the precipitation of every reach, in centimeters, found beforehand. If
+    None, it is found at the first point of every reach
+    :param reachSeconds: An optional float array, one value per reach, that the time spent on each reach by itself is
+    added to. Only the precipitation lookup's polygon tests depend on the reach, so that's all that's counted. The
+    other steps sample every reach in one pass, so their time can't be told apart between reaches
+    :return: A dictionary of arrays: firstPointElevations, lastPointElevations, slopes, precips, flowAccumulations,
+    widths and q_2s
+    """
+    if timings is None:
+        timings = {}
+
+    start = timer()
+    firstPointElevations = inputs.demSampler.sample(firstXs, firstYs, inputs.elevationMethod)
+    lastPointElevations = inputs.demSampler.sample(lastXs, lastYs, inputs.elevationMethod)
+    timings["elevation"] = timings.get("elevation", 0.0) + timer() - start
+
+    if precips is None:
+        start = timer()
+        precips = inputs.precipIndex.query(firstXs, firstYs, pointSeconds=reachSeconds)
+        precips *= 2.54  # converts to centimeters
+        timings["precipitation"] = timings.get("precipitation", 0.0) + timer() - start
+
+    if flowAccumulations is None:
+        start = timer()
+        flowAccumulations = sampleDrainageAreas(inputs.flowAccSampler, firstXs, firstYs, inputs.cellSize,
+                                                inputs.footprint, inputs.bufferRadius, inputs.filteredFlowAccSampler)
+        timings["flowAccumulation"] = timings.get("flowAccumulation", 0.0) + timer() - start
+
+    start = timer()
+    slopes = findSlopes(lengths, firstPointElevations, lastPointElevations)
+    widths = findWidth(flowAccumulations, precips)
+    minJanTemps = None
+    if inputs.q2Equation.needsTemperature:
+        minJanTemps = inputs.tempSampler.sample(firstXs, firstYs)
+    q_2s = inputs.q2Equation.evaluate(flowAccumulations, firstPointElevations, precips, minJanTemps)
+    timings["variables"] = timings.get("variables", 0.0) + timer() - start
+
+    return {"firstPointElevations": firstPointElevations,
+            "lastPointElevations": lastPointElevations,
+            "slopes": slopes,
+            "precips": precips,
+            "flowAccumulations": flowAccumulations,
+            "widths": widths,
+            "q_2s": q_2s}
+
+
+def sampleDrainageAreas(flowAccSampler, xs, ys, cellSize, footprint=None, bufferRadius=None, filteredSampler=None):
+    """
+    Finds the drainage area at many points. Each point takes the largest flow accumulation among the cells whose centers
+    are within bufferRadius of it, like a buffer around the point would. The cells that are within it wherever the point
+    is in its cell can come from filteredSampler, and the rest are checked point by point
+    :param flowAccSampler: A RasterSampler of flow accumulation
+    :param xs: An array with the x coordinate of every point
+    :param ys: An array with the y coordinate of every point
+    :param cellSize: The area of each cell
+    :param footprint: If given, each point takes the largest value among these cells around it. If None, and there's no
+    filteredSampler, flowAccSampler has already been filtered with focalMaximum()
+    :param bufferRadius: If given, cells of the footprint whose centers are farther than this from the point are left
+    out
+    :param filteredSampler: An optional RasterSampler made by filtering flowAccSampler with focalMaximum() over the core
+    from pointFootprint(). The footprint is then the fringe
+    :return: An array with the drainage area at every point, in square kilometers
+    """
+    if filteredSampler is not None:
+        flowAccAtPoints = filteredSampler.sample(xs, ys)
+        if footprint:
+            flowAccAtPoints = np.fmax(flowAccAtPoints,
+                                      flowAccSampler.sampleFocalMaximum(xs, ys, footprint, bufferRadius))
+    elif footprint is None:
+        flowAccAtPoints = flowAccSampler.sample(xs, ys)
+    else:
+        flowAccAtPoints = flowAccSampler.sampleFocalMaximum(xs, ys, footprint, bufferRadius)
+    flowAccAtPoints *= cellSize  # gives us the total area of flow accumulation, rather than just the number of cells
+    flowAccAtPoints /= 1000000  # converts from square meters to square kilometers
+    flowAccAtPoints[np.isnan(flowAccAtPoints) | (flowAccAtPoints < 0)] = 0
+    return flowAccAtPoints
+
+
+def findWidth(flowAccAtPoint, precip):
+    """
+    Estimates the width of a reach, based on its drainage area and precipitation levels. Works on single values or on
+    arrays of reaches
+    :param flowAccAtPoint: A float with flow accumulation at a point
+    :param precip: A float with the precipitation at a point
+    :return: Estimated width
+    """
+    width = 0.177 * (flowAccAtPoint ** 0.397) * (precip ** 0.453)  # This is the equation we're using to estimate width
+    width = np.where(width < .3, .3, width)  # establishes a minimum width value
+    if width.ndim == 0:
+        return float(width)
+    return width
+
+
+def findSlopes(lengths, firstPointElevations, secondPointElevations):
+    """
+    Finds the average slope of every reach at once
+    :param lengths: An array with the length of every reach
+    :param firstPointElevations: An array with the elevation at the first point of every reach
+    :param secondPointElevations: An array with the elevation at the last point of every reach
+    :return: An array of slopes
+    """
+    elevationDifferences = np.abs(firstPointElevations - secondPointElevations)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return elevationDifferences/lengths
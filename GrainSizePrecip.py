@@ -0,0 +1,253 @@
+########################################################################################################################
+# Name: Grain Size Precipitation Index
+# Purpose: Finds which precipitation polygon a point falls in, for many points at once. The polygons are loaded a single
+# time into a uniform grid, so each point is only tested against the few polygons whose bounding boxes overlap its grid
+# cell, rather than intersecting the point with the whole precipitation layer.
+########################################################################################################################
+
+import numpy as np
+from timeit import default_timer as timer
+
+MAX_BLOCK_ELEMENTS = 2 ** 20  # point and edge pairs tested at once. Each temporary array is 8 MB at most
+MIN_POINTS_PER_BAND = 256
+
+
+class PrecipitationIndex(object):
+    def __init__(self, polygons, values, tolerance=1e-9):
+        """
+        :param polygons: A list of polygons. Each polygon is a list of rings, and each ring is an (n, 2) array of x, y
+        vertices. Holes are just more rings, since we use the even-odd rule
+        :param values: The attribute value of each polygon
+        :param tolerance: How close to an edge a point has to be to count as on the boundary, in map units
+        """
+        self.values = np.asarray(values, dtype=np.float64)
+        self.tolerance = tolerance
+        self.numPolygons = len(polygons)
+
+        """Every polygon's edges are stored as one block of start and end coordinates"""
+        edgeStarts = []
+        edgeEnds = []
+        self.edgeOffsets = np.zeros(self.numPolygons + 1, dtype=np.int64)
+        self.boundingBoxes = np.zeros((self.numPolygons, 4))
+        for i, rings in enumerate(polygons):
+            numEdges = 0
+            for ring in rings:
+                ring = np.asarray(ring, dtype=np.float64)
+                if len(ring) < 2:
+                    continue
+                edgeStarts.append(ring)
+                edgeEnds.append(np.roll(ring, -1, axis=0))  # closes the ring, whether or not it repeats its first point
+                numEdges += len(ring)
+            self.edgeOffsets[i + 1] = self.edgeOffsets[i] + numEdges
+            if numEdges > 0:
+                vertices = np.concatenate([np.asarray(ring, dtype=np.float64) for ring in rings if len(ring) >= 2])
+                self.boundingBoxes[i] = (vertices[:, 0].min(), vertices[:, 1].min(),
+                                         vertices[:, 0].max(), vertices[:, 1].max())
+            else:
+                self.boundingBoxes[i] = (np.inf, np.inf, -np.inf, -np.inf)
+        if edgeStarts:
+            self.edgeStarts = np.concatenate(edgeStarts)
+            self.edgeEnds = np.concatenate(edgeEnds)
+        else:
+            self.edgeStarts = np.zeros((0, 2))
+            self.edgeEnds = np.zeros((0, 2))
+        self.edgeYMins = np.minimum(self.edgeStarts[:, 1], self.edgeEnds[:, 1])
+        self.edgeYMaxs = np.maximum(self.edgeStarts[:, 1], self.edgeEnds[:, 1])
+
+        self._buildGrid()
+
+    @classmethod
+    def fromFeatureClass(cls, precipMap, field="Inches", backend=None):
+        """
+        Loads every polygon in a feature class that ArcGIS can read
+        :param precipMap: A feature class that has precipitation data in its polygons
+        :param field: The field with the value we want
+        :param backend: An optional backend from GrainSizeBackends to read the polygons with. Defaults to arcpy
+        :return: A PrecipitationIndex
+        """
+        if backend is not None:
+            polygons, values = backend.readPolygons(precipMap, field)
+        else:
+            polygons, values = readPolygons(precipMap, field)
+        return cls(polygons, [value if value is not None else np.nan for value in values])
+
+    def _buildGrid(self):
+        """Puts each polygon in every grid cell that its bounding box touches"""
+        valid = np.isfinite(self.boundingBoxes).all(axis=1)
+        if not valid.any():
+            self.gridXMin, self.gridYMin, self.gridCellSize, self.gridCols, self.gridRows = 0.0, 0.0, 1.0, 1, 1
+            self.grid = {}
+            return
+        xMin, yMin = self.boundingBoxes[valid, 0].min(), self.boundingBoxes[valid, 1].min()
+        xMax, yMax = self.boundingBoxes[valid, 2].max(), self.boundingBoxes[valid, 3].max()
+
+        """Roughly one polygon per grid cell"""
+        area = max((xMax - xMin) * (yMax - yMin), 1e-12)
+        self.gridCellSize = max(np.sqrt(area / max(valid.sum(), 1)), 1e-9)
+        self.gridXMin = xMin
+        self.gridYMin = yMin
+        self.gridCols = int(np.floor((xMax - xMin) / self.gridCellSize)) + 1
+        self.gridRows = int(np.floor((yMax - yMin) / self.gridCellSize)) + 1
+
+        self.grid = {}
+        for i in np.nonzero(valid)[0]:
+            firstCol, firstRow = self._gridCell(self.boundingBoxes[i, 0] - self.tolerance,
+                                                self.boundingBoxes[i, 1] - self.tolerance)
+            lastCol, lastRow = self._gridCell(self.boundingBoxes[i, 2] + self.tolerance,
+                                              self.boundingBoxes[i, 3] + self.tolerance)
+            for col in range(firstCol, lastCol + 1):
+                for row in range(firstRow, lastRow + 1):
+                    self.grid.setdefault(row * self.gridCols + col, []).append(i)
+
+    def _gridCell(self, x, y):
+        col = int(np.clip(np.floor((x - self.gridXMin) / self.gridCellSize), 0, self.gridCols - 1))
+        row = int(np.clip(np.floor((y - self.gridYMin) / self.gridCellSize), 0, self.gridRows - 1))
+        return col, row
+
+    def findPolygons(self, xs, ys, pointSeconds=None):
+        """
+        Finds the polygon that each point falls in. A point on the boundary between polygons (within the tolerance)
+        goes to whichever of them comes first in the layer
+        :param xs: An array of x coordinates
+        :param ys: An array of y coordinates
+        :param pointSeconds: An optional float array, one value per point, that the time spent testing each point
+        against polygons is added to. A point in a polygon with many vertices costs more than one in a simple polygon
+        :return: An integer array with the index of each point's polygon, or -1 where the point misses every polygon
+        """
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        polygonIds = np.full(xs.shape, -1, dtype=np.int64)
+        if len(xs) == 0 or not self.grid:
+            return polygonIds
+
+        cols = np.floor((xs - self.gridXMin) / self.gridCellSize)
+        rows = np.floor((ys - self.gridYMin) / self.gridCellSize)
+        inGrid = (cols >= 0) & (cols < self.gridCols) & (rows >= 0) & (rows < self.gridRows)
+        cellIds = np.where(inGrid, rows * self.gridCols + cols, -1).astype(np.int64)
+
+        """Points in the same grid cell share their candidate polygons, so we handle them together"""
+        order = np.argsort(cellIds, kind="mergesort")
+        sortedCells = cellIds[order]
+        boundaries = np.nonzero(np.diff(sortedCells))[0] + 1
+        for group in np.split(order, boundaries):
+            cellId = cellIds[group[0]]
+            if cellId < 0:
+                continue
+            for polygonId in self.grid.get(int(cellId), ()):
+                unassigned = group[polygonIds[group] < 0]
+                if len(unassigned) == 0:
+                    break
+                box = self.boundingBoxes[polygonId]
+                nearBox = ((xs[unassigned] >= box[0] - self.tolerance) & (xs[unassigned] <= box[2] + self.tolerance) &
+                           (ys[unassigned] >= box[1] - self.tolerance) & (ys[unassigned] <= box[3] + self.tolerance))
+                candidates = unassigned[nearBox]
+                if len(candidates) == 0:
+                    continue
+                start = timer()
+                inside = self._containsPoints(polygonId, xs[candidates], ys[candidates])
+                polygonIds[candidates[inside]] = polygonId
+                if pointSeconds is not None:
+                    pointSeconds[candidates] += (timer() - start) / len(candidates)
+
+        return polygonIds
+
+    def _containsPoints(self, polygonId, xs, ys):
+        """
+        Even-odd ray casting, where points within the tolerance of an edge count as inside. Points are sorted by y and
+        taken in bands, and each band is only tested against the edges that reach within the tolerance of it, at most
+        MAX_BLOCK_ELEMENTS point and edge pairs at a time. That keeps polygons with thousands of vertices from needing
+        temporaries the size of every point times every edge
+        """
+        start, end = self.edgeOffsets[polygonId], self.edgeOffsets[polygonId + 1]
+        crossings = np.zeros(len(xs), dtype=np.int64)
+        onBoundary = np.zeros(len(xs), dtype=bool)
+        if end == start:
+            return onBoundary
+        order = np.argsort(ys, kind="mergesort")
+        pointsPerBand = max(MAX_BLOCK_ELEMENTS // (end - start), MIN_POINTS_PER_BAND)
+        for firstPoint in range(0, len(order), pointsPerBand):
+            points = order[firstPoint:firstPoint + pointsPerBand]
+            bandYMin, bandYMax = ys[points[0]] - self.tolerance, ys[points[-1]] + self.tolerance
+            edges = start + np.flatnonzero((self.edgeYMaxs[start:end] >= bandYMin) &
+                                           (self.edgeYMins[start:end] <= bandYMax))
+            edgesPerBlock = max(MAX_BLOCK_ELEMENTS // len(points), 1)
+            for firstEdge in range(0, len(edges), edgesPerBlock):
+                blockCrossings, blockOnBoundary = self._testEdges(edges[firstEdge:firstEdge + edgesPerBlock],
+                                                                  xs[points], ys[points])
+                crossings[points] += blockCrossings
+                onBoundary[points] |= blockOnBoundary
+        return (crossings % 2 == 1) | onBoundary
+
+    def _testEdges(self, edges, xs, ys):
+        """
+        :param edges: An array of indices into self.edgeStarts and self.edgeEnds
+        :return: How many of the edges a ray east from each point crosses, and whether each point is within the
+        tolerance of any of them
+        """
+        x0 = self.edgeStarts[edges, 0][np.newaxis, :]
+        y0 = self.edgeStarts[edges, 1][np.newaxis, :]
+        x1 = self.edgeEnds[edges, 0][np.newaxis, :]
+        y1 = self.edgeEnds[edges, 1][np.newaxis, :]
+        px = xs[:, np.newaxis]
+        py = ys[:, np.newaxis]
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            straddles = (y0 > py) != (y1 > py)
+            crossingX = x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+            crossings = np.count_nonzero(straddles & (px < crossingX), axis=1)
+
+            """Distance from each point to each edge, to catch points sitting on the boundary"""
+            dx = x1 - x0
+            dy = y1 - y0
+            lengthSquared = dx * dx + dy * dy
+            t = np.where(lengthSquared > 0, ((px - x0) * dx + (py - y0) * dy) / lengthSquared, 0.0)
+            t = np.clip(t, 0.0, 1.0)
+            distanceSquared = (px - (x0 + t * dx)) ** 2 + (py - (y0 + t * dy)) ** 2
+        onBoundary = (distanceSquared <= self.tolerance ** 2).any(axis=1)
+        return crossings, onBoundary
+
+    def query(self, xs, ys, missingValue=np.nan, pointSeconds=None):
+        """
+        Finds the attribute value of the polygon each point falls in
+        :param xs: An array of x coordinates
+        :param ys: An array of y coordinates
+        :param missingValue: What to give points that miss every polygon
+        :param pointSeconds: An optional float array that the time spent on each point is added to. See findPolygons()
+        :return: A float array of values
+        """
+        polygonIds = self.findPolygons(xs, ys, pointSeconds)
+        values = np.full(polygonIds.shape, missingValue, dtype=np.float64)
+        found = polygonIds >= 0
+        values[found] = self.values[polygonIds[found]]
+        return values
+
+
+def readPolygons(featureClass, field):
+    """
+    Reads every polygon in a feature class that ArcGIS can read
+    :param featureClass: A polygon feature class
+    :param field: The field to read alongside each polygon
+    :return: A list of polygons, each a list of rings of (x, y) vertices, and a list with each polygon's value in the
+    field, as ArcGIS gives it
+    """
+    import arcpy
+
+    polygons = []
+    values = []
+    searchCursor = arcpy.da.SearchCursor(featureClass, ["SHAPE@", field])
+    for row in searchCursor:
+        rings = []
+        if row[0] is not None:
+            for part in row[0]:
+                ring = []
+                for point in part:
+                    if point is None:  # ArcGIS puts a None between the outer ring and each hole
+                        rings.append(ring)
+                        ring = []
+                    else:
+                        ring.append((point.X, point.Y))
+                rings.append(ring)
+        polygons.append(rings)
+        values.append(row[1])
+    del searchCursor
+    return polygons, values
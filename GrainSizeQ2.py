@@ -0,0 +1,118 @@
+########################################################################################################################
+# Name: Grain Size Q_2 Regions
+# Purpose: Holds the regional regression equations we use to estimate the two year flood. Each region is just a
+# coefficient and an exponent for every variable, so the equations are read from a data file (Q2Regions.csv by default)
+# and new regions can be added without touching the code. Q_2 is evaluated for every reach at once.
+########################################################################################################################
+
+import csv
+import os
+import numpy as np
+
+DEFAULT_REGIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Q2Regions.csv")
+CUBIC_FEET_PER_CUBIC_METER = 35.3147
+
+
+class Q2Equation(object):
+    def __init__(self, region, coefficient, areaExponent, elevationExponent=0.0, precipExponent=0.0,
+                 temperatureExponent=0.0):
+        """
+        Q_2 = coefficient * A^areaExponent * (E / 1000)^elevationExponent * P^precipExponent * (T + 273)^temperatureExponent
+        :param region: The region number that identifies this equation
+        :param coefficient: The leading coefficient
+        :param areaExponent: The exponent on drainage area
+        :param elevationExponent: The exponent on elevation, in thousands
+        :param precipExponent: The exponent on precipitation
+        :param temperatureExponent: The exponent on the minimum January temperature, in Kelvin
+        """
+        self.region = region
+        self.coefficient = coefficient
+        self.areaExponent = areaExponent
+        self.elevationExponent = elevationExponent
+        self.precipExponent = precipExponent
+        self.temperatureExponent = temperatureExponent
+
+    @property
+    def needsTemperature(self):
+        return self.temperatureExponent != 0
+
+    def evaluate(self, flowAccumulation, elevation, precip, minJanTemp=None):
+        """
+        Finds Q_2 for one reach or for arrays of reaches
+        :param flowAccumulation: The drainage area
+        :param elevation: The elevation
+        :param precip: The precipitation
+        :param minJanTemp: The minimum January temperature, in Celsius. Only needed if the equation uses it
+        :return: Q_2, in cubic meters per second
+        """
+        """The factors are always multiplied in the same order, so we get the same answer as the old equations did"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            q_2 = self.coefficient * (flowAccumulation ** self.areaExponent)
+            if self.elevationExponent != 0:
+                q_2 = q_2 * ((elevation / 1000) ** self.elevationExponent)
+            if self.precipExponent != 0:
+                q_2 = q_2 * (precip ** self.precipExponent)
+            if self.temperatureExponent != 0:
+                if minJanTemp is None:
+                    raise ValueError("The Q_2 equation for region " + str(self.region) + " needs a temperature")
+                q_2 = q_2 * ((minJanTemp + 273) ** self.temperatureExponent)
+
+            q_2 /= CUBIC_FEET_PER_CUBIC_METER  # converts from cubic feet to cubic meters
+        return q_2
+
+
+class Q2Registry(object):
+    def __init__(self, equations=None):
+        self.equations = {}
+        for equation in equations or []:
+            self.add(equation)
+
+    @classmethod
+    def fromFile(cls, path=DEFAULT_REGIONS_FILE):
+        """
+        Reads equations from a CSV file with the columns region, coefficient, areaExponent, elevationExponent,
+        precipExponent and temperatureExponent. Lines starting with # are comments
+        :param path: The path to the CSV file
+        :return: A Q2Registry
+        """
+        registry = cls()
+        with open(path) as regionsFile:
+            lines = [line for line in regionsFile if line.strip() and not line.lstrip().startswith("#")]
+        for row in csv.DictReader(lines):
+            registry.add(Q2Equation(int(row["region"]),
+                                    float(row["coefficient"]),
+                                    float(row["areaExponent"]),
+                                    float(row.get("elevationExponent") or 0),
+                                    float(row.get("precipExponent") or 0),
+                                    float(row.get("temperatureExponent") or 0)))
+        return registry
+
+    def add(self, equation):
+        """Adds an equation, replacing any that already uses its region number"""
+        self.equations[equation.region] = equation
+
+    def __contains__(self, regionNumber):
+        return regionNumber in self.equations
+
+    def __getitem__(self, regionNumber):
+        if regionNumber not in self.equations:
+            raise KeyError("There is no Q_2 equation for region " + str(regionNumber))
+        return self.equations[regionNumber]
+
+    def regions(self):
+        return sorted(self.equations)
+
+    def evaluate(self, regionNumber, flowAccumulation, elevation, precip, minJanTemp=None):
+        """Finds Q_2 with the equation for a region. See Q2Equation.evaluate()"""
+        return self[regionNumber].evaluate(flowAccumulation, elevation, precip, minJanTemp)
+
+
+_defaultRegistry = None
+
+
+def getDefaultRegistry():
+    """Returns the registry read from Q2Regions.csv, only reading it the first time"""
+    global _defaultRegistry
+    if _defaultRegistry is None:
+        _defaultRegistry = Q2Registry.fromFile(DEFAULT_REGIONS_FILE)
+    return _defaultRegistry
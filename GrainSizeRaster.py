@@ -0,0 +1,298 @@
+########################################################################################################################
+# Name: Grain Size Raster Sampling
+# Purpose: Reads raster values at many points at once. The raster is loaded a single time as a NumPy array (or as a
+# window of it that covers the points we care about), and every point is then sampled in one vectorized call, rather
+# than writing each point to a shapefile and running Extract Values to Points on it.
+########################################################################################################################
+
+import json
+import numpy as np
+
+NEAREST = "nearest"
+BILINEAR = "bilinear"
+
+
+class RasterSampler(object):
+    def __init__(self, array, xMin, yMax, cellWidth, cellHeight, noData=None):
+        """
+        :param array: A 2D NumPy array with the raster values. Row 0 is the northernmost row
+        :param xMin: The x coordinate of the left edge of the array
+        :param yMax: The y coordinate of the top edge of the array
+        :param cellWidth: The width of a cell, in map units
+        :param cellHeight: The height of a cell, in map units
+        :param noData: The value that marks a cell as having no data. NaN cells are always treated as no data
+        """
+        self.array = array
+        self.xMin = float(xMin)
+        self.yMax = float(yMax)
+        self.cellWidth = float(cellWidth)
+        self.cellHeight = float(cellHeight)
+        self.noData = noData
+
+    @property
+    def numRows(self):
+        return self.array.shape[0]
+
+    @property
+    def numCols(self):
+        return self.array.shape[1]
+
+    @property
+    def cellSize(self):
+        """The area of a single cell"""
+        return self.cellWidth * self.cellHeight
+
+    @classmethod
+    def fromRaster(cls, raster, extent=None, margin=1):
+        """
+        Loads a raster that ArcGIS can read into a sampler
+        :param raster: The path to a raster, or an arcpy Raster object
+        :param extent: Optional (xMin, yMin, xMax, yMax). If given, only the window of cells that covers it is read
+        :param margin: How many cells to pad the window by on each side
+        :return: A RasterSampler
+        """
+        import arcpy
+
+        if not isinstance(raster, arcpy.Raster):
+            raster = arcpy.Raster(raster)
+        cellWidth = raster.meanCellWidth
+        cellHeight = raster.meanCellHeight
+        noData = raster.noDataValue
+
+        firstRow, firstCol = 0, 0
+        lastRow, lastCol = raster.height, raster.width
+        if extent is not None:
+            firstRow, firstCol, lastRow, lastCol = windowForExtent(extent, raster.extent.XMin, raster.extent.YMax,
+                                                                   cellWidth, cellHeight, raster.height, raster.width,
+                                                                   margin)
+        xMin = raster.extent.XMin + firstCol * cellWidth
+        yMax = raster.extent.YMax - firstRow * cellHeight
+
+        """We nudge the corner a quarter of a cell inwards so ArcGIS can't snap it to the neighbouring cell"""
+        lowerLeft = arcpy.Point(xMin + cellWidth / 4.0, yMax - (lastRow - firstRow) * cellHeight + cellHeight / 4.0)
+        if noData is None:
+            array = arcpy.RasterToNumPyArray(raster, lowerLeft, lastCol - firstCol, lastRow - firstRow)
+        else:
+            array = arcpy.RasterToNumPyArray(raster, lowerLeft, lastCol - firstCol, lastRow - firstRow, noData)
+
+        return cls(array, xMin, yMax, cellWidth, cellHeight, noData)
+
+    def save(self, path):
+        """
+        Saves the sampler as a .npy file, plus a .json file next to it with where the array sits on the map
+        :param path: The path to the .npy file
+        :return: None
+        """
+        np.save(path, np.ascontiguousarray(self.array))
+        with open(path + ".json", "w") as metadataFile:
+            json.dump({"xMin": self.xMin, "yMax": self.yMax, "cellWidth": self.cellWidth,
+                       "cellHeight": self.cellHeight,
+                       "noData": None if self.noData is None else float(self.noData)}, metadataFile)
+
+    @classmethod
+    def load(cls, path, memoryMap=True):
+        """
+        Loads a sampler saved by save()
+        :param path: The path to the .npy file
+        :param memoryMap: If True, the array stays on disk and is only read as it is used
+        :return: A RasterSampler
+        """
+        with open(path + ".json") as metadataFile:
+            metadata = json.load(metadataFile)
+        array = np.load(path, mmap_mode="r" if memoryMap else None)
+        return cls(array, metadata["xMin"], metadata["yMax"], metadata["cellWidth"], metadata["cellHeight"],
+                   metadata["noData"])
+
+    def window(self, extent, margin=1):
+        """
+        Returns a sampler over only the cells that cover an extent. The array is a view, so nothing is copied
+        :param extent: (xMin, yMin, xMax, yMax) of the area we want
+        :param margin: How many cells to pad the window by on each side
+        :return: A RasterSampler
+        """
+        firstRow, firstCol, lastRow, lastCol = windowForExtent(extent, self.xMin, self.yMax, self.cellWidth,
+                                                               self.cellHeight, self.numRows, self.numCols, margin)
+        return RasterSampler(self.array[firstRow:lastRow, firstCol:lastCol],
+                             self.xMin + firstCol * self.cellWidth, self.yMax - firstRow * self.cellHeight,
+                             self.cellWidth, self.cellHeight, self.noData)
+
+    def cellIndices(self, xs, ys):
+        """
+        Finds the row and column of the cell that contains each point
+        :param xs: An array of x coordinates
+        :param ys: An array of y coordinates
+        :return: Two integer arrays, the rows and the columns. They may fall outside the raster
+        """
+        cols = np.floor((np.asarray(xs, dtype=np.float64) - self.xMin) / self.cellWidth).astype(np.int64)
+        rows = np.floor((self.yMax - np.asarray(ys, dtype=np.float64)) / self.cellHeight).astype(np.int64)
+        return rows, cols
+
+    def cellValues(self, rows, cols):
+        """
+        Reads the value of individual cells
+        :param rows: An integer array of rows
+        :param cols: An integer array of columns, the same length as rows
+        :return: A float array, with NaN for cells that are outside the raster or have no data
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        values = np.full(rows.shape, np.nan)
+        inside = (rows >= 0) & (rows < self.numRows) & (cols >= 0) & (cols < self.numCols)
+        values[inside] = self.array[rows[inside], cols[inside]]
+        if self.noData is not None:
+            values[values == self.noData] = np.nan
+        return values
+
+    def sample(self, xs, ys, method=NEAREST):
+        """
+        Finds the value of the raster at every point
+        :param xs: An array of x coordinates
+        :param ys: An array of y coordinates
+        :param method: NEAREST takes the value of the cell the point is in. BILINEAR interpolates between the centers of
+        the four closest cells, ignoring any of them that have no data
+        :return: A float array of values, with NaN where there is no data
+        """
+        if method == NEAREST:
+            rows, cols = self.cellIndices(xs, ys)
+            return self.cellValues(rows, cols)
+        elif method == BILINEAR:
+            return self._sampleBilinear(np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+        else:
+            raise ValueError("Unknown interpolation method: " + str(method))
+
+    def sampleFocalMaximum(self, xs, ys, footprint, radius=None):
+        """
+        Finds the largest value among the cells of a footprint around the cell each point is in. This only reads the
+        cells it needs, so it suits rasters that are too big to filter as a whole with focalMaximum()
+        :param xs: An array of x coordinates
+        :param ys: An array of y coordinates
+        :param footprint: A list of (row offset, column offset) tuples, like the ones made by pointFootprint()
+        :param radius: If given, a cell of the footprint only counts for a point if the cell's center is within this
+        distance of the point itself, rather than of the center of the point's cell. The point's own cell always counts
+        :return: A float array of values, with NaN where no cell in the footprint has data
+        """
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        rows, cols = self.cellIndices(xs, ys)
+        maximum = np.full(rows.shape, np.nan)
+        for rowOffset, colOffset in footprint:
+            values = self.cellValues(rows + rowOffset, cols + colOffset)
+            if radius is not None and (rowOffset, colOffset) != (0, 0):
+                centerXs = self.xMin + (cols + colOffset + 0.5) * self.cellWidth
+                centerYs = self.yMax - (rows + rowOffset + 0.5) * self.cellHeight
+                values[(centerXs - xs) ** 2 + (centerYs - ys) ** 2 > radius ** 2] = np.nan
+            maximum = np.fmax(maximum, values)
+        return maximum
+
+    def _sampleBilinear(self, xs, ys):
+        """Bilinear interpolation between cell centers. Points outside the raster come back as NaN"""
+        colPositions = (xs - self.xMin) / self.cellWidth
+        rowPositions = (self.yMax - ys) / self.cellHeight
+        outside = ((colPositions < 0) | (colPositions >= self.numCols) |
+                   (rowPositions < 0) | (rowPositions >= self.numRows))
+
+        """Positions relative to cell centers, clamped so points near the edge use the edge cells"""
+        colPositions = np.clip(colPositions - 0.5, 0, self.numCols - 1)
+        rowPositions = np.clip(rowPositions - 0.5, 0, self.numRows - 1)
+        col0 = np.minimum(np.floor(colPositions).astype(np.int64), max(self.numCols - 2, 0))
+        row0 = np.minimum(np.floor(rowPositions).astype(np.int64), max(self.numRows - 2, 0))
+        col1 = np.minimum(col0 + 1, self.numCols - 1)
+        row1 = np.minimum(row0 + 1, self.numRows - 1)
+        colWeight = colPositions - col0
+        rowWeight = rowPositions - row0
+
+        total = np.zeros(xs.shape)
+        weights = np.zeros(xs.shape)
+        for rows, cols, weight in ((row0, col0, (1 - rowWeight) * (1 - colWeight)),
+                                   (row0, col1, (1 - rowWeight) * colWeight),
+                                   (row1, col0, rowWeight * (1 - colWeight)),
+                                   (row1, col1, rowWeight * colWeight)):
+            values = self.cellValues(rows, cols)
+            valid = ~np.isnan(values)
+            total[valid] += values[valid] * weight[valid]
+            weights[valid] += weight[valid]
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result = total / weights
+        result[(weights == 0) | outside] = np.nan
+        return result
+
+
+def windowForExtent(extent, xMin, yMax, cellWidth, cellHeight, numRows, numCols, margin=1):
+    """
+    Finds the block of cells that covers an extent, padded by a margin of cells so interpolation has neighbours
+    :param extent: (xMin, yMin, xMax, yMax) of the area we want
+    :return: (firstRow, firstCol, lastRow, lastCol), with the last row and column being exclusive
+    """
+    extentXMin, extentYMin, extentXMax, extentYMax = extent
+    firstCol = int(np.floor((extentXMin - xMin) / cellWidth)) - margin
+    lastCol = int(np.floor((extentXMax - xMin) / cellWidth)) + 1 + margin
+    firstRow = int(np.floor((yMax - extentYMax) / cellHeight)) - margin
+    lastRow = int(np.floor((yMax - extentYMin) / cellHeight)) + 1 + margin
+    firstRow, lastRow = max(firstRow, 0), min(lastRow, numRows)
+    firstCol, lastCol = max(firstCol, 0), min(lastCol, numCols)
+    if firstRow >= lastRow or firstCol >= lastCol:
+        return 0, 0, numRows, numCols  # the extent misses the raster, so just read the whole thing
+    return firstRow, firstCol, lastRow, lastCol
+
+
+def pointExtent(xs, ys):
+    """Returns the (xMin, yMin, xMax, yMax) bounding box of a set of points"""
+    return float(np.min(xs)), float(np.min(ys)), float(np.max(xs)), float(np.max(ys))
+
+
+def pointFootprint(radius, cellWidth, cellHeight=None):
+    """
+    Splits the cells around a point by whether their centers are within a radius of it. Cells in the core are within
+    the radius wherever the point is in its cell, so they can be filtered for the whole raster at once with
+    focalMaximum(). Cells in the fringe are within it for some points in the cell but not others, so they have to be
+    checked for each point with RasterSampler.sampleFocalMaximum()
+    :param radius: The radius of the circle, in map units
+    :param cellWidth: The width of a cell, in map units
+    :param cellHeight: The height of a cell. Defaults to the width
+    :return: Two lists of (row offset, column offset) tuples, the core, which always includes (0, 0), and the fringe
+    """
+    if cellHeight is None:
+        cellHeight = cellWidth
+    maxRowOffset = int(np.floor(radius / cellHeight + 0.5))
+    maxColOffset = int(np.floor(radius / cellWidth + 0.5))
+    core = []
+    fringe = []
+    for rowOffset in range(-maxRowOffset, maxRowOffset + 1):
+        for colOffset in range(-maxColOffset, maxColOffset + 1):
+            """The farthest and nearest a point in the middle cell can be from this cell's center"""
+            farthest = ((abs(rowOffset) + 0.5) * cellHeight) ** 2 + ((abs(colOffset) + 0.5) * cellWidth) ** 2
+            nearest = (max(abs(rowOffset) - 0.5, 0) * cellHeight) ** 2 + (max(abs(colOffset) - 0.5, 0) * cellWidth) ** 2
+            if farthest <= radius ** 2 or (rowOffset, colOffset) == (0, 0):
+                core.append((rowOffset, colOffset))
+            elif nearest <= radius ** 2:
+                fringe.append((rowOffset, colOffset))
+    return core, fringe
+
+
+def focalMaximum(sampler, footprint):
+    """
+    Finds, for every cell, the largest value among the cells of the footprint around it. Cells with no data are ignored
+    :param sampler: A RasterSampler with the raster we want to filter
+    :param footprint: A list of (row offset, column offset) tuples, like the core from pointFootprint()
+    :return: A new RasterSampler with the same extent, holding the maximum values. Cells with no data anywhere in their
+    footprint are NaN
+    """
+    values = sampler.array.astype(np.float64)
+    if sampler.noData is not None:
+        values[values == sampler.noData] = -np.inf
+    values[np.isnan(values)] = -np.inf
+
+    numRows, numCols = values.shape
+    maximum = np.full(values.shape, -np.inf)
+    for rowOffset, colOffset in footprint:
+        """Each cell (row, col) looks at (row + rowOffset, col + colOffset), so we compare two shifted windows"""
+        targetRows = slice(max(0, -rowOffset), min(numRows, numRows - rowOffset))
+        targetCols = slice(max(0, -colOffset), min(numCols, numCols - colOffset))
+        sourceRows = slice(max(0, rowOffset), min(numRows, numRows + rowOffset))
+        sourceCols = slice(max(0, colOffset), min(numCols, numCols + colOffset))
+        np.maximum(maximum[targetRows, targetCols], values[sourceRows, sourceCols],
+                   out=maximum[targetRows, targetCols])
+
+    maximum[np.isinf(maximum)] = np.nan
+    return RasterSampler(maximum, sampler.xMin, sampler.yMax, sampler.cellWidth, sampler.cellHeight)
@@ -1,4 +1,110 @@
+import numpy as np
+
+
+def calculateGrainSizes(n, t_c, q_2, width, slope):
+    """
+    The Snyder et al. (2013) grain size equation. Works on single values or on whole arrays of reaches
+    :param n: Our Manning coefficient
+    :param t_c: Our Shields critical value
+    :param q_2: The flow at a 2 year flood
+    :param width: The average width of the reach
+    :param slope: The average slope of the reach
+    :return: The grain size, in millimeters
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        grainSize = (n**.6) * (q_2**.6) * (width**-.6) * (slope ** .7)
+        grainSize /= t_c
+        grainSize /= 1.65
+        grainSize *= 1000 # converts to millimeters
+    return grainSize
+
+
+def calculateT_cs(n, q_2, width, slope, grainSize):
+    """
+    The grain size equation solved for t_c, given a known grain size. Works on single values or on whole arrays
+    :param n: Our Manning coefficient
+    :param q_2: The flow at a 2 year flood
+    :param width: The average width of the reach
+    :param slope: The average slope of the reach
+    :param grainSize: The grain size, in millimeters
+    :return: t_c
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t_c = (n**.6) * (q_2**.6) * (width**-.6) * (slope ** .7)
+        t_c /= 1.65
+        t_c *= 1000
+        t_c /= grainSize
+    return t_c
+
+
+class ReachTable(object):
+    def __init__(self, width, q_2, slope, polylines=None, featureIds=None):
+        """
+        Holds every reach in the stream network as columns, rather than as one object per reach
+        :param width: An array with the average width of each reach
+        :param q_2: An array with the flow at a 2 year flood of each reach
+        :param slope: An array with the average slope of each reach
+        :param polylines: A list with the polyline of each reach. We only keep a reference to it
+        :param featureIds: An array with the ID of each reach in the stream network. Defaults to 0, 1, 2...
+        """
+        self.width = np.array(width, dtype=np.float64, ndmin=1)
+        self.q_2 = np.array(q_2, dtype=np.float64, ndmin=1)
+        self.slope = np.array(slope, dtype=np.float64, ndmin=1)
+        numReaches = len(self.width)
+        if len(self.q_2) != numReaches or len(self.slope) != numReaches:
+            raise ValueError("width, q_2 and slope must all have one value per reach")
+
+        self.polylines = polylines
+        if featureIds is None:
+            self.featureIds = np.arange(numReaches, dtype=np.int64)
+        else:
+            self.featureIds = np.array(featureIds, dtype=np.int64, ndmin=1)
+
+        self.grainSize = np.full(numReaches, -1.0)
+        self.t_c = np.full(numReaches, -1.0)
+        self.flowAccumulation = np.full(numReaches, -1.0)
+
+    @classmethod
+    def fromReaches(cls, reaches):
+        """Builds a table out of a list of Reach objects"""
+        reaches = list(reaches)
+        table = cls([reach.width for reach in reaches], [reach.q_2 for reach in reaches],
+                    [reach.slope for reach in reaches], [reach.polyline for reach in reaches])
+        table.grainSize[:] = [reach.grainSize for reach in reaches]
+        table.t_c[:] = [reach.t_c for reach in reaches]
+        table.flowAccumulation[:] = [reach.flowAccumulation for reach in reaches]
+        return table
+
+    def __len__(self):
+        return len(self.width)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("reach index out of range")
+        return Reach.fromTable(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield Reach.fromTable(self, index)
+
+    def calculateGrainSize(self, n, t_c):
+        """Finds the grain size of every reach at once"""
+        self.grainSize = calculateGrainSizes(n, t_c, self.q_2, self.width, self.slope)
+
+    def calculateT_c(self, n):
+        """Finds the t_c of every reach at once, using the grain sizes already in the table"""
+        self.t_c = calculateT_cs(n, self.q_2, self.width, self.slope, self.grainSize)
+
+
 class Reach(object):
+    """
+    A single reach. A reach that comes from a ReachTable is only a view of one row of it, so iterating a table doesn't
+    copy anything. A reach made on its own keeps its values in its own slots instead
+    """
+    __slots__ = ("table", "index", "_width", "_q_2", "_slope", "_grainSize", "_t_c", "_flowAccumulation", "_polyline")
+
     def __init__(self, width, q_2, slope, polyline):
         """
         :type width: The average width of the reach
@@ -7,26 +113,65 @@ class Reach(object):
         :type polyline: The complete polyline
         :type xyPosition: The x y position of the centroid of the polyline
         """
-        self.width = width
-        self.q_2 = q_2
-        self.slope = slope
-        self.polyline = polyline
+        self.table = None
+        self.index = 0
+        self._width = float(width)
+        self._q_2 = float(q_2)
+        self._slope = float(slope)
+        self._grainSize = -1.0
+        self._t_c = -1.0
+        self._flowAccumulation = -1.0
+        self._polyline = polyline
+
+    @classmethod
+    def fromTable(cls, table, index):
+        reach = cls.__new__(cls)
+        reach.table = table
+        reach.index = index
+        return reach
+
+    def _getColumn(name):
+        slot = "_" + name
+
+        def getter(self):
+            if self.table is None:
+                return getattr(self, slot)
+            return float(getattr(self.table, name)[self.index])
+
+        def setter(self, value):
+            if self.table is None:
+                setattr(self, slot, float(value))
+            else:
+                getattr(self.table, name)[self.index] = value
+        return property(getter, setter)
+
+    width = _getColumn("width")
+    q_2 = _getColumn("q_2")
+    slope = _getColumn("slope")
+    grainSize = _getColumn("grainSize")
+    t_c = _getColumn("t_c")
+    flowAccumulation = _getColumn("flowAccumulation")
+    del _getColumn
+
+    @property
+    def polyline(self):
+        if self.table is None:
+            return self._polyline
+        if self.table.polylines is None:
+            return None
+        return self.table.polylines[self.index]
 
-        self.grainSize = -1
-        self.t_c = -1
-        self.flowAccumulation = -1
+    @property
+    def featureId(self):
+        if self.table is None:
+            return 0
+        return int(self.table.featureIds[self.index])
 
     def calculateGrainSize(self, n, t_c):
-        self.grainSize = (n**.6) * (self.q_2**.6) * (self.width**-.6) * (self.slope ** .7)
-        self.grainSize /= t_c
-        self.grainSize /= 1.65
-        self.grainSize *= 1000 # converts to millimeters
+        self.grainSize = calculateGrainSizes(n, t_c, self.q_2, self.width, self.slope)
 
     def calculateT_c(self, n):
-        self.t_c = (n**.6) * (self.q_2**.6) * (self.width**-.6) * (self.slope ** .7)
-        self.t_c /= 1.65
-        self.t_c *= 1000
-        self.t_c /= self.grainSize
+        self.t_c = calculateT_cs(n, self.q_2, self.width, self.slope, self.grainSize)
 
     def setFlowAccumulation(self, flowAccumulation):
         self.flowAccumulation = flowAccumulation
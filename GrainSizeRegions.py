@@ -0,0 +1,156 @@
+########################################################################################################################
+# Name: Grain Size Regions
+# Purpose: Lets one run cover many regions, like every HUC10 in a state. Each reach is put in the region its first point
+# falls in, using the same grid of polygons as the precipitation map, so the stream network never has to be clipped.
+# Once the merged output is written, it is split into an output folder for each region, and a summary of every region
+# is written alongside it.
+########################################################################################################################
+
+import json
+import os
+import re
+import numpy as np
+from GrainSizeOutput import loadReaches, readGeoPackageGeometries, writeGeoPackage, writeResultsFile
+from GrainSizePrecip import PrecipitationIndex, readPolygons
+
+SUMMARY_FIELDS = ["region", "folder", "reaches", "meanGrainSize", "medianGrainSize", "minGrainSize", "maxGrainSize",
+                  "maxDrainageArea"]
+
+
+class RegionIndex(PrecipitationIndex):
+    def __init__(self, polygons, names, tolerance=1e-9):
+        """
+        Finds which region a point falls in. Polygons with the same name, like the parts of a HUC that was split, are
+        one region
+        :param polygons: A list of polygons, the same as for a PrecipitationIndex
+        :param names: The name of the region each polygon is part of
+        :param tolerance: How close to an edge a point has to be to count as on the boundary, in map units
+        """
+        names = [str(name) for name in names]
+        self.names = sorted(set(names))
+        regionNumbers = dict((name, i) for i, name in enumerate(self.names))
+        self.polygonRegions = np.array([regionNumbers[name] for name in names], dtype=np.int64)
+        super(RegionIndex, self).__init__(polygons, self.polygonRegions, tolerance)
+
+    @classmethod
+    def fromFeatureClass(cls, regions, field, backend=None):
+        """
+        Loads every region in a feature class that ArcGIS can read
+        :param regions: A feature class of region polygons, like HUC10 boundaries
+        :param field: The field with the name of each region, like its HUC code
+        :param backend: An optional backend from GrainSizeBackends to read the polygons with. Defaults to arcpy
+        :return: A RegionIndex
+        """
+        if backend is not None:
+            polygons, names = backend.readPolygons(regions, field)
+        else:
+            polygons, names = readPolygons(regions, field)
+        return cls(polygons, names)
+
+    def findRegions(self, xs, ys):
+        """
+        :param xs: An array of x coordinates
+        :param ys: An array of y coordinates
+        :return: An integer array with the number of each point's region in self.names, or -1 where the point misses
+        every region
+        """
+        polygonIds = self.findPolygons(xs, ys)
+        return np.where(polygonIds >= 0, self.polygonRegions[np.maximum(polygonIds, 0)], -1)
+
+
+def regionFolderName(name):
+    """Turns a region name into something safe to use as a folder name"""
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", name).strip(".") or "region"
+
+
+def regionFolderNames(names):
+    """
+    Makes a different folder name for every region. Names that come out the same once they're made safe, like "a/b"
+    and "a_b", or that only differ in case, get a number added to all but the first of them
+    :param names: The name of each region
+    :return: A list with the folder name of each region
+    """
+    folders = []
+    used = set()
+    for name in names:
+        base = regionFolderName(name)
+        folder = base
+        suffix = 2
+        while folder.lower() in used:  # Windows folder names ignore case
+            folder = base + "_" + str(suffix)
+            suffix += 1
+        used.add(folder.lower())
+        folders.append(folder)
+    return folders
+
+
+def writeRegionOutputs(outputDataPath, regionIds, names, srsId=None, srsWkt=None, attributes=None):
+    """
+    Splits the merged output of a run into a folder for each region, each with its own GrainSizeResults.bin and
+    GrainSize.gpkg. Only one region is in memory at a time
+    :param outputDataPath: The folder with the merged GrainSizeResults.bin and GrainSize.gpkg
+    :param regionIds: An array with the region number of each reach, in the order they were written
+    :param names: The name of each region
+    :param srsId: The EPSG code of the reaches' spatial reference, if it has one
+    :param srsWkt: The well known text of the spatial reference
+    :param attributes: An optional dictionary of values to keep with each region's results. Its name is added to it
+    :return: A list with a summary dictionary for each region, with the fields in SUMMARY_FIELDS
+    """
+    regionIds = np.asarray(regionIds, dtype=np.int64)
+    order = np.argsort(regionIds, kind="mergesort")
+    starts = np.searchsorted(regionIds[order], np.arange(len(names) + 1))
+    summaries = []
+    folders = regionFolderNames(names)
+    for regionNumber, name in enumerate(names):
+        rows = order[starts[regionNumber]:starts[regionNumber + 1]]
+        folder = folders[regionNumber]
+        summary = {"region": name, "folder": folder, "reaches": len(rows), "meanGrainSize": None,
+                   "medianGrainSize": None, "minGrainSize": None, "maxGrainSize": None, "maxDrainageArea": None}
+        summaries.append(summary)
+        if len(rows) == 0:
+            continue
+
+        reaches = loadReaches(os.path.join(outputDataPath, "GrainSizeResults.bin"), rows)
+        regionFolder = os.path.join(outputDataPath, "regions", folder)
+        if not os.path.exists(regionFolder):
+            os.makedirs(regionFolder)
+        regionAttributes = dict(attributes or {}, region=name)
+        writeResultsFile(os.path.join(regionFolder, "GrainSizeResults.bin"), reaches, regionAttributes)
+        geometries, envelopes = readGeoPackageGeometries(os.path.join(outputDataPath, "GrainSize.gpkg"), rows + 1)
+        writeGeoPackage(os.path.join(regionFolder, "GrainSize.gpkg"), reaches, geometries, srsId=srsId, srsWkt=srsWkt,
+                        envelopes=None if np.isnan(envelopes).all() else envelopes)
+
+        grainSizes = reaches.grainSize[np.isfinite(reaches.grainSize)]
+        if len(grainSizes) > 0:
+            summary.update({"meanGrainSize": float(grainSizes.mean()),
+                            "medianGrainSize": float(np.median(grainSizes)),
+                            "minGrainSize": float(grainSizes.min()),
+                            "maxGrainSize": float(grainSizes.max())})
+        drainageAreas = reaches.flowAccumulation[np.isfinite(reaches.flowAccumulation)]
+        if len(drainageAreas) > 0:
+            summary["maxDrainageArea"] = float(drainageAreas.max())
+    return summaries
+
+
+def writeRegionSummary(path, summaries, runSummary=None):
+    """
+    Writes the summary of every region as a CSV file, and the whole run as JSON next to it
+    :param path: Where to write the CSV file. The JSON goes to the same path with a .json extension
+    :param summaries: The list of dictionaries from writeRegionOutputs()
+    :param runSummary: An optional dictionary with anything else worth reporting about the run
+    :return: None
+    """
+    def formatValue(value):
+        if value is None:
+            return ""
+        if isinstance(value, float):
+            return repr(value)
+        text = str(value)
+        return '"' + text.replace('"', '""') + '"' if any(c in text for c in ',"\n') else text
+
+    with open(path, "w") as summaryFile:
+        summaryFile.write(",".join(SUMMARY_FIELDS) + "\n")
+        for summary in summaries:
+            summaryFile.write(",".join(formatValue(summary[field]) for field in SUMMARY_FIELDS) + "\n")
+    with open(os.path.splitext(path)[0] + ".json", "w") as summaryFile:
+        json.dump(dict(runSummary or {}, regions=summaries), summaryFile, indent=2)
@@ -0,0 +1,333 @@
+########################################################################################################################
+# Name: Grain Size Tiled Rasters
+# Purpose: Reads rasters that are too big to hold in memory. A raster is converted once into a cache file of fixed size
+# square tiles, which is memory mapped, and only a limited number of tiles are ever held in memory at a time. Points
+# are sorted by the tile they fall in, so each tile is read once per batch of points. ASCII grids, like the PRISM
+# climate normals, can be converted or read without ArcGIS.
+########################################################################################################################
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+import numpy as np
+from GrainSizeRaster import RasterSampler, windowForExtent
+
+DEFAULT_TILE_SIZE = 512
+DEFAULT_MAX_MEMORY = 256 * 1024 ** 2  # 256 MB
+
+
+class TiledRaster(RasterSampler):
+    def __init__(self, path, maxMemory=DEFAULT_MAX_MEMORY):
+        """
+        Opens a tile cache made by writeTiles()
+        :param path: The path to the .tiles file. Its metadata is in a .json file next to it
+        :param maxMemory: The most memory, in bytes, that tiles read from the cache may take up
+        """
+        with open(path + ".json") as metadataFile:
+            metadata = json.load(metadataFile)
+        RasterSampler.__init__(self, None, metadata["xMin"], metadata["yMax"], metadata["cellWidth"],
+                               metadata["cellHeight"], metadata["noData"])
+        self.path = path
+        self.tileSize = metadata["tileSize"]
+        self._numRows = metadata["numRows"]
+        self._numCols = metadata["numCols"]
+        self.tileRows = -(-self._numRows // self.tileSize)
+        self.tileCols = -(-self._numCols // self.tileSize)
+        self.dtype = np.dtype(metadata["dtype"])
+        self.tiles = np.memmap(path, dtype=self.dtype, mode="r",
+                               shape=(self.tileRows, self.tileCols, self.tileSize, self.tileSize))
+
+        tileBytes = self.tileSize * self.tileSize * self.dtype.itemsize
+        self.maxCachedTiles = max(int(maxMemory // tileBytes), 1)
+        self._cachedTiles = OrderedDict()
+        self.tileReads = 0
+
+    @property
+    def numRows(self):
+        return self._numRows
+
+    @property
+    def numCols(self):
+        return self._numCols
+
+    def readTile(self, tileRow, tileCol):
+        """
+        Returns one tile, reading it from disk if it isn't one of the tiles we're holding on to
+        :return: A tileSize by tileSize array
+        """
+        key = (tileRow, tileCol)
+        tile = self._cachedTiles.pop(key, None)
+        if tile is None:
+            tile = np.array(self.tiles[tileRow, tileCol])
+            self.tileReads += 1
+            while len(self._cachedTiles) >= self.maxCachedTiles:
+                self._cachedTiles.popitem(last=False)  # drops the tile we used longest ago
+        self._cachedTiles[key] = tile
+        return tile
+
+    def cellValues(self, rows, cols):
+        """
+        Reads the value of individual cells, reading each tile they fall in only once
+        :param rows: An integer array of rows
+        :param cols: An integer array of columns, the same length as rows
+        :return: A float array, with NaN for cells that are outside the raster or have no data
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        values = np.full(rows.shape, np.nan)
+        inside = np.flatnonzero((rows >= 0) & (rows < self.numRows) & (cols >= 0) & (cols < self.numCols))
+        if len(inside) == 0:
+            return values
+
+        tileIds = (rows[inside] // self.tileSize) * self.tileCols + cols[inside] // self.tileSize
+        order = np.argsort(tileIds, kind="mergesort")
+        sortedIds = tileIds[order]
+        boundaries = np.flatnonzero(np.diff(sortedIds)) + 1
+        for group in np.split(order, boundaries):
+            tileRow, tileCol = divmod(int(tileIds[group[0]]), self.tileCols)
+            tile = self.readTile(tileRow, tileCol)
+            cells = inside[group]
+            values[cells] = tile[rows[cells] - tileRow * self.tileSize, cols[cells] - tileCol * self.tileSize]
+
+        if self.noData is not None:
+            values[values == self.noData] = np.nan
+        return values
+
+    def window(self, extent, margin=1):
+        """
+        Reads the cells that cover an extent into an ordinary RasterSampler
+        :param extent: (xMin, yMin, xMax, yMax) of the area we want
+        :param margin: How many cells to pad the window by on each side
+        :return: A RasterSampler
+        """
+        firstRow, firstCol, lastRow, lastCol = windowForExtent(extent, self.xMin, self.yMax, self.cellWidth,
+                                                               self.cellHeight, self.numRows, self.numCols, margin)
+        array = np.empty((lastRow - firstRow, lastCol - firstCol), dtype=self.dtype)
+        for tileRow in range(firstRow // self.tileSize, (lastRow - 1) // self.tileSize + 1):
+            for tileCol in range(firstCol // self.tileSize, (lastCol - 1) // self.tileSize + 1):
+                rowStart = max(firstRow, tileRow * self.tileSize)
+                rowEnd = min(lastRow, (tileRow + 1) * self.tileSize)
+                colStart = max(firstCol, tileCol * self.tileSize)
+                colEnd = min(lastCol, (tileCol + 1) * self.tileSize)
+                tile = self.readTile(tileRow, tileCol)
+                array[rowStart - firstRow:rowEnd - firstRow, colStart - firstCol:colEnd - firstCol] = \
+                    tile[rowStart - tileRow * self.tileSize:rowEnd - tileRow * self.tileSize,
+                         colStart - tileCol * self.tileSize:colEnd - tileCol * self.tileSize]
+        return RasterSampler(array, self.xMin + firstCol * self.cellWidth, self.yMax - firstRow * self.cellHeight,
+                             self.cellWidth, self.cellHeight, self.noData)
+
+
+def writeTiles(path, readRows, numRows, numCols, dtype, xMin, yMax, cellWidth, cellHeight, noData,
+               tileSize=DEFAULT_TILE_SIZE):
+    """
+    Writes a raster to a tile cache, one band of tile rows at a time, so only tileSize rows are ever in memory
+    :param path: Where to write the .tiles file
+    :param readRows: A function that takes (firstRow, numRowsToRead) and returns that band of the raster as an array
+    :param numRows: The number of rows in the raster
+    :param numCols: The number of columns in the raster
+    :param dtype: The NumPy type of the cells
+    :param noData: The value that marks a cell as having no data. Tiles that hang off the edge are padded with it
+    :return: None
+    """
+    dtype = np.dtype(dtype)
+    fillValue = noData if noData is not None else (np.nan if dtype.kind == "f" else 0)
+    tileCols = -(-numCols // tileSize)
+    partialPath = path + "." + str(os.getpid()) + ".partial"  # so two processes converting the same raster don't collide
+    with open(partialPath, "wb") as tileFile:
+        for firstRow in range(0, numRows, tileSize):
+            band = np.full((tileSize, tileCols * tileSize), fillValue, dtype=dtype)
+            rowsToRead = min(tileSize, numRows - firstRow)
+            band[:rowsToRead, :numCols] = readRows(firstRow, rowsToRead)
+            for tileCol in range(tileCols):
+                tileFile.write(np.ascontiguousarray(band[:, tileCol * tileSize:(tileCol + 1) * tileSize]).tobytes())
+
+    with open(partialPath + ".json", "w") as metadataFile:
+        json.dump({"numRows": numRows, "numCols": numCols, "tileSize": tileSize, "dtype": dtype.str,
+                   "xMin": float(xMin), "yMax": float(yMax), "cellWidth": float(cellWidth),
+                   "cellHeight": float(cellHeight), "noData": None if noData is None else float(noData)},
+                  metadataFile)
+    for finalPath, writtenPath in ((path + ".json", partialPath + ".json"), (path, partialPath)):
+        if os.path.exists(finalPath):
+            os.remove(finalPath)
+        os.rename(writtenPath, finalPath)  # the cache only shows up once it's complete
+
+
+def readAsciiHeader(asciiFile):
+    """
+    Reads the header of an ESRI ASCII grid
+    :param asciiFile: An open file, which is left at the first row of data
+    :return: A dictionary of the header, with lower case keys
+    """
+    header = {}
+    while True:
+        position = asciiFile.tell()
+        line = asciiFile.readline()
+        parts = line.split()
+        if len(parts) != 2 or not parts[0][0].isalpha():
+            asciiFile.seek(position)
+            return header
+        header[parts[0].lower()] = float(parts[1])
+
+
+def asciiGridGeometry(header):
+    """
+    :param header: The header of an ESRI ASCII grid, from readAsciiHeader()
+    :return: The number of rows and columns, the x of its left edge, the y of its top edge, its cell size, and its no
+    data value (or None)
+    """
+    numRows = int(header["nrows"])
+    numCols = int(header["ncols"])
+    cellSize = header["cellsize"]
+    xMin = header["xllcorner"] if "xllcorner" in header else header["xllcenter"] - cellSize / 2.0
+    yMin = header["yllcorner"] if "yllcorner" in header else header["yllcenter"] - cellSize / 2.0
+    return numRows, numCols, xMin, yMin + numRows * cellSize, cellSize, header.get("nodata_value")
+
+
+def _asciiRowReader(asciiFile, asciiPath, numCols):
+    """
+    Makes a function that reads the next rows of an ASCII grid. A line can hold part of a row or more than one row, so
+    the values read past the end of one call are kept for the next
+    """
+    pending = []  # values read from the file that belong to the rows after the last ones we returned
+
+    def readRows(firstRow, numRowsToRead):
+        numValues = numRowsToRead * numCols
+        while len(pending) < numValues:
+            line = asciiFile.readline()
+            if not line:
+                raise ValueError(asciiPath + " ends before all of its rows were read")
+            pending.extend(line.split())
+        values = pending[:numValues]
+        del pending[:numValues]
+        return np.array(values, dtype=np.float32).reshape(numRowsToRead, numCols)
+    return readRows
+
+
+def convertAsciiGrid(asciiPath, path, tileSize=DEFAULT_TILE_SIZE):
+    """
+    Converts an ESRI ASCII grid (.asc) into a tile cache without ArcGIS, reading it one band of rows at a time
+    :param asciiPath: The path to the .asc file
+    :param path: Where to write the .tiles file
+    :return: None
+    """
+    with open(asciiPath) as asciiFile:
+        numRows, numCols, xMin, yMax, cellSize, noData = asciiGridGeometry(readAsciiHeader(asciiFile))
+        writeTiles(path, _asciiRowReader(asciiFile, asciiPath, numCols), numRows, numCols, np.float32, xMin, yMax,
+                   cellSize, cellSize, noData, tileSize)
+
+
+def readAsciiGrid(asciiPath, extent=None, margin=1):
+    """
+    Reads an ESRI ASCII grid (.asc) into a sampler without ArcGIS
+    :param asciiPath: The path to the .asc file
+    :param extent: Optional (xMin, yMin, xMax, yMax). If given, only the window of cells that covers it is kept
+    :param margin: How many cells to pad the window by on each side
+    :return: A RasterSampler
+    """
+    with open(asciiPath) as asciiFile:
+        numRows, numCols, xMin, yMax, cellSize, noData = asciiGridGeometry(readAsciiHeader(asciiFile))
+        firstRow, firstCol, lastRow, lastCol = 0, 0, numRows, numCols
+        if extent is not None:
+            firstRow, firstCol, lastRow, lastCol = windowForExtent(extent, xMin, yMax, cellSize, cellSize, numRows,
+                                                                   numCols, margin)
+        readRows = _asciiRowReader(asciiFile, asciiPath, numCols)
+        for row in range(firstRow):
+            readRows(row, 1)  # the rows above the window still have to be read past
+        array = readRows(firstRow, lastRow - firstRow)[:, firstCol:lastCol] if lastRow > firstRow else \
+            np.zeros((0, lastCol - firstCol), dtype=np.float32)
+    return RasterSampler(array, xMin + firstCol * cellSize, yMax - firstRow * cellSize, cellSize, cellSize, noData)
+
+
+def convertRaster(raster, path, tileSize=DEFAULT_TILE_SIZE):
+    """
+    Converts a raster that ArcGIS can read into a tile cache, reading it one band of rows at a time
+    :param raster: The path to a raster, or an arcpy Raster object
+    :param path: Where to write the .tiles file
+    :return: None
+    """
+    import arcpy
+
+    if not isinstance(raster, arcpy.Raster):
+        raster = arcpy.Raster(raster)
+    cellWidth = raster.meanCellWidth
+    cellHeight = raster.meanCellHeight
+    xMin = raster.extent.XMin
+    yMax = raster.extent.YMax
+    noData = raster.noDataValue
+
+    def readRows(firstRow, numRowsToRead):
+        lowerLeft = arcpy.Point(xMin + cellWidth / 4.0, yMax - (firstRow + numRowsToRead) * cellHeight + cellHeight / 4.0)
+        if noData is None:
+            return arcpy.RasterToNumPyArray(raster, lowerLeft, raster.width, numRowsToRead)
+        return arcpy.RasterToNumPyArray(raster, lowerLeft, raster.width, numRowsToRead, noData)
+
+    dtype = readRows(0, 1).dtype
+    writeTiles(path, readRows, raster.height, raster.width, dtype, xMin, yMax, cellWidth, cellHeight, noData,
+               tileSize)
+
+
+def openTiled(raster, tileCacheFolder, maxMemory=DEFAULT_MAX_MEMORY, tileSize=DEFAULT_TILE_SIZE):
+    """
+    Opens a raster through a tile cache, converting it the first time we see it. A raster that has been changed since it
+    was converted is converted again
+    :param raster: The path to a raster. ASCII grids (.asc) are converted without ArcGIS
+    :param tileCacheFolder: Where we keep the tile caches
+    :param maxMemory: The most memory, in bytes, that the raster's tiles may take up
+    :return: A TiledRaster
+    """
+    raster = str(raster)
+    if not os.path.exists(tileCacheFolder):
+        os.makedirs(tileCacheFolder)
+    source = raster
+    if not os.path.exists(source) and os.path.exists(os.path.dirname(source)):
+        source = os.path.dirname(source)  # rasters in a geodatabase are a path inside the .gdb folder
+    stamp = os.path.getmtime(source) if os.path.exists(source) else 0
+    key = hashlib.sha1((os.path.abspath(raster) + "|" + repr(stamp) + "|" + str(tileSize)).encode("utf-8")).hexdigest()
+    path = os.path.join(tileCacheFolder, key + ".tiles")
+
+    if not os.path.exists(path):
+        if raster.lower().endswith(".asc"):
+            convertAsciiGrid(raster, path, tileSize)
+        else:
+            convertRaster(raster, path, tileSize)
+    return TiledRaster(path, maxMemory)
+
+
+def rasterBytes(raster, extent=None, margin=1):
+    """
+    Finds how much memory reading a raster (or the window of it that covers an extent) as one array would take
+    :param raster: The path to a raster that ArcGIS can read
+    :return: The size in bytes
+    """
+    import arcpy
+
+    if not isinstance(raster, arcpy.Raster):
+        raster = arcpy.Raster(raster)
+    firstRow, firstCol, lastRow, lastCol = 0, 0, raster.height, raster.width
+    if extent is not None:
+        firstRow, firstCol, lastRow, lastCol = windowForExtent(extent, raster.extent.XMin, raster.extent.YMax,
+                                                               raster.meanCellWidth, raster.meanCellHeight,
+                                                               raster.height, raster.width, margin)
+    bytesPerCell = {"U1": 1, "U2": 1, "U4": 1, "S8": 1, "U8": 1, "S16": 2, "U16": 2, "S32": 4, "U32": 4,
+                    "F32": 4}.get(raster.pixelType, 8)
+    return (lastRow - firstRow) * (lastCol - firstCol) * bytesPerCell
+
+
+def openRaster(raster, extent=None, margin=1, maxMemory=None, tileCacheFolder=None):
+    """
+    Opens a raster for sampling. It is read straight into memory if it fits in maxMemory, and through a tile cache if
+    it doesn't
+    :param raster: The path to a raster, or a RasterSampler, which is returned as it is
+    :param extent: Optional (xMin, yMin, xMax, yMax) of the area we need. Only used when reading into memory
+    :param margin: How many cells to pad the extent by
+    :param maxMemory: The most memory, in bytes, the raster may take up. None means there is no limit
+    :param tileCacheFolder: Where we keep the tile caches. Needed if maxMemory is given
+    :return: A RasterSampler, or a TiledRaster
+    """
+    if isinstance(raster, RasterSampler):
+        return raster
+    if maxMemory is not None and tileCacheFolder is not None:
+        if str(raster).lower().endswith(".asc") or rasterBytes(raster, extent, margin) > maxMemory:
+            return openTiled(raster, tileCacheFolder, maxMemory)
+    return RasterSampler.fromRaster(raster, extent, margin)
@@ -0,0 +1,351 @@
+########################################################################################################################
+# Name: Pipeline Benchmark
+# Purpose: Times every stage of finding grain sizes on synthetic data, so we can measure the tool without ArcGIS or real
+# inputs. For each scale, a seeded DEM, precipitation layer and stream network are generated, then each stage is timed:
+# the native hydrology, building the precipitation index, filtering flow accumulation, sampling elevation, looking up
+# precipitation, finding drainage area, finding slope, width and Q_2, and finding grain size. Then the whole network is
+# run through streamReaches() a batch at a time, as the tool runs it, with each batch written to the GeoPackage and
+# results file, and the results file is loaded back. The timings, throughput, memory and a summary of the results are
+# written as JSON, and can be compared against an earlier run to catch both slowdowns and changed results.
+#
+# Each scale runs in its own process, so its memory isn't hidden by the scales before it. Every stage records the
+# process's peak memory once it's done, and how much the stage raised that peak.
+#
+# Usage: python benchPipeline.py [--scales 1000,10000,100000,1000000] [--output results.json]
+#                                [--baseline baseline.json] [--tolerance 0.25] [--region 1] [--seed 0]
+########################################################################################################################
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import numpy as np
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import GrainSizeHydrology
+from GrainSizeBackends import LocalBackend, Polyline
+from GrainSizeCore import DEFAULT_BATCH_SIZE, ReachFileWriter, streamReaches
+from GrainSizeInstrumentation import Instrumentation
+from GrainSizeOutput import loadReaches
+from GrainSizePipeline import ReachInputs, computeReachVariables
+from GrainSizePrecip import PrecipitationIndex
+from GrainSizeQ2 import getDefaultRegistry
+from GrainSizeRaster import RasterSampler, pointFootprint, focalMaximum
+from GrainSizeReach import ReachTable
+from benchPrecipitationIndex import makeSyntheticPolygons
+
+BENCHMARK_VERSION = 2
+DEFAULT_SCALES = [1000, 10000, 100000, 1000000]
+CELL_SIZE = 10.0
+BUFFER_RADIUS = 20.0
+N_VALUE = .04
+T_C_VALUE = .04
+RESULT_TOLERANCE = 1e-7  # how far, relatively, a result may drift from the baseline before we call it changed
+NOISE_FLOOR = 0.05  # seconds. Stages quicker than this are too noisy to call a regression
+
+
+def peakMemory():
+    """
+    Finds the most memory this process has used so far
+    :return: The peak resident set size in bytes, or None if we can't tell on this platform
+    """
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+            return int(psutil.Process().memory_info().peak_wset)  # Windows
+        except (ImportError, AttributeError):
+            return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return int(peak) if sys.platform == "darwin" else int(peak) * 1024  # Linux reports kilobytes
+
+
+def demSideForScale(numReaches):
+    """Picks a DEM big enough that the reaches are spread out like a real network, but small enough to fill quickly"""
+    return int(np.clip(np.sqrt(numReaches) * 2, 256, 2048))
+
+
+def makeSyntheticDEM(side, seed):
+    """
+    Makes a DEM that slopes down to one corner, with rolling hills and noise on top, so it has valleys to drain
+    :param side: How many cells along each side
+    :return: A RasterSampler
+    """
+    random = np.random.RandomState(seed)
+    rows, cols = np.mgrid[0:side, 0:side].astype(np.float64) / side
+    elevations = 2000 * (1 - 0.5 * (rows + cols))
+    for frequency in (2, 5, 11):
+        phase = random.uniform(0, 2 * np.pi, 2)
+        elevations += 300.0 / frequency * np.sin(2 * np.pi * frequency * rows + phase[0]) * \
+            np.cos(2 * np.pi * frequency * cols + phase[1])
+    elevations += random.normal(0, 2.0, elevations.shape)
+    return RasterSampler(elevations.astype(np.float32), 0.0, side * CELL_SIZE, CELL_SIZE, CELL_SIZE)
+
+
+def makeSyntheticReaches(numReaches, extent, seed):
+    """
+    Makes a stream network of short straight reaches scattered across the DEM
+    :param extent: (xMin, yMin, xMax, yMax) of the DEM
+    :return: Arrays of the first point x and y, the last point x and y, and the length of every reach
+    """
+    random = np.random.RandomState(seed)
+    xMin, yMin, xMax, yMax = extent
+    lengths = random.uniform(50, 500, numReaches)
+    angles = random.uniform(0, 2 * np.pi, numReaches)
+    firstXs = random.uniform(xMin + CELL_SIZE / 2, xMax - CELL_SIZE / 2, numReaches)
+    firstYs = random.uniform(yMin + CELL_SIZE / 2, yMax - CELL_SIZE / 2, numReaches)
+    margin = CELL_SIZE / 2  # keeps the last points off the outside edge, which belongs to no cell
+    lastXs = np.clip(firstXs + lengths * np.cos(angles), xMin + margin, xMax - margin)
+    lastYs = np.clip(firstYs + lengths * np.sin(angles), yMin + margin, yMax - margin)
+    lengths = np.hypot(lastXs - firstXs, lastYs - firstYs)
+    return firstXs, firstYs, lastXs, lastYs, lengths
+
+
+class SyntheticBackend(LocalBackend):
+    def __init__(self, firstXs, firstYs, lastXs, lastYs, polygons, values, extent):
+        """Hands streamReaches() the synthetic stream network and precipitation polygons, as if read from files"""
+        LocalBackend.__init__(self, report=lambda text: None)
+        self.ends = (firstXs, firstYs, lastXs, lastYs)
+        self.polygons = polygons
+        self.values = values
+        self.extent = extent
+
+    def countFeatures(self, featureClass):
+        return len(self.ends[0])
+
+    def readPolylines(self, featureClass):
+        firstXs, firstYs, lastXs, lastYs = self.ends
+        for i in range(len(firstXs)):
+            yield Polyline([[(firstXs[i], firstYs[i]), (lastXs[i], lastYs[i])]]), i + 1
+
+    def featureExtent(self, featureClass):
+        return self.extent
+
+    def spatialReference(self, featureClass):
+        return None, None
+
+    def readPolygons(self, featureClass, field):
+        return self.polygons, self.values
+
+
+def summarizeResults(reaches):
+    """A few numbers that change if any reach's grain size changes"""
+    grainSizes = reaches.grainSize
+    finite = np.isfinite(grainSizes)
+    return {"grainSizeSum": float(np.sum(grainSizes[finite])),
+            "grainSizeMean": float(np.mean(grainSizes[finite])) if finite.any() else None,
+            "grainSizeMax": float(np.max(grainSizes[finite])) if finite.any() else None,
+            "nanCount": int(np.count_nonzero(~finite)),
+            "checksum": hashlib.sha1(np.ascontiguousarray(grainSizes.astype(np.float32)).tobytes()).hexdigest()}
+
+
+def runScale(numReaches, q2Equation, seed, scratchFolder):
+    """
+    Runs every stage once on a network of numReaches reaches
+    :return: A dictionary describing the scale, its stage timings and its results
+    """
+    stages = {}
+
+    def addStage(name, numItems, seconds, peakBefore):
+        peakAfter = peakMemory()
+        stages[name] = {"seconds": seconds,
+                        "itemsPerSecond": numItems / seconds if seconds > 0 else None,
+                        "peakMemoryBytes": peakAfter,
+                        "peakMemoryGrowthBytes": peakAfter - peakBefore if peakAfter is not None else None}
+
+    def timeStage(name, numItems, function, *args):
+        peakBefore = peakMemory()
+        start = timer()
+        result = function(*args)
+        addStage(name, numItems, timer() - start, peakBefore)
+        return result
+
+    side = demSideForScale(numReaches)
+    demSampler = makeSyntheticDEM(side, seed)
+    extent = (0.0, 0.0, side * CELL_SIZE, side * CELL_SIZE)
+    polygonsPerSide = int(np.clip(np.sqrt(numReaches / 100.0), 10, 100))
+    polygons, values = makeSyntheticPolygons(polygonsPerSide, side * CELL_SIZE / polygonsPerSide, seed)
+    firstXs, firstYs, lastXs, lastYs, lengths = makeSyntheticReaches(numReaches, extent, seed + 1)
+
+    drainageRasters = timeStage("hydrology", side * side, GrainSizeHydrology.findDrainageRasters, demSampler)
+    precipIndex = timeStage("precipitationIndex", len(polygons), PrecipitationIndex, polygons, values)
+    core, fringe = pointFootprint(BUFFER_RADIUS, CELL_SIZE)
+    flowAccSampler = drainageRasters["flowAccumulation"]
+    filteredFlowAccSampler = timeStage("drainageFilter", side * side, focalMaximum, flowAccSampler, core)
+
+    """computeReachVariables() times its own steps, so we split its time up the same way"""
+    tempSampler = None
+    if q2Equation.needsTemperature:
+        tempSampler = RasterSampler(np.full((side, side), -5.0), 0.0, side * CELL_SIZE, CELL_SIZE, CELL_SIZE)
+    inputs = ReachInputs(demSampler, flowAccSampler, CELL_SIZE * CELL_SIZE, precipIndex, q2Equation, tempSampler,
+                         footprint=fringe, bufferRadius=BUFFER_RADIUS, filteredFlowAccSampler=filteredFlowAccSampler)
+    timings = {}
+    peakBefore = peakMemory()
+    columns = computeReachVariables(inputs, firstXs, firstYs, lastXs, lastYs, lengths, timings)
+    for name in ("elevation", "precipitation", "flowAccumulation", "variables"):
+        addStage(name, numReaches, timings[name], peakBefore)
+
+    def findGrainSizes():
+        reaches = ReachTable(columns["widths"], columns["q_2s"], columns["slopes"])
+        reaches.calculateGrainSize(N_VALUE, T_C_VALUE)
+        reaches.flowAccumulation[:] = columns["flowAccumulations"]
+        return reaches
+    timeStage("grainSize", numReaches, findGrainSizes)
+    del inputs, flowAccSampler, filteredFlowAccSampler
+
+    """The whole pipeline, as the tool runs it: each batch is read, found and written before the next one is read"""
+    backend = SyntheticBackend(firstXs, firstYs, lastXs, lastYs, polygons, values, extent)
+    outputFolder = os.path.join(scratchFolder, "output_" + str(numReaches))
+    os.makedirs(outputFolder)
+    peakBefore = peakMemory()
+    streamSeconds = 0.0
+    outputSeconds = 0.0
+    grainSizes = []
+    batches = streamReaches(False, demSampler, drainageRasters["flowAccumulation"], "streams", "precipitation",
+                            q2Equation.region, scratchFolder, N_VALUE, T_C_VALUE, minJanTempMap=tempSampler,
+                            batchSize=DEFAULT_BATCH_SIZE,
+                            instrumentation=Instrumentation(enabled=False), backend=backend)
+    writer = ReachFileWriter(outputFolder)
+    while True:
+        start = timer()
+        batch = next(batches, None)
+        streamSeconds += timer() - start
+        if batch is None:
+            break
+        start = timer()
+        writer.write(batch)
+        outputSeconds += timer() - start
+        grainSizes.append(batch.grainSize)
+    start = timer()
+    writer.close()
+    outputSeconds += timer() - start
+    addStage("streamReaches", numReaches, streamSeconds, peakBefore)
+    addStage("output", numReaches, outputSeconds, peakBefore)
+    reaches = timeStage("reload", numReaches, loadReaches, os.path.join(outputFolder, "GrainSizeResults.bin"))
+
+    reachStages = ["streamReaches", "output"]
+    reachSeconds = sum(stages[name]["seconds"] for name in reachStages)
+    return {"numReaches": numReaches,
+            "demCells": side * side,
+            "numPolygons": len(polygons),
+            "stages": stages,
+            "reachStagesSeconds": reachSeconds,
+            "reachesPerSecond": numReaches / reachSeconds if reachSeconds > 0 else None,
+            "totalSeconds": sum(stage["seconds"] for stage in stages.values()),
+            "peakMemoryBytes": peakMemory(),
+            "results": summarizeResults(reaches)}
+
+
+def runScaleInSubprocess(numReaches, region, seed):
+    """
+    Runs one scale in a process of its own, so the peak memory it reports isn't left over from an earlier scale
+    :return: The dictionary runScale() gives back for the scale
+    """
+    outputFile, outputPath = tempfile.mkstemp(prefix="benchPipeline_", suffix=".json")
+    os.close(outputFile)
+    try:
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), "--scales", str(numReaches),
+                               "--region", str(region), "--seed", str(seed), "--output", outputPath,
+                               "--sameProcess"])
+        with open(outputPath) as scaleFile:
+            return json.load(scaleFile)["scales"][0]
+    finally:
+        os.remove(outputPath)
+
+
+def compareToBaseline(report, baseline, tolerance):
+    """
+    Finds the stages that got slower, and the results that changed, since the baseline
+    :param tolerance: How much slower, as a fraction, a stage may get before it counts as a regression
+    :return: A list of problems, each a string
+    """
+    problems = []
+    baselineScales = dict((scale["numReaches"], scale) for scale in baseline.get("scales", []))
+    for scale in report["scales"]:
+        old = baselineScales.get(scale["numReaches"])
+        if old is None:
+            continue
+        label = str(scale["numReaches"]) + " reaches"
+        for name, stage in sorted(scale["stages"].items()):
+            if name not in old["stages"]:
+                continue
+            before, after = old["stages"][name]["seconds"], stage["seconds"]
+            if after > before * (1 + tolerance) and after - before > NOISE_FLOOR:
+                problems.append(label + ", " + name + ": " + "%.3f" % before + " s -> " + "%.3f" % after + " s (" +
+                                "%+.0f" % (100 * (after / before - 1)) + "%)")
+        for name, value in sorted(scale["results"].items()):
+            oldValue = old["results"].get(name)
+            if oldValue is None or value is None:
+                continue
+            if name == "checksum":
+                if value != oldValue:
+                    problems.append(label + ", the grain sizes changed: checksum " + oldValue + " -> " + value)
+            elif abs(value - oldValue) > RESULT_TOLERANCE * max(abs(oldValue), 1e-300):
+                problems.append(label + ", result " + name + " changed: " + repr(oldValue) + " -> " + repr(value))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times every stage of the grain size pipeline on synthetic data")
+    parser.add_argument("--scales", default=",".join(str(scale) for scale in DEFAULT_SCALES),
+                        help="Comma separated numbers of reaches to run")
+    parser.add_argument("--output", help="Where to write the JSON report. Printed if not given")
+    parser.add_argument("--baseline", help="An earlier JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="How much slower a stage may get before it counts as a regression")
+    parser.add_argument("--region", type=int, default=1, help="Which Q_2 region's equation to use")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sameProcess", action="store_true",
+                        help="Runs every scale in this process, rather than each in a process of its own")
+    arguments = parser.parse_args()
+
+    q2Equation = getDefaultRegistry()[arguments.region]
+    report = {"version": BENCHMARK_VERSION,
+              "machine": {"platform": platform.platform(), "python": platform.python_version(),
+                          "numpy": np.__version__, "processor": platform.processor()},
+              "seed": arguments.seed,
+              "region": arguments.region,
+              "scales": []}
+
+    scratchFolder = tempfile.mkdtemp(prefix="benchPipeline_")
+    try:
+        for numReaches in [int(scale) for scale in arguments.scales.split(",") if scale]:
+            if not arguments.sameProcess:
+                report["scales"].append(runScaleInSubprocess(numReaches, arguments.region, arguments.seed))
+                continue
+            scale = runScale(numReaches, q2Equation, arguments.seed, scratchFolder)
+            report["scales"].append(scale)
+            sys.stderr.write(str(numReaches) + " reaches: " + "%.3f" % scale["reachStagesSeconds"] + " s for the reach "
+                             "stages (" + "%.0f" % scale["reachesPerSecond"] + " reaches per second), " +
+                             "%.3f" % scale["totalSeconds"] + " s in total\n")
+    finally:
+        shutil.rmtree(scratchFolder, ignore_errors=True)
+
+    problems = []
+    if arguments.baseline:
+        with open(arguments.baseline) as baselineFile:
+            problems = compareToBaseline(report, json.load(baselineFile), arguments.tolerance)
+        report["regressions"] = problems
+        for problem in problems:
+            sys.stderr.write("REGRESSION: " + problem + "\n")
+        if not problems:
+            sys.stderr.write("No regressions against " + arguments.baseline + "\n")
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if arguments.output:
+        with open(arguments.output, "w") as outputFile:
+            outputFile.write(text)
+    else:
+        print(text)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
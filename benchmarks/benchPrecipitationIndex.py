@@ -0,0 +1,128 @@
+########################################################################################################################
+# Name: Precipitation Index Benchmark
+# Purpose: Compares the time it takes to find the precipitation at a set of points using the PrecipitationIndex against
+# testing every point against every polygon, which is what intersecting the point with the whole layer does. If arcpy
+# is available, it can also time the real Intersect_analysis path that findPrecipitation() uses.
+#
+# Usage: python benchPrecipitationIndex.py [numPolygonsPerSide] [numPoints] [--arcpy scratchFolder]
+########################################################################################################################
+
+import os
+import sys
+import numpy as np
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from GrainSizePrecip import PrecipitationIndex
+
+
+def makeSyntheticPolygons(numPerSide, cellSize=1000.0, seed=0):
+    """
+    Makes a tiling of jittered quadrilaterals, so neighbouring polygons share their edges like real precipitation zones
+    :param numPerSide: How many polygons along each side. The layer has numPerSide ** 2 polygons
+    :param cellSize: The rough size of each polygon, in map units
+    :return: A list of polygons (each a list of one ring) and an array of precipitation values, in inches
+    """
+    random = np.random.RandomState(seed)
+    xs, ys = np.meshgrid(np.arange(numPerSide + 1) * cellSize, np.arange(numPerSide + 1) * cellSize)
+    jitter = random.uniform(-0.3, 0.3, size=(2,) + xs.shape) * cellSize
+    jitter[:, 0, :] = jitter[:, -1, :] = jitter[:, :, 0] = jitter[:, :, -1] = 0  # keeps the outside edge straight
+    xs = xs + jitter[0]
+    ys = ys + jitter[1]
+
+    polygons = []
+    for row in range(numPerSide):
+        for col in range(numPerSide):
+            ring = np.array([(xs[row, col], ys[row, col]),
+                             (xs[row, col + 1], ys[row, col + 1]),
+                             (xs[row + 1, col + 1], ys[row + 1, col + 1]),
+                             (xs[row + 1, col], ys[row + 1, col])])
+            polygons.append([ring])
+    values = random.uniform(5, 120, size=len(polygons))
+    return polygons, values
+
+
+def bruteForceQuery(index, xs, ys):
+    """Tests every point against every polygon, the way a full intersect does"""
+    polygonIds = np.full(len(xs), -1, dtype=np.int64)
+    for polygonId in range(index.numPolygons):
+        unassigned = np.nonzero(polygonIds < 0)[0]
+        if len(unassigned) == 0:
+            break
+        inside = index._containsPoints(polygonId, xs[unassigned], ys[unassigned])
+        polygonIds[unassigned[inside]] = polygonId
+    values = np.full(len(xs), np.nan)
+    values[polygonIds >= 0] = index.values[polygonIds[polygonIds >= 0]]
+    return values
+
+
+def arcpyIntersectQuery(polygons, values, xs, ys, scratchFolder):
+    """Times findPrecipitation() itself. This is slow, so only use it with a few points"""
+    import arcpy
+    import GrainSize
+
+    arcpy.env.overwriteOutput = True
+    arcpy.CreateFeatureclass_management(scratchFolder, "precip.shp", "POLYGON")
+    precipMap = os.path.join(scratchFolder, "precip.shp")
+    arcpy.AddField_management(precipMap, "Inches", "DOUBLE")
+    insertCursor = arcpy.da.InsertCursor(precipMap, ["SHAPE@", "Inches"])
+    for rings, value in zip(polygons, values):
+        polygon = arcpy.Polygon(arcpy.Array([arcpy.Point(x, y) for x, y in rings[0]]))
+        insertCursor.insertRow([polygon, value])
+    del insertCursor
+
+    results = []
+    for x, y in zip(xs, ys):
+        GrainSize.writePoint(arcpy.Point(x, y), scratchFolder, None)
+        results.append(GrainSize.findPrecipitation(precipMap, scratchFolder, None) / 2.54)
+    return np.array(results)
+
+
+def main():
+    arguments = [argument for argument in sys.argv[1:] if not argument.startswith("--")]
+    numPerSide = int(arguments[0]) if len(arguments) > 0 else 100
+    numPoints = int(arguments[1]) if len(arguments) > 1 else 100000
+
+    polygons, values = makeSyntheticPolygons(numPerSide)
+    random = np.random.RandomState(1)
+    xs = random.uniform(0, numPerSide * 1000.0, numPoints)
+    ys = random.uniform(0, numPerSide * 1000.0, numPoints)
+    print("Polygons: " + str(len(polygons)) + ", points: " + str(numPoints))
+
+    start = timer()
+    index = PrecipitationIndex(polygons, values)
+    buildTime = timer() - start
+    print("Index build: " + str(buildTime) + " seconds")
+
+    start = timer()
+    indexed = index.query(xs, ys)
+    queryTime = timer() - start
+    print("Index query: " + str(queryTime) + " seconds (" + str(numPoints / queryTime) + " points per second)")
+
+    """Brute force is O(points * polygons), so we only run it on a sample and scale it up"""
+    numSamples = min(numPoints, 2000)
+    start = timer()
+    bruteForce = bruteForceQuery(index, xs[:numSamples], ys[:numSamples])
+    bruteForceTime = (timer() - start) * numPoints / numSamples
+    print("Brute force query (estimated): " + str(bruteForceTime) + " seconds")
+    print("Speedup: " + str(bruteForceTime / queryTime) + "x")
+
+    mismatches = np.count_nonzero(~np.isclose(indexed[:numSamples], bruteForce, equal_nan=True))
+    print("Mismatches against brute force: " + str(mismatches))
+
+    if "--arcpy" in sys.argv:
+        scratchFolder = sys.argv[sys.argv.index("--arcpy") + 1]
+        numArcpySamples = min(numPoints, 50)
+        start = timer()
+        intersected = arcpyIntersectQuery(polygons, values, xs[:numArcpySamples], ys[:numArcpySamples], scratchFolder)
+        intersectTime = (timer() - start) * numPoints / numArcpySamples
+        print("Intersect_analysis query (estimated): " + str(intersectTime) + " seconds")
+        print("Speedup: " + str(intersectTime / queryTime) + "x")
+        mismatches = np.count_nonzero(~np.isclose(indexed[:numArcpySamples], intersected, equal_nan=True))
+        print("Mismatches against Intersect_analysis: " + str(mismatches))
+
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
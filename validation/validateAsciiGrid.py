@@ -0,0 +1,76 @@
+########################################################################################################################
+# Name: ASCII Grid Validation
+# Purpose: Checks that ESRI ASCII grids are read the same however their values are split across lines. Some tools write
+# one row per line, some wrap long rows, and some pack several rows onto a line, so each layout is written out and read
+# back through readAsciiGrid() (whole and windowed) and through a tile cache.
+#
+# Usage: python validateAsciiGrid.py
+########################################################################################################################
+
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from GrainSizeTiles import TiledRaster, convertAsciiGrid, readAsciiGrid
+
+
+def writeAsciiGrid(path, grid, valuesPerLine):
+    """Writes a grid as an ESRI ASCII grid with a set number of values on each line, whatever the row length"""
+    values = [repr(float(value)) for value in grid.ravel()]
+    with open(path, "w") as asciiFile:
+        asciiFile.write("ncols " + str(grid.shape[1]) + "\nnrows " + str(grid.shape[0]) +
+                        "\nxllcorner 0\nyllcorner 0\ncellsize 1\nNODATA_value -9999\n")
+        for start in range(0, len(values), valuesPerLine):
+            asciiFile.write(" ".join(values[start:start + valuesPerLine]) + "\n")
+
+
+def report(name, passed, detail=""):
+    print(("PASS " if passed else "FAIL ") + name + (": " + detail if detail else ""))
+    return passed
+
+
+def validateLayouts(folder):
+    results = []
+    grid = np.arange(1, 10, dtype=np.float32).reshape(3, 3)
+    largeGrid = np.random.RandomState(0).rand(37, 23).astype(np.float32)
+    for name, values, valuesPerLine in (("3x3, 4 values per line", grid, 4),
+                                        ("3x3, one row per line", grid, 3),
+                                        ("3x3, one value per line", grid, 1),
+                                        ("3x3, every value on one line", grid, 9),
+                                        ("37x23, 10 values per line", largeGrid, 10),
+                                        ("37x23, 50 values per line", largeGrid, 50)):
+        asciiPath = os.path.join(folder, "grid.asc")
+        writeAsciiGrid(asciiPath, values, valuesPerLine)
+        numRows, numCols = values.shape
+
+        results.append(report(name + ", whole grid", np.array_equal(readAsciiGrid(asciiPath).array, values)))
+
+        """A window that starts below the first row, so the rows above it have to be read past"""
+        window = readAsciiGrid(asciiPath, (1.5, 0.5, numCols - 0.5, numRows - 1.5), 0)
+        expected = values[1:, 1:]
+        results.append(report(name + ", window", np.array_equal(window.array, expected),
+                              str(window.array.shape) + " cells"))
+
+        tilesPath = os.path.join(folder, "grid" + str(len(results)) + ".tiles")
+        convertAsciiGrid(asciiPath, tilesPath, tileSize=2)
+        tiled = TiledRaster(tilesPath)
+        rows, cols = np.mgrid[0:numRows, 0:numCols]
+        results.append(report(name + ", tile cache",
+                              np.array_equal(tiled.cellValues(rows.ravel(), cols.ravel()), values.ravel())))
+    return all(results)
+
+
+def main():
+    folder = tempfile.mkdtemp(prefix="validateAsciiGrid_")
+    try:
+        passed = validateLayouts(folder)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
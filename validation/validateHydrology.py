@@ -0,0 +1,165 @@
+########################################################################################################################
+# Name: Hydrology Validation
+# Purpose: Checks the native fill / flow direction / flow accumulation engine in GrainSizeHydrology against reference
+# grids. The synthetic terrains have either an exact answer (a tilted plane) or are checked against slow but simple
+# reference implementations. Grids exported from ArcGIS can also be compared, to check that the two engines agree.
+#
+# Usage: python validateHydrology.py [--size N] [--reference dem.npy flowAccumulation.npy]
+########################################################################################################################
+
+import os
+import sys
+import numpy as np
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from GrainSizeHydrology import DIRECTIONS, OUTLET, NO_DATA_DIRECTION, findDrainageRasters
+from GrainSizeRaster import RasterSampler
+
+
+def tiltedPlane(numRows, numCols):
+    """A plane that drops one unit per row to the south. Every cell flows straight south"""
+    dem = np.tile(np.arange(numRows, 0, -1, dtype=np.float64)[:, np.newaxis], (1, numCols))
+    expectedAccumulation = np.tile(np.arange(numRows, dtype=np.float64)[:, np.newaxis], (1, numCols))
+    return dem, expectedAccumulation
+
+
+def pittedValley(numRows, numCols, seed=0):
+    """A V shaped valley draining north, with noise, closed basins and a hole of no data in it"""
+    random = np.random.RandomState(seed)
+    rows, cols = np.mgrid[0:numRows, 0:numCols].astype(np.float64)
+    dem = np.abs(cols - numCols / 2.0) * 0.5 + rows * 0.1 + random.rand(numRows, numCols) * 2
+    for i in range(max(numRows * numCols // 2000, 1)):
+        centerRow, centerCol = random.randint(0, numRows), random.randint(0, numCols)
+        radius = random.randint(2, 8)
+        dem -= np.maximum(0, radius - np.hypot(rows - centerRow, cols - centerCol)) * 1.5  # digs a closed basin
+    dem[numRows // 3:numRows // 3 + 4, numCols // 4:numCols // 4 + 4] = np.nan
+    return dem
+
+
+def referenceFill(dem):
+    """
+    Fills depressions by repeatedly lowering water from an infinitely high start until nothing changes. Slow, but so
+    simple it's hard to get wrong
+    """
+    valid = ~np.isnan(dem)
+    padded = np.pad(np.where(valid, 0.0, np.nan), 1, mode="constant", constant_values=np.nan)
+    touchesEdge = np.zeros(dem.shape, dtype=bool)
+    for code, rowOffset, colOffset in DIRECTIONS:
+        touchesEdge |= np.isnan(padded[1 + rowOffset:dem.shape[0] + 1 + rowOffset,
+                                       1 + colOffset:dem.shape[1] + 1 + colOffset])
+    water = np.where(touchesEdge, dem, np.inf)
+    water[~valid] = np.nan
+    while True:
+        padded = np.pad(water, 1, mode="constant", constant_values=np.nan)
+        lowestNeighbour = np.full(dem.shape, np.inf)
+        for code, rowOffset, colOffset in DIRECTIONS:
+            neighbour = padded[1 + rowOffset:dem.shape[0] + 1 + rowOffset, 1 + colOffset:dem.shape[1] + 1 + colOffset]
+            lowestNeighbour = np.fmin(lowestNeighbour, neighbour)
+        newWater = np.where(touchesEdge, dem, np.maximum(dem, np.minimum(water, lowestNeighbour)))
+        newWater[~valid] = np.nan
+        if np.all((newWater == water) | (np.isnan(newWater) & np.isnan(water))):
+            return water
+        water = newWater
+
+
+def referenceAccumulation(directions):
+    """Walks downstream from every cell, adding one to every cell it passes through"""
+    numRows, numCols = directions.shape
+    offsets = dict((code, (rowOffset, colOffset)) for code, rowOffset, colOffset in DIRECTIONS)
+    accumulation = np.zeros(directions.shape)
+    for row in range(numRows):
+        for col in range(numCols):
+            if directions[row, col] == NO_DATA_DIRECTION:
+                continue
+            currentRow, currentCol = row, col
+            for step in range(numRows * numCols):
+                code = directions[currentRow, currentCol]
+                if code == OUTLET:
+                    break
+                currentRow += offsets[code][0]
+                currentCol += offsets[code][1]
+                if not (0 <= currentRow < numRows and 0 <= currentCol < numCols) or \
+                        directions[currentRow, currentCol] == NO_DATA_DIRECTION:
+                    break
+                accumulation[currentRow, currentCol] += 1
+            else:
+                raise AssertionError("The flow directions have a loop in them")
+    accumulation[directions == NO_DATA_DIRECTION] = np.nan
+    return accumulation
+
+
+def runEngine(dem):
+    start = timer()
+    rasters = findDrainageRasters(RasterSampler(dem, 0, dem.shape[0], 1, 1))
+    return rasters, timer() - start
+
+
+def report(name, passed, detail=""):
+    print(("PASS " if passed else "FAIL ") + name + (": " + detail if detail else ""))
+    return passed
+
+
+def compareGrids(name, actual, expected):
+    same = np.isclose(actual, expected, equal_nan=True)
+    return report(name, same.all(), str(int(np.count_nonzero(~same))) + " of " + str(same.size) + " cells differ")
+
+
+def validateSynthetic(size):
+    results = []
+
+    dem, expectedAccumulation = tiltedPlane(size, size)
+    rasters, seconds = runEngine(dem)
+    results.append(compareGrids("Tilted plane flow accumulation (" + str(round(seconds, 3)) + " s)",
+                                rasters["flowAccumulation"].array, expectedAccumulation))
+
+    dem = pittedValley(size, size)
+    rasters, seconds = runEngine(dem)
+    filled = rasters["filledDEM"].array
+    directions = rasters["flowDirection"].array
+    accumulation = rasters["flowAccumulation"].array
+    valid = ~np.isnan(dem)
+    print("Pitted valley took " + str(round(seconds, 3)) + " seconds")
+
+    results.append(compareGrids("Pitted valley fill", filled, referenceFill(dem)))
+    results.append(report("Fill never lowers the DEM", bool(np.all(filled[valid] >= dem[valid]))))
+    results.append(compareGrids("Pitted valley flow accumulation", accumulation, referenceAccumulation(directions)))
+
+    outlets = (directions == OUTLET)
+    drained = np.nansum(accumulation[outlets] + 1)
+    results.append(report("Every cell drains to an outlet", drained == np.count_nonzero(valid),
+                          str(int(drained)) + " of " + str(np.count_nonzero(valid)) + " cells"))
+    return all(results)
+
+
+def validateReference(demPath, accumulationPath):
+    """Compares against a DEM and flow accumulation grid exported from another tool, such as ArcGIS"""
+    dem = np.load(demPath).astype(np.float64)
+    expectedAccumulation = np.load(accumulationPath).astype(np.float64)
+    rasters, seconds = runEngine(dem)
+    accumulation = rasters["flowAccumulation"].array
+    valid = ~np.isnan(accumulation) & ~np.isnan(expectedAccumulation)
+    same = np.isclose(accumulation[valid], expectedAccumulation[valid])
+    print("Reference grid took " + str(round(seconds, 3)) + " seconds")
+    print(str(round(100.0 * same.mean(), 3)) + "% of cells match exactly")
+
+    """Flat areas can be routed differently by different tools, so large streams are the real test"""
+    streams = valid & (expectedAccumulation > np.nanpercentile(expectedAccumulation, 99))
+    relativeError = np.abs(accumulation[streams] - expectedAccumulation[streams]) / expectedAccumulation[streams]
+    return report("Median relative error on streams", np.median(relativeError) < 0.01,
+                  str(float(np.median(relativeError))))
+
+
+def main():
+    size = 120
+    if "--size" in sys.argv:
+        size = int(sys.argv[sys.argv.index("--size") + 1])
+    passed = validateSynthetic(size)
+    if "--reference" in sys.argv:
+        index = sys.argv.index("--reference")
+        passed = validateReference(sys.argv[index + 1], sys.argv[index + 2]) and passed
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
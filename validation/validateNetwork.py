@@ -0,0 +1,73 @@
+########################################################################################################################
+# Name: Stream Network Validation
+# Purpose: Checks that the ends of reaches are snapped together by how far apart they are, not by which side of a grid
+# line they fall on. Two reaches whose ends are a hair apart across a rounding boundary have to join, so drainage area
+# keeps adding up downstream, and ends that are farther apart than the tolerance have to stay apart.
+#
+# Usage: python validateNetwork.py
+########################################################################################################################
+
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from GrainSizeNetwork import DEFAULT_SNAP_TOLERANCE, StreamGraph, snapEndPoints
+
+
+def report(name, passed, detail=""):
+    print(("PASS " if passed else "FAIL ") + name + (": " + detail if detail else ""))
+    return passed
+
+
+def validateSnapping(tolerance=DEFAULT_SNAP_TOLERANCE):
+    results = []
+
+    """The upper reach ends 0.01 to the left of x = tolerance / 2, where rounding to a grid would split them, and the
+    lower reach starts 0.01 to the right of it"""
+    boundary = tolerance / 2
+    firstXs = np.array([-100.0, boundary + 0.005])
+    firstYs = np.array([0.0, 0.0])
+    lastXs = np.array([boundary - 0.005, 100.0])
+    lastYs = np.array([0.0, 0.0])
+    upNodes, downNodes, nodeXs, nodeYs = snapEndPoints(firstXs, firstYs, lastXs, lastYs, tolerance)
+    results.append(report("Ends 0.01 apart across a rounding boundary share a node", downNodes[0] == upNodes[1],
+                          str(len(nodeXs)) + " nodes"))
+
+    """What drains off the upper reach has to carry on into the lower one, so the lower reach starts with the upper
+    reach's precipitation rather than its own"""
+    nodeDrainageAreas = np.where(nodeXs < -50, 1.0, np.where(nodeXs > 50, 5.0, 3.0))
+    drainageAreas, precips, numInLoops = StreamGraph(upNodes, downNodes, len(nodeXs)).accumulate(
+        nodeDrainageAreas, np.array([100.0, 200.0]))
+    results.append(report("Precipitation is passed down across the boundary", precips[1] == 100.0,
+                          "%.1f" % precips[1] + " cm at the top of the lower reach"))
+
+    """Ends almost 1.4 tolerances apart on a diagonal, which rounding to a grid puts in the same cell"""
+    firstXs = np.array([-100.0, 0.49 * tolerance])
+    firstYs = np.array([0.0, 0.49 * tolerance])
+    lastXs = np.array([-0.49 * tolerance, 100.0])
+    lastYs = np.array([-0.49 * tolerance, 0.0])
+    upNodes, downNodes, nodeXs, nodeYs = snapEndPoints(firstXs, firstYs, lastXs, lastYs, tolerance)
+    results.append(report("Ends 1.39 tolerances apart stay apart", downNodes[0] != upNodes[1],
+                          str(len(nodeXs)) + " nodes"))
+
+    """A random cloud of ends, checked against comparing every pair of them"""
+    random = np.random.RandomState(0)
+    numReaches = 400
+    ends = random.uniform(0, 20 * tolerance, (4, numReaches))
+    upNodes, downNodes, nodeXs, nodeYs = snapEndPoints(ends[0], ends[1], ends[2], ends[3], tolerance)
+    xs = np.concatenate((ends[0], ends[2]))
+    ys = np.concatenate((ends[1], ends[3]))
+    nodes = np.concatenate((upNodes, downNodes))
+    close = (xs[:, np.newaxis] - xs) ** 2 + (ys[:, np.newaxis] - ys) ** 2 <= tolerance ** 2
+    results.append(report("Every pair of ends within the tolerance shares a node",
+                          bool((nodes[:, np.newaxis] == nodes)[close].all()), str(len(nodeXs)) + " nodes"))
+    return all(results)
+
+
+def main():
+    return 0 if validateSnapping() else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())